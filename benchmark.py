@@ -0,0 +1,397 @@
+"""
+Benchmarks of the newsletter and directory tools.
+
+Run from the folder containing ssphub_directory:
+    python -m ssphub_directory.benchmark render .temp/temp.qmd
+    python -m ssphub_directory.benchmark offline --output results.json --compare previous_results.json
+    python -m ssphub_directory.benchmark cold-start
+
+The offline benchmarks run against local stand-ins of GitHub and GRIST serving synthetic data,
+so that their results are reproducible and can be compared from one run to the next.
+"""
+import argparse  # Command line of the benchmarks
+import contextlib  # To silence the functions while they are timed
+import datetime  # Date of the results
+import difflib  # To compare rendered outputs
+import html.parser  # To extract the text of rendered html
+import io  # To silence the functions while they are timed
+import json  # Machine-readable results
+import os
+import platform  # Machine the results come from
+import random  # Synthetic data
+import shutil  # To copy the qmd file rendered by each backend
+import subprocess  # Fresh interpreters to measure cold starts
+import sys
+import tempfile  # Work folder of each backend
+import time  # To time the runs
+
+import ssphub_directory.my_functions as my_f
+from ssphub_directory.tests.stand_ins import (GristStandIn, render_stand_in, serve_github, serve_grist, stand_in_environment,
+                                              write_synthetic_newsletter)
+
+
+class HtmlText(html.parser.HTMLParser):
+    """
+    Collect the visible words and the images of an html document
+    """
+    def __init__(self):
+        super().__init__()
+        self.words = []
+        self.images = 0
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('style', 'script', 'head'):
+            self._skip += 1
+        if tag == 'img':
+            self.images += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('style', 'script', 'head') and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.words.extend(data.split())
+
+
+def html_text(html_content):
+    """
+    Visible words and number of images of an html document
+
+    Returns:
+        tuple with the list of words and the number of images
+    """
+    parser = HtmlText()
+    parser.feed(html_content)
+    return parser.words, parser.images
+
+
+def benchmark_render_backends(processed_qmd_file, engines=None, repeat=3):
+    """
+    Render a processed qmd file with each backend, timing it, and compare the outputs to the first backend
+
+    Args:
+        processed_qmd_file (string): qmd file written by process_qmd_file. The images it uses must be in the same folder
+        engines (tuple): names of the backends, keys of my_f.RENDER_BACKENDS. All of them by default
+        repeat (int): number of renderings per backend, the best time is kept
+
+    Returns:
+        list of dicts with keys 'engine', 'seconds', 'bytes', 'words', 'images', 'text_similarity'
+        ('status' and 'error' instead when the backend failed, e.g. Quarto not installed)
+    """
+    results = []
+    reference_words = None
+    engines = engines or tuple(my_f.RENDER_BACKENDS)
+    source_dir = os.path.dirname(os.path.abspath(processed_qmd_file))
+
+    for engine in engines:
+        # Each backend renders a copy of the folder, so that outputs don't overwrite each other
+        with tempfile.TemporaryDirectory() as work_dir:
+            work_dir = os.path.join(work_dir, os.path.basename(source_dir))
+            shutil.copytree(source_dir, work_dir)
+            qmd_file = os.path.join(work_dir, os.path.basename(processed_qmd_file))
+
+            timings = []
+            try:
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    html_file = my_f.RENDER_BACKENDS[engine](qmd_file)
+                    timings.append(time.perf_counter() - start)
+                with open(html_file, 'r', encoding='utf-8') as f:
+                    html_content = f.read()
+            except Exception as e:
+                results.append({'engine': engine, 'status': 'failed', 'error': str(e)})
+                continue
+
+        words, images = html_text(html_content)
+        if reference_words is None:
+            reference_words = words
+        results.append({
+            'engine': engine,
+            'status': 'ok',
+            'seconds': min(timings),
+            'bytes': len(html_content.encode('utf-8')),
+            'words': len(words),
+            'images': images,
+            'text_similarity': round(difflib.SequenceMatcher(None, reference_words, words, autojunk=False).ratio(), 4)
+        })
+
+    return results
+
+
+def synthetic_contact_table(n_rows, n_domains=50):
+    """Columns of a GRIST Contact table of n_rows rows, with a few accounts to delete and duplicates"""
+    return {
+        'id': list(range(1, n_rows + 1)),
+        'email': [f'User{i}@Domain{i % n_domains}.fr' if i % 97 else f'user{i - 1}@domain{(i - 1) % n_domains}.fr'
+                  for i in range(1, n_rows + 1)],
+        'Supprimez_mon_compte': [i % 53 == 0 for i in range(1, n_rows + 1)],
+        'nom': [f'Nom {i}' for i in range(1, n_rows + 1)],
+        'Nom_domaine': [f'domain{i % n_domains}.fr' for i in range(1, n_rows + 1)],
+        'Date_modification': [1_700_000_000.0 + i for i in range(1, n_rows + 1)]
+    }
+
+
+def synthetic_website_tables(n_pages, image_size=50_000):
+    """
+    Intranet_details table of the GRIST website merge document with n_pages pages, and the attachments of their images
+
+    Returns:
+        tuple (table columns, attachments {id: (file name, content)})
+    """
+    rng = random.Random(n_pages)
+    table = {
+        'id': list(range(1, n_pages + 1)),
+        'Acteurs': [f'Équipe {i}\nInsee' for i in range(n_pages)],
+        'Resultats': [f'Résultats du projet {i}' for i in range(n_pages)],
+        'Details_du_projet': [f'Détails du projet {i}\nsur deux lignes' for i in range(n_pages)],
+        'sous_titre': [f'Sous-titre {i}' for i in range(n_pages)],
+        'Code_du_projet': [f'https://github.com/InseeFrLab/projet_{i}' for i in range(n_pages)],
+        'tags': [f'  - tag{i % 5}' for i in range(n_pages)],
+        'nom_dossier': [f'projet_{i}' for i in range(n_pages)],
+        'date': ['2025-10-01'] * n_pages,
+        'image': [f'image_{i % 20}.png' for i in range(n_pages)],
+        'Titre': [f'Projet {i}' for i in range(n_pages)],
+        'auteurs': [f'  - Auteur {i}' for i in range(n_pages)],
+        'to_update': [True] * n_pages
+    }
+    attachments = {i + 1: (f'image_{i}.png', rng.randbytes(image_size)) for i in range(min(n_pages, 20))}
+    return table, attachments
+
+
+def time_runs(func, repeat=3, setup=None):
+    """
+    Time repeat runs of func, the printed messages being discarded
+
+    Args:
+        func (callable): function to time, without arguments
+        repeat (int): number of runs. The first one runs with empty caches
+        setup (callable or None): called before each run, not timed
+
+    Returns:
+        list of the durations in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def benchmark_result(name, rows, timings, **counters):
+    """
+    Result of a benchmark: cold (first run, empty caches) and best durations. For the instrumented
+    pipelines, the stage durations and counters of the last run are added (see my_f.instrumented_pipeline)
+    """
+    result = {'benchmark': name, 'rows': rows, 'cold_seconds': round(timings[0], 4),
+              'best_seconds': round(min(timings), 4), 'runs': len(timings), **counters}
+    report = my_f.last_pipeline_metrics(name)
+    if report is not None:
+        result['stages'] = {stage['stage']: stage['seconds'] for stage in report['stages']}
+        result['counters'] = report['counters']
+    return result
+
+
+# Dependencies my_functions imports only when a command needs them
+HEAVY_MODULES = ('pandas', 'polars', 'grist_api', 'yaml', 'requests')
+
+
+def benchmark_cold_start(repeat=5):
+    """
+    Time fresh Python interpreters: importing my_functions, running the bounces command of the
+    command line on a small file, and importing the heavy dependencies (what importing my_functions
+    cost before they were imported lazily)
+
+    Args:
+        repeat (int): number of interpreters started per measure
+
+    Returns:
+        list of results (see benchmark_result), with the heavy modules loaded by the import of my_functions
+    """
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(my_f.__file__)))
+    env = dict(os.environ, PYTHONPATH=package_parent + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    loaded = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        replies_path = os.path.join(work_dir, 'replies.txt')
+        with open(replies_path, 'w', encoding='utf-8') as f:
+            f.write('Delivery failed for user1@domain.fr\nDelivery failed for user2@domain.fr\n')
+
+        commands = {
+            'cold_start_import': [sys.executable, '-c', 'import sys, ssphub_directory.my_functions; '
+                                  f'print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'],
+            'cold_start_bounces': [sys.executable, '-m', 'ssphub_directory.cli', 'bounces', replies_path],
+            'cold_start_heavy_modules': [sys.executable, '-c', f'import {", ".join(HEAVY_MODULES)}']
+        }
+        results = []
+        for name, command in commands.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                completed = subprocess.run(command, cwd=package_parent, env=env, capture_output=True, text=True, check=True)
+                timings.append(time.perf_counter() - start)
+            if name == 'cold_start_import':
+                loaded = [module for module in completed.stdout.strip().split(',') if module]
+                results.append(benchmark_result(name, 0, timings, heavy_modules_loaded=loaded))
+            else:
+                results.append(benchmark_result(name, 0, timings))
+
+    return results
+
+
+def run_offline_benchmarks(scales=(1000, 10000, 100000), repeat=3, n_images=8, pages_per_rows=100, cold_start=True,
+    engine='stand_in'):
+    """
+    Time generate_email, get_emails, delete_email_from_contact_table and fill_all_templates_from_grist
+    against local GitHub / GRIST stand-ins, for Contact tables of each size in scales.
+    Each scale runs in a new folder, so the first run of each benchmark has empty caches.
+
+    Args:
+        scales (tuple): numbers of rows of the Contact table
+        repeat (int): runs of each benchmark
+        n_images (int): number of images of the newsletter
+        pages_per_rows (int): one website page per pages_per_rows rows of the Contact table
+        cold_start (boolean): also time the start of fresh interpreters, see benchmark_cold_start
+        engine (string): render backend of generate_email. By default the stand-in of Quarto (see render_stand_in),
+        to time the network and GRIST stages without Quarto
+
+    Returns:
+        dict with the environment of the run and the list of results (see benchmark_result)
+    """
+    results = []
+    cwd = os.getcwd()
+    template_path = os.path.join(os.path.dirname(os.path.abspath(my_f.__file__)), 'template.qmd')
+    my_f.register_render_backend('stand_in', render_stand_in)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        write_synthetic_newsletter(os.path.join(work_dir, 'github'), n_images=n_images)
+        github_server, github_url = serve_github(os.path.join(work_dir, 'github'))
+
+        for n_rows in scales:
+            scale_dir = os.path.join(work_dir, f'rows_{n_rows}')
+            os.makedirs(scale_dir)
+            os.chdir(scale_dir)
+
+            contact = synthetic_contact_table(n_rows)
+            website, attachments = synthetic_website_tables(max(1, n_rows // pages_per_rows))
+            grist_server, grist_url = serve_grist({'Contact': {col: list(values) for col, values in contact.items()},
+                                                   'Delete': {'id': [], 'Emails_to_delete': []},
+                                                   'Intranet_details': website}, attachments)
+            # 1% of the directory replies with a bounce
+            with open('replies.txt', 'w', encoding='utf-8') as f:
+                f.write('\n'.join(f'Delivery failed for {email}' for email in contact['email'][::100]))
+
+            try:
+                with stand_in_environment(github_url, grist_url, os.path.join(scale_dir, '.cache')):
+                    emails = []
+                    timings = time_runs(lambda: emails.append(my_f.get_emails()), repeat)
+                    results.append(benchmark_result('get_emails', n_rows, timings, emails=emails[-1].count('@')))
+
+                    timings = time_runs(lambda: my_f.generate_email(1, 'main', 'Infolettre', 'newsletter@insee.fr',
+                                                                    emails[-1], email_from=None, engine=engine), repeat)
+                    results.append(benchmark_result('generate_email', n_rows, timings,
+                                                    eml_bytes=os.path.getsize('.temp/email.eml')))
+
+                    timings = time_runs(lambda: my_f.fill_all_templates_from_grist(template_path, directory='site'), repeat)
+                    results.append(benchmark_result('fill_all_templates_from_grist', n_rows, timings, pages=len(website['id'])))
+
+                    def reset_contact():
+                        GristStandIn.tables['Contact'] = {col: list(values) for col, values in contact.items()}
+                        my_f.clear_grist_clients()
+                    timings = time_runs(lambda: my_f.delete_email_from_contact_table('replies.txt', backoff=0.01),
+                                        repeat, setup=reset_contact)
+                    results.append(benchmark_result('delete_email_from_contact_table', n_rows, timings,
+                                                    deleted=n_rows - len(GristStandIn.tables['Contact']['id'])))
+            finally:
+                os.chdir(cwd)
+                grist_server.shutdown()
+
+        github_server.shutdown()
+
+    if cold_start:
+        results.extend(benchmark_cold_start(repeat))
+
+    return {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+
+
+def compare_results(previous, current, tolerance=0.25):
+    """
+    Find the benchmarks whose best time got worse by more than tolerance since a previous run
+
+    Args:
+        previous (dict): results of a previous run_offline_benchmarks
+        current (dict): results of run_offline_benchmarks
+        tolerance (float): allowed relative slow down
+
+    Returns:
+        list of dicts with keys 'benchmark', 'rows', 'previous_seconds', 'current_seconds'
+    """
+    previous_best = {(result['benchmark'], result['rows']): result['best_seconds'] for result in previous['results']}
+    regressions = []
+    for result in current['results']:
+        before = previous_best.get((result['benchmark'], result['rows']))
+        if before is not None and result['best_seconds'] > before * (1 + tolerance):
+            regressions.append({'benchmark': result['benchmark'], 'rows': result['rows'],
+                                'previous_seconds': before, 'current_seconds': result['best_seconds']})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    render_parser = subparsers.add_parser('render', help='compare the render backends of knit_to_html')
+    render_parser.add_argument('qmd_file', help='processed qmd file (see process_qmd_file)')
+    render_parser.add_argument('--engines', nargs='+', default=None, help='backends to compare, all by default')
+    render_parser.add_argument('--repeat', type=int, default=3)
+
+    offline_parser = subparsers.add_parser('offline', help='time the pipelines against local GitHub / GRIST stand-ins')
+    offline_parser.add_argument('--scales', nargs='+', type=int, default=[1000, 10000, 100000],
+                                help='numbers of rows of the Contact table')
+    offline_parser.add_argument('--repeat', type=int, default=3)
+    offline_parser.add_argument('--images', type=int, default=8, help='number of images of the newsletter')
+    offline_parser.add_argument('--output', help='json file to write the results to')
+    offline_parser.add_argument('--compare', help='json file of previous results: exit with 1 if a benchmark got slower')
+    offline_parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slow down')
+    offline_parser.add_argument('--skip-cold-start', action='store_true', help="don't time the start of fresh interpreters")
+    offline_parser.add_argument('--engine', default='stand_in', help='render backend of generate_email, quarto to time it too')
+
+    cold_start_parser = subparsers.add_parser('cold-start', help='time the import of my_functions and the command line')
+    cold_start_parser.add_argument('--repeat', type=int, default=5)
+
+    args = parser.parse_args(argv)
+    if args.benchmark == 'render':
+        results = benchmark_render_backends(args.qmd_file, args.engines and tuple(args.engines), args.repeat)
+    elif args.benchmark == 'cold-start':
+        results = benchmark_cold_start(args.repeat)
+    else:
+        results = run_offline_benchmarks(tuple(args.scales), args.repeat, args.images, cold_start=not args.skip_cold_start,
+                                         engine=args.engine)
+    print(json.dumps(results, indent=2))
+
+    if args.benchmark == 'offline':
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+        if args.compare:
+            with open(args.compare, 'r', encoding='utf-8') as f:
+                regressions = compare_results(json.load(f), results, args.tolerance)
+            for regression in regressions:
+                print(f"Regression: {regression['benchmark']} ({regression['rows']} rows) "
+                      f"{regression['previous_seconds']}s -> {regression['current_seconds']}s", file=sys.stderr)
+            return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""
+Command line of the SSPHub directory and newsletter tools.
+
+Run from the folder containing ssphub_directory:
+    python -m ssphub_directory.cli newsletter 20 --object "Infolettre d'octobre" --to newsletter@insee.fr --directory-bcc
+    python -m ssphub_directory.cli bounces replies.mbox
+    python -m ssphub_directory.cli bounces replies.txt --delete
+    python -m ssphub_directory.cli site-merge --template ssphub_directory/template.qmd --directory ssphub/project
+
+The heavy dependencies (pandas, polars, grist_api, yaml, requests) are only imported by the commands that use them.
+"""
+import argparse  # Command line
+import logging
+import sys
+
+import ssphub_directory.my_functions as my_f
+
+
+def newsletter(args):
+    """Generate the draft email(s) of a newsletter, see my_f.generate_emails"""
+    bcc = my_f.get_emails() if args.directory_bcc and args.max_per_domain is None else args.bcc
+    batches = None
+    if args.directory_bcc and args.max_per_domain is not None:
+        batches = my_f.get_recipient_batches(max_per_message=args.shard_size or 500, max_per_domain=args.max_per_domain)
+    eml_files = my_f.generate_emails(args.number, args.branch, [{
+        'email_object': args.object,
+        'email_to': args.to,
+        'email_bcc': bcc,
+        'email_cc': args.cc,
+        'email_from': args.sender,
+        'eml_file': args.output,
+        'shard_size': args.shard_size,
+        'batches': batches
+    }], drop_temp=not args.keep_temp, engine=args.engine,
+        cid_images=args.cid_images, image_max_width=args.image_max_width, image_quality=args.image_quality)
+    return 0 if eml_files else 1
+
+
+def bounces(args):
+    """List the emails of the replies to a newsletter, and optionally remove them from GRIST"""
+    if args.delete:
+        summary = my_f.delete_email_from_contact_table(args.path, types=tuple(args.types))
+        return 1 if any(chunk['status'] == 'failed' for chunk in summary) else 0
+
+    emails = my_f.extract_emails_from_replies(args.path, tuple(args.types))
+    if args.add_to_delete_table:
+        summary = my_f.add_to_grist_delete_table(emails)
+        return 1 if any(chunk['status'] == 'failed' for chunk in summary) else 0
+
+    print('\n'.join(emails))
+    return 0
+
+
+def site_merge(args):
+    """Write the pages of the website from GRIST, see my_f.fill_all_templates_from_grist"""
+    my_f.fill_all_templates_from_grist(args.template, directory=args.directory, attachments_mode=args.attachments,
+                                       max_workers=args.max_workers, incremental=not args.full)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m ssphub_directory.cli', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--verbose', action='store_true', help='print the duration and the counters of each stage')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    newsletter_parser = subparsers.add_parser('newsletter', help='generate the draft email of a newsletter')
+    newsletter_parser.add_argument('number', help='number of the newsletter')
+    newsletter_parser.add_argument('--branch', default='main', help='repo branch of the newsletter (main when published)')
+    newsletter_parser.add_argument('--object', required=True, help='object of the email')
+    newsletter_parser.add_argument('--to', required=True, help='email adresses to send the email to')
+    recipients = newsletter_parser.add_mutually_exclusive_group()
+    recipients.add_argument('--bcc', default='', help='email adresses to put in bcc, separated by ;')
+    recipients.add_argument('--directory-bcc', action='store_true', help='put the emails of the GRIST directory in bcc')
+    newsletter_parser.add_argument('--cc', default='', help='email adresses to put in cc')
+    newsletter_parser.add_argument('--from', dest='sender', default=None, help='sender to see in Outlook. Default sender if not given')
+    newsletter_parser.add_argument('--output', default='.temp/email.eml', help='path of the .eml file')
+    newsletter_parser.add_argument('--shard-size', type=int, default=None, help='maximum number of bcc recipients per .eml file')
+    newsletter_parser.add_argument('--max-per-domain', type=int, default=None,
+                                   help='with --directory-bcc, maximum number of recipients at the same mail domain per .eml file')
+    newsletter_parser.add_argument('--engine', default='quarto',
+                                   help='render backend, quarto or a backend added with register_render_backend')
+    newsletter_parser.add_argument('--cid-images', action='store_true', help='attach the images instead of putting them inside the html')
+    newsletter_parser.add_argument('--image-max-width', type=int, default=None, help='with --cid-images, maximum width of the images')
+    newsletter_parser.add_argument('--image-quality', type=int, default=None, help='with --cid-images, jpeg quality of the images')
+    newsletter_parser.add_argument('--keep-temp', action='store_true', help='keep the knitted qmd and html files')
+    newsletter_parser.set_defaults(func=newsletter)
+
+    bounces_parser = subparsers.add_parser('bounces', help='extract the emails of the replies to a newsletter')
+    bounces_parser.add_argument('path', help='replies.txt, mbox file, Maildir, folder of .eml files or .eml file')
+    bounces_parser.add_argument('--types', nargs='+', default=['hard'], choices=['hard', 'soft'],
+                                help='types of bounces to keep for mailboxes')
+    action = bounces_parser.add_mutually_exclusive_group()
+    action.add_argument('--add-to-delete-table', action='store_true', help='post the emails to the Delete table of GRIST')
+    action.add_argument('--delete', action='store_true', help='delete the emails from the Contact table of GRIST')
+    bounces_parser.set_defaults(func=bounces)
+
+    site_parser = subparsers.add_parser('site-merge', help='write the pages of the website from GRIST')
+    site_parser.add_argument('--template', default='ssphub_directory/template.qmd', help='template of the pages')
+    site_parser.add_argument('--directory', default='ssphub_directory', help='root directory of the pages')
+    site_parser.add_argument('--attachments', default='selective', choices=['selective', 'archive'],
+                             help='download only the needed images, or the whole attachments archive')
+    site_parser.add_argument('--max-workers', type=int, default=8)
+    site_parser.add_argument('--full', action='store_true', help='write every page, ignoring the build manifest')
+    site_parser.set_defaults(func=site_merge)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'newsletter' and args.max_per_domain is not None and not args.directory_bcc:
+        parser.error('--max-per-domain only applies to the emails of the directory, use it with --directory-bcc')
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
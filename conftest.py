@@ -0,0 +1,33 @@
+import pytest
+
+from ssphub_directory.my_functions import clear_grist_clients
+from ssphub_directory.tests.stand_ins import serve_grist
+
+
+@pytest.fixture(autouse=True)
+def cache_in_tmp_path(tmp_path, monkeypatch):
+    # The caches of my_functions (see cache_path) are kept in the folder of each test
+    monkeypatch.setenv('SSPHUB_CACHE_DIR', str(tmp_path / '.cache'))
+
+
+@pytest.fixture
+def grist_stand_in(monkeypatch):
+    # grist_stand_in(tables) starts a GRIST stand-in serving tables (see serve_grist), points the GRIST
+    # clients to it (documents 'doc' for the directory and 'website' for the website merge) and returns its url.
+    # The stand-in is shut down and the shared clients are forgotten after the test
+    servers = []
+
+    def start(tables, attachments=None):
+        server, url = serve_grist(tables, attachments)
+        servers.append(server)
+        monkeypatch.setenv('GRIST_API_KEY', 'key')
+        monkeypatch.setenv('GRIST_SERVER', url)
+        monkeypatch.setenv('GRIST_SSPHUB_DIRECTORY_ID', 'doc')
+        monkeypatch.setenv('GRIST_SSPHUB_WEBSITE_MERGE_ID', 'website')
+        clear_grist_clients()
+        return url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+    clear_grist_clients()
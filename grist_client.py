@@ -0,0 +1,161 @@
+"""
+GRIST client shared by the functions of my_functions.
+
+It is kept in its own module so that grist_api is only imported by the commands that use GRIST:
+my_functions.get_grist_client imports it on first use.
+"""
+
+import json  # Body of the GRIST requests
+import threading  # Clients are shared between threads
+import time  # Lifetime of the table snapshots
+from collections import namedtuple  # GRIST records
+
+import requests
+from grist_api import GristDocAPI
+from grist_api.grist_api import get_api_key
+
+from ssphub_directory.my_functions import (GRIST_ALL_TABLES, GRIST_BUSY_DELAY, GRIST_BUSY_RETRIES, GRIST_SERVER,
+                                           GRIST_SNAPSHOT_TTL, build_email_index, count_metric, get_http_session)
+
+
+class PooledGristDocAPI(GristDocAPI):
+    """
+    GristDocAPI reusing one HTTP session (keep-alive) for all its calls,
+    and keeping a snapshot of each fetched table for ttl seconds. The snapshot of a table is dropped
+    as soon as this client writes to it.
+    Only the HTTP request of GristDocAPI.call is replaced: the connection settings are kept by this class
+    instead of being read from the private attributes of GristDocAPI.
+    """
+    def __init__(self, doc_id, api_key=None, server=GRIST_SERVER, ttl=GRIST_SNAPSHOT_TTL, dryrun=False, verify_ssl=True,
+                 busy_retries=GRIST_BUSY_RETRIES):
+        api_key = api_key or get_api_key()
+        super().__init__(doc_id, api_key=api_key, server=server.rstrip('/'), dryrun=dryrun, verify_ssl=verify_ssl)
+        self.doc_url = server.rstrip('/') + '/api/docs/%s/' % doc_id
+        self.server = server.rstrip('/')
+        self.dryrun = dryrun
+        self.busy_retries = busy_retries
+        self._session = get_http_session()
+        self._session.headers.update({'Authorization': 'Bearer %s' % api_key,
+                                      'Content-Type': 'application/json',
+                                      'Accept': 'application/json'})
+        self._session.verify = verify_ssl
+        self._ttl = ttl
+        self._snapshots = {}  # {table_name: (time of fetch, {column: list of values})}
+        self._email_indexes = {}  # {(table_name, column, fold_plus): index built from the snapshot}, see email_index
+        self._lock = threading.Lock()
+
+    def call(self, url, json_data=None, method=None, prefix=None):
+        """
+        Same as GristDocAPI.call, through the shared session. Writes invalidate the snapshots
+        of the tables they touch. In dryrun, writes are not sent but reads (GET and the SQL endpoint) are.
+        """
+        full_url = self.doc_url + url if prefix is None else self.server + prefix + url
+        data = json.dumps(json_data, sort_keys=True).encode('utf8') if json_data is not None else None
+        method = method or ('POST' if data else 'GET')
+        read_only = self.is_read_only(url, method)
+
+        if self.dryrun and not read_only:
+            print(f"Dry run: {method} request to {full_url} not sent")
+            return None
+
+        try:
+            return self._request(method, full_url, data)
+        finally:
+            if not read_only:
+                self.invalidate(*self._tables_written(url, json_data))
+
+    def _request(self, method, full_url, data):
+        # SQLITE_BUSY is a temporary problem for which it's safe to retry, a few times
+        for attempt in range(self.busy_retries + 1):
+            resp = self._session.request(method, full_url, data=data)
+            count_metric('http_calls')
+            if resp.ok:
+                count_metric('bytes_downloaded', len(resp.content))
+                return resp
+            err_msg = None
+            try:
+                error_obj = resp.json()
+                if isinstance(error_obj, dict):
+                    err_msg = error_obj.get('error')
+            except ValueError:
+                pass
+            if not (isinstance(err_msg, str) and 'SQLITE_BUSY' in err_msg) or attempt == self.busy_retries:
+                break
+            print(f"GRIST busy, retrying in {GRIST_BUSY_DELAY} s: {err_msg}")
+            time.sleep(GRIST_BUSY_DELAY)
+        if isinstance(err_msg, str):
+            raise requests.HTTPError(err_msg, response=resp)
+        resp.raise_for_status()
+
+    @staticmethod
+    def is_read_only(url, method):
+        # GET requests and the SQL endpoint (SELECT statements only, sent with POST) don't change the document
+        return method == 'GET' or url.startswith('sql')
+
+    @staticmethod
+    def _tables_written(url, json_data):
+        # 'tables/<table>/...' endpoints or user actions ['BulkRemoveRecord', '<table>', ...] sent to 'apply'
+        if url.startswith('tables/'):
+            return [url.split('/')[1].split('?')[0]]
+        if url.startswith('apply') and isinstance(json_data, list):
+            return [action[1] for action in json_data if len(action) > 1 and isinstance(action[1], str)]
+        return list(GRIST_ALL_TABLES)
+
+    def fetch_table_columns(self, table_name):
+        """
+        Fetch a table as GRIST sends it: a dict {column: list of values}. The table is served
+        from its snapshot if it was fetched less than ttl seconds ago.
+        """
+        with self._lock:
+            snapshot = self._snapshots.get(table_name)
+        if snapshot is not None and time.monotonic() - snapshot[0] < self._ttl:
+            count_metric('grist_snapshot_hits')
+            return snapshot[1]
+
+        columns = self.call('tables/%s/data' % table_name).json()
+        count_metric('rows_fetched', len(columns.get('id', [])))
+        # The indexes of the previous snapshot are out of date
+        self.invalidate(table_name)
+        with self._lock:
+            self._snapshots[table_name] = (time.monotonic(), columns)
+        return columns
+
+    def email_index(self, table_name='Contact', column='email', fold_plus=False):
+        """
+        Normalized email index of a column (see build_email_index), built once per snapshot of the table:
+        it is dropped with the snapshot, when the snapshot expires or when this client writes to the table
+        """
+        columns = self.fetch_table_columns(table_name)
+        key = (table_name, column, fold_plus)
+        with self._lock:
+            index = self._email_indexes.get(key)
+        if index is None:
+            index = build_email_index(columns['id'], columns[column], fold_plus)
+            with self._lock:
+                self._email_indexes[key] = index
+        return index
+
+    def fetch_table(self, table_name, filters=None):
+        """
+        Same as GristDocAPI.fetch_table. Without filters, the table is served from its snapshot
+        if it was fetched less than ttl seconds ago.
+        """
+        if filters:
+            return super().fetch_table(table_name, filters)
+
+        columns = self.fetch_table_columns(table_name)
+        Record = namedtuple(table_name, columns.keys())
+        return [Record._make(values) for values in zip(*columns.values())]
+
+    def invalidate(self, *table_names):
+        """
+        Drop the snapshots of the given tables, or of every table if GRIST_ALL_TABLES is given or none
+        """
+        with self._lock:
+            if not table_names or GRIST_ALL_TABLES[0] in table_names:
+                self._snapshots.clear()
+                self._email_indexes.clear()
+            for table_name in table_names:
+                self._snapshots.pop(table_name, None)
+            for key in [key for key in self._email_indexes if key[0] in table_names]:
+                del self._email_indexes[key]
@@ -12,19 +12,479 @@
 
 from email.mime.multipart import MIMEMultipart  # To generate the draft email
 from email.mime.text import MIMEText  # To generate the draft email
-import requests  # To transform newsletter into email, call Github API and download files
-import yaml  # To update newsletter qmd metadata for the email
+from email.mime.image import MIMEImage  # To attach the images of the draft email
+import io  # To recompress images in memory
+from email import policy  # To parse bounced emails
+from email.parser import BytesParser  # To parse bounced emails
+import mailbox  # To read bounced emails from mbox / Maildir
+import subprocess  # To call Quarto
+import base64  # To embed images in the html
+import mimetypes  # To embed images in the html
+import importlib  # To import heavy dependencies on first use
 import os  # to remove temporary files, create directory etc
-from grist_api import GristDocAPI  # To get directory emails
-import polars as pl  # to manage directory emails
-import pandas as pd  # to manage directory emails
 import re  # For pattern matching to search for emails
 import shutil  # to remove directory and its content
 import zipfile  # GRIST attachments
+from concurrent.futures import ThreadPoolExecutor  # To download several files at once
+import hashlib  # To name cached files
+import json  # To store metadata of cached files
+import time  # To order cached files by last use
+import threading  # To share GRIST clients between threads
+import asyncio  # To overlap the network stages of generate_email
+import contextlib  # Stages of the instrumented pipelines
+import logging  # Summaries of the instrumented pipelines
+import urllib.parse  # To filter GRIST records on the server
+from collections import deque, namedtuple  # GRIST records, recipients left by domain
+
+
+class LazyModule:
+    """
+    Module imported on first use of one of its attributes, so that importing my_functions
+    doesn't load the heavy dependencies that a command doesn't need (e.g. extracting bounces)
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'{' (imported)' if self._module is not None else ''}>"
+
+
+requests = LazyModule('requests')  # To transform newsletter into email, call Github API and download files
+yaml = LazyModule('yaml')  # To update newsletter qmd metadata for the email
+pl = LazyModule('polars')  # to manage directory emails
+pd = LazyModule('pandas')  # to manage directory emails
+
+# Images of the draft email attached by Content-ID (see encode_email_body): default recompression settings
+EMAIL_IMAGE_MAX_WIDTH = 1200
+EMAIL_IMAGE_QUALITY = 80
+DATA_URI_IMAGE_PATTERN = re.compile(r'(<img\b[^>]*?\bsrc=)(["\'])data:(image/[\w.+-]+);base64,([A-Za-z0-9+/=\s]+)\2', re.IGNORECASE)
+
+# Folder of the caches below when they are given as relative paths: the .cache folder next to this file,
+# whatever the working directory (can be overridden with the SSPHUB_CACHE_DIR environment variable)
+CACHE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+
+# Persistent HTTP cache for GitHub / Grist downloads
+HTTP_CACHE_DIR = 'http'
+HTTP_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# Cache of the html rendered by knit_to_html, keyed by a hash of its inputs
+RENDER_CACHE_DIR = 'render'
+RENDER_CACHE_MAX_BYTES = 100 * 1024 * 1024
+
+# Extensions of the files considered as images
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp'}
+# Image paths of a qmd file: in ![](...), src="..." or the yaml, anything ending with one of IMAGE_EXTENSIONS
+IMAGE_REFERENCE_PATTERN = re.compile(r'[^\s"\'()<>\[\]=]+(?:%s)\b' % '|'.join(re.escape(ext) for ext in sorted(IMAGE_EXTENSIONS)),
+                                     re.IGNORECASE)
+
+# Build manifest of the pages generated from GRIST, stored in the output directory
+BUILD_MANIFEST_FILE = '.build_manifest.json'
+
+# Local snapshot of the GRIST directory, kept up to date by delta syncs
+DIRECTORY_SNAPSHOT_DIR = 'directory'
+DIRECTORY_COLUMNS = ['email', 'Supprimez_mon_compte', 'nom', 'Nom_domaine']
+# GRIST column holding the last modification time of a row (trigger formula NOW() on any change),
+# added to the Contact table once with add_directory_updated_at_column
+DIRECTORY_UPDATED_AT_COLUMN = 'Date_modification'
+
+# Types of the GRIST columns we use, to build polars DataFrames without inferring the schema.
+# 'List' columns (choice lists, attachments) are sent by GRIST as ['L', value, ...], 'Object' columns are kept as sent
+GRIST_TABLE_SCHEMAS = {
+    'Contact': {'id': 'Int64', 'email': 'String', 'Supprimez_mon_compte': 'Boolean', 'nom': 'String', 'Nom_domaine': 'String'},
+    'Delete': {'id': 'Int64', 'Emails_to_delete': 'String'},
+    'Intranet_details': {'id': 'Int64', 'Acteurs': 'String', 'Resultats': 'String', 'Details_du_projet': 'String',
+                         'sous_titre': 'String', 'Code_du_projet': 'String', 'tags': 'Object', 'nom_dossier': 'String',
+                         'date': 'Object', 'image': 'Object', 'Titre': 'String', 'auteurs': 'String', 'to_update': 'Boolean'}
+}
+
+# '+tag' of the local part of an email (name+newsletter@example.com), removed when folding plus tags
+EMAIL_PLUS_TAG_PATTERN = r'\+[^@]*@'
+
+# GRIST server (can be overridden with the GRIST_SERVER environment variable)
+# and lifetime in seconds of the table snapshots kept by the GRIST clients
+GRIST_SERVER = "https://grist.numerique.gouv.fr/"
+GRIST_SNAPSHOT_TTL = 300
+# Retries (and seconds between them) of a GRIST call answered with SQLITE_BUSY, a temporary error
+GRIST_BUSY_RETRIES = 5
+GRIST_BUSY_DELAY = 2
+# Answers of a GRIST server without the SQL endpoint (older or restricted servers): lookups use record filters instead
+GRIST_SQL_UNAVAILABLE_STATUSES = (400, 403, 404)
+
+# GitHub API and raw files (can be overridden with the SSPHUB_GITHUB_API and SSPHUB_GITHUB_RAW
+# environment variables, e.g. to run against a local stand-in)
+GITHUB_API = "https://api.github.com"
+GITHUB_RAW = "https://raw.githubusercontent.com"
+
+# Git trees of the repo folders, cached by commit SHA (a tree never changes for a given commit),
+# and lifetime in seconds of the commit SHA resolved for a branch
+GITHUB_TREE_CACHE_DIR = 'github_trees'
+GITHUB_BRANCH_TTL = 300
+
+
+# Opt-in profiling of each stage of the instrumented pipelines (environment variable SSPHUB_PROFILE),
+# and json lines file their reports are appended to (environment variable SSPHUB_METRICS_FILE)
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+PROFILE_TOP_LINES = 15
+
+
+# Summaries of the instrumented pipelines are logged at the INFO level, e.g. shown with logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def profile_stage(record, profile):
+    """
+    Profile the code of the with block into the record of a stage: 'profile' (top functions by cumulative
+    time) with profile='cprofile', 'memory' (peak and top allocations) with profile='tracemalloc'.
+    The profilers are only imported here. cProfile only sees the current thread
+    """
+    if profile == 'cprofile':
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_TOP_LINES)
+            record['profile'] = stream.getvalue()
+    else:
+        import tracemalloc
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        snapshot_before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            top_stats = tracemalloc.take_snapshot().compare_to(snapshot_before, 'lineno')
+            record['memory'] = {'peak_bytes': tracemalloc.get_traced_memory()[1],
+                                'top': [str(stat) for stat in top_stats[:PROFILE_TOP_LINES]]}
+            if started_tracing:
+                tracemalloc.stop()
+
+
+class PipelineMetrics:
+    """
+    Timings of the stages of a pipeline run, and counters (http_calls, bytes_downloaded, rows_fetched,
+    files_written...) in total and per stage. The stages of a run follow each other: the counters of
+    a stage are what the run counted while the stage was open, from any thread.
+    With profile='cprofile' or 'tracemalloc', each stage is profiled (see profile_stage).
+    """
+    def __init__(self, name, profile=None):
+        if profile is not None and profile not in PROFILE_MODES:
+            raise ValueError(f"profile must be None or one of {PROFILE_MODES}, not {profile!r}")
+        self.name = name
+        self.profile = profile
+        self.stages = []
+        self.counters = {}
+        self.seconds = None
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the code of the with block as a stage
+        """
+        record = {'stage': name, 'seconds': None, 'counters': {}}
+        with self._lock:
+            counters_before = dict(self.counters)
+        start = time.perf_counter()
+        try:
+            with profile_stage(record, self.profile) if self.profile else contextlib.nullcontext():
+                yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 6)
+            with self._lock:
+                record['counters'] = {counter: value - counters_before.get(counter, 0)
+                                      for counter, value in self.counters.items() if value != counters_before.get(counter, 0)}
+                self.stages.append(record)
+
+    def count(self, counter, value=1):
+        """
+        Add value to a counter of the run, from any thread
+        """
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def report(self):
+        """
+        Returns:
+            dict with keys 'pipeline', 'seconds', 'stages' (list of dicts with keys 'stage', 'seconds',
+            'counters' and 'profile' or 'memory' when profiled) and 'counters'
+        """
+        return {'pipeline': self.name, 'seconds': self.seconds, 'stages': self.stages, 'counters': self.counters}
+
+
+# Run being instrumented, and last report of each pipeline
+_active_metrics = None
+_active_metrics_lock = threading.Lock()
+_last_metrics = {}
+
+
+@contextlib.contextmanager
+def instrumented_pipeline(name, profile=None):
+    """
+    Record the stages (see pipeline_stage) and counters (see count_metric) of a pipeline run.
+    A pipeline started inside another one (e.g. generate_email calling generate_emails) adds
+    to the outer run. At the end, a summary is logged at the INFO level (nothing is printed by default),
+    the report is kept (see last_pipeline_metrics) and appended to the json lines file of the
+    SSPHUB_METRICS_FILE environment variable, if set.
+
+    Args:
+        name (string): name of the pipeline
+        profile (string or None): 'cprofile' or 'tracemalloc' to profile each stage. Default from the
+        SSPHUB_PROFILE environment variable, no profiling if it is not set
+
+    Example:
+        >>> with instrumented_pipeline('newsletter', profile='cprofile'):
+                generate_email(19, 'main', 'Infolettre de rentrée', 'my_to_email@insee.fr', '')
+        >>> last_pipeline_metrics('newsletter')['stages'][0]['profile']
+    """
+    global _active_metrics
+    with _active_metrics_lock:
+        outer = _active_metrics
+        if outer is None:
+            _active_metrics = PipelineMetrics(name, profile or os.environ.get('SSPHUB_PROFILE') or None)
+        metrics = _active_metrics
+
+    if outer is not None:
+        yield outer
+        return
+
+    try:
+        yield metrics
+    finally:
+        metrics.seconds = round(time.perf_counter() - metrics._start, 6)
+        with _active_metrics_lock:
+            _active_metrics = None
+        report = metrics.report()
+        _last_metrics[name] = report
+        logger.info(format_pipeline_metrics(report))
+
+        metrics_file = os.environ.get('SSPHUB_METRICS_FILE')
+        if metrics_file:
+            with open(metrics_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(report) + '\n')
+
+
+@contextlib.contextmanager
+def pipeline_stage(name):
+    """
+    Time the code of the with block as a stage of the instrumented pipeline, if any
+    """
+    metrics = _active_metrics
+    if metrics is None:
+        yield None
+    else:
+        with metrics.stage(name) as record:
+            yield record
+
+
+def count_metric(counter, value=1):
+    """
+    Add value to a counter of the instrumented pipeline, if any
+    """
+    metrics = _active_metrics
+    if metrics is not None:
+        metrics.count(counter, value)
+
+
+def last_pipeline_metrics(name):
+    """
+    Report of the last run of a pipeline, see PipelineMetrics.report. None if it didn't run
+    """
+    return _last_metrics.get(name)
+
+
+def format_pipeline_metrics(report):
+    """
+    One line summary of a pipeline report
+
+    Example:
+        >>> format_pipeline_metrics(last_pipeline_metrics('generate_email'))
+        'generate_email: 0.52 s (download 0.40 s, knit 0.10 s, encode_body 0.01 s, write_eml 0.01 s) | http_calls=9 bytes_downloaded=1623442 files_written=3'
+    """
+    stages = ', '.join(f"{stage['stage']} {stage['seconds']:.2f} s" for stage in report['stages'])
+    counters = ' '.join(f'{counter}={value}' for counter, value in sorted(report['counters'].items()))
+    return f"{report['pipeline']}: {report['seconds']:.2f} s ({stages}) | {counters}"
+
+
+def recompress_image(image_bytes, mime_type, max_width=None, quality=None):
+    """
+    Downscale an image to max_width pixels and recompress it (jpeg with the given quality, or png
+    for images with transparency). Needs Pillow, images are returned as is without it.
+    Svg and gif (animations) are returned as is, and so is the original when it is smaller.
+
+    Args:
+        image_bytes (bytes): content of the image
+        mime_type (string): e.g. 'image/png'
+        max_width (int or None): maximum width in pixels. None to keep the width
+        quality (int or None): jpeg quality (1-95). None for EMAIL_IMAGE_QUALITY
+
+    Returns:
+        tuple (image bytes, mime type)
+    """
+    if (max_width is None and quality is None) or mime_type in ('image/svg+xml', 'image/gif'):
+        return image_bytes, mime_type
+    try:
+        from PIL import Image
+    except ImportError:
+        print("Pillow is not installed (pip install pillow), images are attached as is")
+        return image_bytes, mime_type
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        resized = max_width is not None and image.width > max_width
+        if resized:
+            image = image.resize((max_width, max(1, round(image.height * max_width / image.width))), Image.LANCZOS)
+        output = io.BytesIO()
+        if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+            image.save(output, 'PNG', optimize=True)
+            new_mime_type = 'image/png'
+        else:
+            image.convert('RGB').save(output, 'JPEG', quality=quality or EMAIL_IMAGE_QUALITY, optimize=True)
+            new_mime_type = 'image/jpeg'
+
+    if not resized and len(output.getvalue()) >= len(image_bytes):
+        return image_bytes, mime_type
+    return output.getvalue(), new_mime_type
+
+
+def extract_inline_images(html_content, max_width=None, quality=None):
+    """
+    Replace the base64 images of the html (<img src="data:image/...">) by references to attachments
+    (src="cid:..."). The same image used twice is attached once.
+
+    Args:
+        html_content (string): self-contained html
+        max_width, quality: see recompress_image
+
+    Returns:
+        tuple (html, dict {content id: (image bytes, mime type)})
+    """
+    images = {}
+
+    def to_cid(match):
+        image_bytes = base64.b64decode(match.group(4))
+        cid = hashlib.sha256(image_bytes).hexdigest()[:16] + '@ssphub'
+        if cid not in images:
+            images[cid] = recompress_image(image_bytes, match.group(3).lower(), max_width, quality)
+        return f'{match.group(1)}{match.group(2)}cid:{cid}{match.group(2)}'
+
+    return DATA_URI_IMAGE_PATTERN.sub(to_cid, html_content), images
+
 
-def generate_eml_file(email_body, subject, bcc_recipient, to_recipient='EMAIL_SSPHUB', cc_recipient='', from_sender=None):
+def encode_email_body(email_body, cid_images=False, max_width=None, quality=None):
     """
-    Creates an .eml file and saves it to .temp/email.eml
+    MIME body of the draft email: html part in a multipart, serialized to bytes. It can be reused
+    for several .eml files, only their headers differ (see write_eml_files)
+
+    Args:
+        email_body (string): html body of the email
+        cid_images (boolean): True to take the base64 images out of the html and attach them
+        by Content-ID (multipart/related), which makes the email lighter
+        max_width, quality: with cid_images, downscaling and recompression of the images, see recompress_image
+
+    Returns:
+        (bytes) Content-Type and MIME-Version headers followed by the encoded parts
+    """
+    if not cid_images:
+        msg = MIMEMultipart()
+        msg.attach(MIMEText(email_body, 'html'))
+        return msg.as_bytes()
+
+    html_content, images = extract_inline_images(email_body, max_width, quality)
+    msg = MIMEMultipart('related')
+    msg.attach(MIMEText(html_content, 'html'))
+    for cid, (image_bytes, mime_type) in images.items():
+        image_part = MIMEImage(image_bytes, _subtype=mime_type.split('/')[1])
+        image_part.add_header('Content-ID', f'<{cid}>')
+        image_part.add_header('Content-Disposition', 'inline', filename=cid.split('@')[0] + (mimetypes.guess_extension(mime_type) or ''))
+        msg.attach(image_part)
+    return msg.as_bytes()
+
+
+def encode_email_headers(subject, bcc_recipient, to_recipient='EMAIL_SSPHUB', cc_recipient='', from_sender=None):
+    """
+    Addressing headers of the draft email, serialized to bytes. See generate_eml_file for the arguments
+
+    Returns:
+        (bytes) headers, without the blank line separating them from the body
+    """
+    headers = [('Subject', subject), ('BCC', bcc_recipient), ('CC', cc_recipient),
+               ('To', to_recipient)]  # Auto send the email
+    if from_sender is not None:
+        headers.append(('From', from_sender))  # Set the sender's email address
+    headers.append(('X-Unsent', '1'))  # Mark the email as unsent : when the file is opened, it can be sent.
+    # Each header folded and encoded as Message.as_bytes would, with the same policy as the body (see encode_email_body)
+    return b''.join(policy.compat32.fold_binary(name, value) for name, value in headers)
+
+
+def split_recipients(recipients, shard_size):
+    """
+    Split a list of email adresses separated by ; into strings of at most shard_size adresses
+
+    Example:
+        >>> split_recipients('<a@b.fr>; <c@d.fr>; <e@f.fr>', 2)
+        ['<a@b.fr>; <c@d.fr>', '<e@f.fr>']
+    """
+    emails = [email.strip() for email in recipients.split(';') if email.strip()]
+    return ['; '.join(shard) for shard in chunk_list(emails, shard_size)] or ['']
+
+
+def write_eml_files(body_bytes, subject, bcc_recipient, to_recipient='EMAIL_SSPHUB', cc_recipient='', from_sender=None,
+                    eml_file_path='.temp/email.eml', shard_size=None, batches=None):
+    """
+    Write the .eml files of a draft email whose body was encoded with encode_email_body. With a shard_size,
+    the bcc recipients are split into several files .temp/email_001.eml, .temp/email_002.eml... of at most
+    shard_size recipients each, to, cc and body being the same in all of them.
+    Each file is written before the next one is built.
+
+    Args:
+        body_bytes (bytes): body of the email, see encode_email_body
+        shard_size (int or None): maximum number of bcc recipients per file. None for a single file
+        batches (list or None): RecipientBatch of plan_recipient_batches, one file per batch with its emails
+        in bcc (bcc_recipient and shard_size are then ignored)
+        other args: see generate_eml_file
+
+    Yields:
+        (string) path of each .eml file, once written
+    """
+    # Create the output directory if it doesn't exist
+    os.makedirs(os.path.dirname(eml_file_path) or '.', exist_ok=True)
+
+    root, ext = os.path.splitext(eml_file_path)
+    if batches is not None:
+        shards = ((f'{root}_{batch.number:03d}{ext}', batch.bcc) for batch in batches)
+    elif shard_size is None:
+        shards = [(eml_file_path, bcc_recipient)]
+    else:
+        shards = ((f'{root}_{i:03d}{ext}', bcc) for i, bcc in enumerate(split_recipients(bcc_recipient, shard_size), start=1))
+
+    for shard_path, shard_bcc in shards:
+        with open(shard_path, 'wb') as f:
+            f.write(encode_email_headers(subject, shard_bcc, to_recipient, cc_recipient, from_sender))
+            f.write(body_bytes)
+        count_metric('files_written')
+        print(f"Email saved as {shard_path}")
+        yield shard_path
+
+
+def generate_eml_file(email_body, subject, bcc_recipient, to_recipient='EMAIL_SSPHUB', cc_recipient='', from_sender=None,
+                      eml_file_path='.temp/email.eml'):
+    """
+    Creates an .eml file and saves it to eml_file_path. To split the bcc recipients
+    over several files, see generate_sharded_eml_files
 
     Args:
         email_body (string): html body of the email
@@ -34,45 +494,322 @@ def generate_eml_file(email_body, subject, bcc_recipient, to_recipient='EMAIL_SS
         The email will be sent to himself
         cc_recipient (string): list of recipients of the emails to be put in cc
         from_sender(string or None): email adresses to send from. If None, default Outlook
+        eml_file_path (string): where to save the email
 
     Returns:
-        None
-    Nb : create the email to .temp/email.eml with a message
+        (string) path of the .eml file written, eml_file_path
 
     Example:
         >>> generate_eml_file('body', 'this an email', 'test@test.fr')
     Email saved as .temp/email.eml
     """
-    msg = MIMEMultipart()
-    msg['Subject'] = subject
-    msg['BCC'] = bcc_recipient
-    msg['CC'] = cc_recipient
-    msg['To'] = to_recipient   # Auto send the email
-    if from_sender is not None:
-        msg['From'] = from_sender  # Set the sender's email address
-    msg['X-Unsent'] = '1'  # Mark the email as unsent : when the file is opened, it can be sent.
+    return next(write_eml_files(encode_email_body(email_body), subject, bcc_recipient, to_recipient,
+                                cc_recipient, from_sender, eml_file_path))
+
 
-    # Attach the HTML body
-    msg.attach(MIMEText(email_body, 'html'))
+def generate_sharded_eml_files(email_body, subject, bcc_recipient, shard_size=500, to_recipient='EMAIL_SSPHUB', cc_recipient='',
+                               from_sender=None, eml_file_path='.temp/email.eml'):
+    """
+    Creates several .eml files of at most shard_size bcc recipients each, for mail clients limiting
+    the number of recipients of a message (e.g. Outlook / Exchange). The body is encoded once for all files.
 
-    # Save the email as an .eml file
-    eml_file_path = '.temp/email.eml'
+    Args:
+        shard_size (int): maximum number of bcc recipients per file
+        other args: see generate_eml_file
 
-    # Create the output directory if it doesn't exist
-    os.makedirs('.temp', exist_ok=True)
+    Returns:
+        list of the paths of the .eml files
+
+    Example:
+        >>> generate_sharded_eml_files('body', 'this an email', get_emails(), shard_size=500)
+    Email saved as .temp/email_001.eml
+    Email saved as .temp/email_002.eml
+    """
+    return list(write_eml_files(encode_email_body(email_body), subject, bcc_recipient, to_recipient,
+                                cc_recipient, from_sender, eml_file_path, shard_size))
+
+
+def cache_path(cache_dir):
+    """
+    Path of a cache folder: a relative cache_dir is taken inside the environment variable SSPHUB_CACHE_DIR
+    if it is set, CACHE_ROOT otherwise, so that the caches don't depend on the working directory
+
+    Args:
+        cache_dir (string): folder of the cache, e.g. HTTP_CACHE_DIR
+
+    Returns:
+        string
+
+    Example:
+        >>> cache_path(HTTP_CACHE_DIR)
+        '/home/me/ssphub_directory/.cache/http'
+    """
+    return os.path.join(os.environ.get('SSPHUB_CACHE_DIR') or CACHE_ROOT, cache_dir)
+
+
+def http_cache_enabled(use_cache=True):
+    """
+    Tell if the HTTP cache should be used. It can be bypassed for one call with use_cache=False
+    or for every call with the environment variable SSPHUB_NO_HTTP_CACHE=1
+
+    Args:
+        use_cache (boolean): switch given by the caller
+
+    Returns:
+        boolean
+    """
+    return use_cache and os.environ.get('SSPHUB_NO_HTTP_CACHE', '0') in ('', '0')
+
+
+def http_cache_paths(url, headers=None, cache_dir=HTTP_CACHE_DIR):
+    """
+    Paths of the cached body and metadata of an url. Request headers (e.g. Authorization)
+    are part of the key but are never written on disk
+
+    Args:
+        url (string): url of the request
+        headers (dict): headers of the request
+        cache_dir (string): folder of the cache
+
+    Returns:
+        tuple with the body path and the metadata path
+    """
+    cache_dir = cache_path(cache_dir)
+    key = url + json.dumps(sorted((headers or {}).items()))
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, digest + '.body'), os.path.join(cache_dir, digest + '.json')
+
+
+def http_cache_lookup(url, headers=None, cache_dir=HTTP_CACHE_DIR):
+    """
+    Get the metadata of a cached url, None if the url is not cached
 
-    with open(eml_file_path, 'wb') as f:
-        f.write(msg.as_bytes())
+    Args:
+        url (string): url of the request
+        headers (dict): headers of the request
+        cache_dir (string): folder of the cache
+
+    Returns:
+        dict with 'url', 'etag', 'last_modified', 'headers', 'encoding' and 'body_path' keys, or None
+    """
+    body_path, meta_path = http_cache_paths(url, headers, cache_dir)
+    if not (os.path.isfile(body_path) and os.path.isfile(meta_path)):
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    meta['body_path'] = body_path
+    return meta
+
+
+def http_cache_conditional_headers(meta, headers=None):
+    """
+    Add If-None-Match / If-Modified-Since to the request headers from cached metadata
+
+    Args:
+        meta (dict or None): result of http_cache_lookup
+        headers (dict): headers of the request
+
+    Returns:
+        dict of headers
+    """
+    request_headers = dict(headers or {})
+    if meta is not None:
+        if meta.get('etag'):
+            request_headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            request_headers['If-Modified-Since'] = meta['last_modified']
+    return request_headers
+
+
+def http_cache_touch(meta):
+    """
+    Mark a cached entry as recently used, for the LRU eviction
+
+    Args:
+        meta (dict): result of http_cache_lookup
+    """
+    now = time.time()
+    os.utime(meta['body_path'], (now, now))
+
+
+def http_cache_store(url, response, body_path_or_bytes, headers=None, cache_dir=HTTP_CACHE_DIR, max_bytes=HTTP_CACHE_MAX_BYTES):
+    """
+    Store a response in the cache if it can be revalidated (ETag or Last-Modified), then evict
+    least recently used entries to keep the cache under max_bytes
+
+    Args:
+        url (string): url of the request
+        response (requests.Response): the 200 response
+        body_path_or_bytes (bytes or string): body of the response, or path to a file holding it
+        headers (dict): headers of the request
+        cache_dir (string): folder of the cache
+        max_bytes (int): maximum size of the cache
+
+    Returns:
+        None
+    """
+    cache_dir = cache_path(cache_dir)
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return None
+
+    # A body bigger than the whole cache (e.g. the GRIST archive) would only evict everything else
+    if isinstance(body_path_or_bytes, bytes):
+        body_size = len(body_path_or_bytes)
+    else:
+        body_size = os.path.getsize(body_path_or_bytes)
+    if body_size > max_bytes:
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    body_path, meta_path = http_cache_paths(url, headers, cache_dir)
+
+    if isinstance(body_path_or_bytes, bytes):
+        with open(body_path + '.tmp', 'wb') as f:
+            f.write(body_path_or_bytes)
+    else:
+        shutil.copyfile(body_path_or_bytes, body_path + '.tmp')
+    os.replace(body_path + '.tmp', body_path)
+
+    meta = {
+        'url': url,
+        'etag': etag,
+        'last_modified': last_modified,
+        'headers': {key: value for key, value in response.headers.items()
+                    if key.lower() in ('content-type', 'content-disposition', 'etag', 'last-modified')},
+        'encoding': response.encoding
+    }
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+    evict_http_cache(cache_dir, max_bytes)
+
+
+def evict_lru_files(cache_dir, max_bytes, suffix):
+    """
+    Remove least recently used entries of a cache folder until its size is under max_bytes.
+    An entry is a '<key><suffix>' file, whose last use is its modification time; the other
+    files named '<key>.*' are removed with it
+
+    Args:
+        cache_dir (string): folder of the cache
+        max_bytes (int): maximum size of the cache
+        suffix (string): extension of the files holding the cached data, e.g. '.body'
+
+    Returns:
+        list of the keys removed from the cache
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        if file_name.endswith(suffix):
+            stat = os.stat(os.path.join(cache_dir, file_name))
+            entries.append((stat.st_mtime, stat.st_size, file_name[:-len(suffix)]))
+
+    total_size = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, key in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        for file_name in os.listdir(cache_dir):
+            if file_name.startswith(key + '.'):
+                os.remove(os.path.join(cache_dir, file_name))
+        removed.append(key)
+        total_size -= size
+
+    return removed
+
+
+def evict_http_cache(cache_dir=HTTP_CACHE_DIR, max_bytes=HTTP_CACHE_MAX_BYTES):
+    """
+    Remove least recently used entries of the HTTP cache until its size is under max_bytes
+
+    Args:
+        cache_dir (string): folder of the cache
+        max_bytes (int): maximum size of the cache
+
+    Returns:
+        list of the keys removed from the cache
+    """
+    return evict_lru_files(cache_path(cache_dir), max_bytes, '.body')
+
+
+def clear_http_cache(cache_dir=HTTP_CACHE_DIR):
+    """
+    Remove every entry of the HTTP cache
+
+    Example:
+        >>> clear_http_cache()
+        ('/home/me/ssphub_directory/.cache/http',) have been removed
+    """
+    remove_files_dir(cache_path(cache_dir))
 
-    print(f"Email saved as {eml_file_path}")
 
+def cached_get(url, headers=None, session=None, use_cache=True, cache_dir=HTTP_CACHE_DIR, max_bytes=HTTP_CACHE_MAX_BYTES):
+    """
+    GET an url, revalidating the cached copy with ETag / Last-Modified. A 304 answer
+    is served from disk; GitHub doesn't count it in the API rate limit.
+
+    Args:
+        url (string): url to fetch
+        headers (dict): headers of the request
+        session (requests.Session): session to reuse connections from. If None, a single request is made
+        use_cache (boolean): False to bypass the cache
+        cache_dir (string): folder of the cache
+        max_bytes (int): maximum size of the cache
+
+    Returns:
+        requests.Response, with a 200 status code even when served from the cache
+        Raises requests.exceptions.RequestException on HTTP errors
+
+    Example:
+        >>> cached_get('https://api.github.com/repos/InseeFrLab/ssphub/contents/infolettre/infolettre_19?ref=main').json()
+    """
+    http = session if session is not None else requests
 
-def fetch_qmd_file(url):
+    if not http_cache_enabled(use_cache):
+        response = http.get(url, headers=headers)
+        count_metric('http_calls')
+        response.raise_for_status()
+        count_metric('bytes_downloaded', len(response.content))
+        return response
+
+    meta = http_cache_lookup(url, headers, cache_dir)
+    response = http.get(url, headers=http_cache_conditional_headers(meta, headers))
+    count_metric('http_calls')
+
+    if response.status_code == 304 and meta is not None:
+        count_metric('http_cache_hits')
+        http_cache_touch(meta)
+        with open(meta['body_path'], 'rb') as f:
+            body = f.read()
+        cached_response = requests.models.Response()
+        cached_response.status_code = 200
+        cached_response._content = body
+        cached_response.headers = requests.structures.CaseInsensitiveDict(meta['headers'])
+        cached_response.encoding = meta['encoding']
+        cached_response.url = url
+        return cached_response
+
+    response.raise_for_status()
+    count_metric('bytes_downloaded', len(response.content))
+    http_cache_store(url, response, response.content, headers, cache_dir, max_bytes)
+    return response
+
+
+def fetch_qmd_file(url, use_cache=True):
     """
     get the qmf file from an url and return it as string
 
     Args:
         url (string): the qmd url to fetch. Usually a github raw URL
+        use_cache (boolean): revalidate a cached copy instead of downloading it again. False to bypass the cache
 
     Returns:
         (string) the text of the qmd file
@@ -83,8 +820,7 @@ def fetch_qmd_file(url):
     __Septembre 2025__\n\n# Date published\ndate: \'2025-09-29\'\nnumber: 19\n\nauthors:\n ......'
     """
     try:
-        response = requests.get(url)
-        response.raise_for_status()
+        response = cached_get(url, use_cache=use_cache)
         return response.text
     except requests.exceptions.RequestException as e:
         print(f"Error fetching the .qmd file: {e}")
@@ -130,6 +866,7 @@ def process_qmd_file(qmd_content, qmd_output_file, newsletter_url='https://ssphu
     # Save the processed QMD content to a file
     with open(qmd_output_file, 'w', encoding='utf-8') as f:
         f.write(processed_qmd_content)
+    count_metric('files_written')
 
 
 def clean_yaml_header(yaml_header, newsletter_url):
@@ -184,138 +921,680 @@ def clean_yaml_header(yaml_header, newsletter_url):
     return cleaned_yaml_str
 
 
-def knit_to_html(processed_qmd_file):
+def render_with_quarto(processed_qmd_file):
     """
-    knit a qmd file to html
+    Render backend calling the Quarto CLI. Saves the html file with same name as qmd file, same folder
 
     Args:
         processed_qmd_file (string): file path to the qmd file to knit
 
     Returns:
-        None
-    Saves the knitted file with same name as qmd file, same folder
+        (string) path to the html file
     """
-    # Use the Quarto CLI to knit the QMD file to HTML
-    import subprocess
-    try:
-        subprocess.run(['quarto', 'render', processed_qmd_file, '--to', 'html'], check=True)
-        print("QMD file successfully knitted to HTML")
-    except subprocess.CalledProcessError as e:
-        print(f"Error knitting QMD file to HTML: {e}")
+    subprocess.run(['quarto', 'render', processed_qmd_file, '--to', 'html'], check=True)
+    return os.path.splitext(processed_qmd_file)[0] + '.html'
 
 
-def raw_url_newsletter(number, branch='main'):
+def qmd_css_path(yaml_data, base_dir):
     """
-    Function to get url of raw Qmd files of a newsletter on SSPHub repo
+    Path of the css of a processed qmd file: the one of its yaml header, or the one of this repo
+    if it can't be found
 
-    Arg :
-        number: number of the newsletter
-        branch: branch of the repo to look for
+    Args:
+        yaml_data (dict): parsed yaml header
+        base_dir (string): folder of the qmd file
 
     Returns:
-        (string) Url to raw Qmd newsletter
+        (string) path to the css file
     """
-    return f"https://raw.githubusercontent.com/InseeFrLab/ssphub/refs/heads/{branch}/infolettre/infolettre_{number}/index.qmd"
+    css_path = yaml_data.get('format', {}).get('html', {}).get('css')
+    if css_path and os.path.isfile(os.path.join(base_dir, css_path)):
+        return os.path.join(base_dir, css_path)
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'email_style', 'style.css')
 
 
-def published_url_newsletter(number):
-    """
-    Function to generate url of published newsletter on SSPHub website
+# Render backends usable by knit_to_html: {name: function(qmd file path) returning the html file path}
+RENDER_BACKENDS = {
+    'quarto': render_with_quarto
+}
 
-    Arg :
-        number: number of the newsletter
 
-    Returns:
-        url to ssphub website of the given newsletter
-        Output format: a string
+def register_render_backend(name, render_function):
+    """
+    Add a render backend usable by knit_to_html
 
-    Example:
-        >>> published_url_newsletter('19')
-        'https://ssphub.netlify.app/infolettre/infolettre_19/'
+    Args:
+        name (string): name of the backend, to pass as engine
+        render_function (function): takes the path of the processed qmd file, writes the html file
+        next to it and returns its path
     """
-    return f"https://ssphub.netlify.app/infolettre/infolettre_{number}/"
+    RENDER_BACKENDS[name] = render_function
 
 
-def list_raw_image_files(repo_owner, repo_name, subfolder_path, branch='main'):
+def referenced_image_files(qmd_content, base_dir='.'):
     """
-    List image files present in a given github folder. Images are defined by the following formats
-    ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp')
+    Local image files referenced by a qmd file, in the order of their first reference.
+    Remote images and references to missing files are left out
 
-    Arg :
-        repo_owner : name of the owner of the repo in Github
-        repo_name : name of the Github repo
-        subfolder_path : in the given repo architecture, a subfolder path to the folder where you want to list all files.
-    For example : infolettre/infolettre_19/
-        branch where the newsletter is (main by default)
+    Args:
+        qmd_content (string): content of the qmd file
+        base_dir (string): folder the relative paths are taken from
 
     Returns:
-        url to the raw images files
-        Output format: a list of strings
+        list of file paths
 
     Example:
-        >>> list_raw_image_files('InseeFrLab', 'ssphub', 'infolettre/infolettre_19', branch='main')
-        ['https://raw.githubusercontent.com/InseeFrLab/ssphub/refs/heads/main/infolettre/infolettre_19/2025_09_back_school.png',
-        'https://raw.githubusercontent.com/InseeFrLab/ssphub/refs/heads/main/infolettre/infolettre_19/measles-cases-historical-us-states-heatmap.png']
-
+        >>> referenced_image_files('![Un graphique](chart.png) <img src="logo.svg">', '.temp')
+        ['.temp/chart.png', '.temp/logo.svg']
     """
-    # GitHub API URL to list contents of a subfolder
-    url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/contents/{subfolder_path}?ref={branch}"
+    image_files = []
+    for reference in IMAGE_REFERENCE_PATTERN.findall(qmd_content):
+        image_file = os.path.normpath(os.path.join(base_dir, urllib.parse.unquote(reference)))
+        if '://' not in reference and image_file not in image_files and os.path.isfile(image_file):
+            image_files.append(image_file)
+    return image_files
 
-    try:
-        # Send a GET request to the GitHub API
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for HTTP errors
 
-        # Parse the JSON response
-        contents = response.json()
+def render_cache_key(processed_qmd_file, engine):
+    """
+    Hash of everything the rendered html depends on: the processed qmd, its css,
+    the local images it references and the render engine
 
-        # Filter image files (assuming common image extensions)
-        image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp'}
-        image_files = [
-            f'https://raw.githubusercontent.com/{repo_owner}/{repo_name}/refs/heads/{branch}/{item['path']}' for item in contents
-            if item['type'] == 'file' and os.path.splitext(item['name'])[1].lower() in image_extensions
-        ]
+    Args:
+        processed_qmd_file (string): file path to the qmd file to knit
+        engine (string): render backend
 
-        return image_files
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching contents from GitHub API: {e}")
-        return None
+    Returns:
+        (string) sha256 hex digest
+    """
+    base_dir = os.path.dirname(processed_qmd_file) or '.'
+    hasher = hashlib.sha256(engine.encode('utf-8'))
 
+    with open(processed_qmd_file, 'rb') as f:
+        qmd_content = f.read()
+    hasher.update(qmd_content)
 
-def list_image_files_for_newsletter(number, branch='main'):
-    """
-    Wrapper of list_raw_image_files. List image files present in the github folder InseeFrLab, repo ssphub. Ima
+    parts = qmd_content.decode('utf-8').split('---', 2)
+    yaml_data = (yaml.safe_load(parts[1]) if len(parts) == 3 else None) or {}
+    input_files = [qmd_css_path(yaml_data, base_dir)] + referenced_image_files(qmd_content.decode('utf-8'), base_dir)
 
-    Arg :
-        number of the newsletter
-        branch where the newsletter is (main by default)
+    for input_file in input_files:
+        hasher.update(os.path.basename(input_file).encode('utf-8'))
+        with open(input_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(chunk)
 
-    Returns:
-        list of path to the raw images files
+    return hasher.hexdigest()
 
-    Example:
-        >>> list_image_files_for_newsletter('19', branch='main')
-        ['https://raw.githubusercontent.com/InseeFrLab/ssphub/refs/heads/main/infolettre/infolettre_19/2025_09_back_school.png',
-        'https://raw.githubusercontent.com/InseeFrLab/ssphub/refs/heads/main/infolettre/infolettre_19/measles-cases-historical-us-states-heatmap.png']
+
+def clear_render_cache(cache_dir=RENDER_CACHE_DIR):
+    """
+    Remove every html of the render cache
+
+    Example:
+        >>> clear_render_cache()
+        ('/home/me/ssphub_directory/.cache/render',) have been removed
+    """
+    remove_files_dir(cache_path(cache_dir))
+
+
+def invalidate_render_cache(processed_qmd_file, engine='quarto', cache_dir=RENDER_CACHE_DIR):
+    """
+    Remove the cached html of a qmd file, so that the next knit_to_html renders it again
+
+    Args:
+        processed_qmd_file (string): file path to the qmd file
+        engine (string): render backend the html was cached for
+        cache_dir (string): folder of the render cache
+    """
+    cache_dir = cache_path(cache_dir)
+    discard_files(os.path.join(cache_dir, render_cache_key(processed_qmd_file, engine) + '.html'))
+
+
+def knit_to_html(processed_qmd_file, engine='quarto', use_cache=True, cache_dir=RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_MAX_BYTES):
+    """
+    knit a qmd file to html. The html is cached by a hash of the qmd, the css and the images
+    (see render_cache_key): rendering the same newsletter again doesn't run the backend
+
+    Args:
+        processed_qmd_file (string): file path to the qmd file to knit
+        engine (string): render backend, a key of RENDER_BACKENDS (see register_render_backend). 'quarto' by default
+        use_cache (boolean): False to bypass the render cache
+        cache_dir (string): folder of the render cache
+        max_bytes (int): maximum size of the render cache
+
+    Returns:
+        (string) path to the html file, None if the rendering failed
+    Saves the knitted file with same name as qmd file, same folder
+    """
+    cache_dir = cache_path(cache_dir)
+    html_file = os.path.splitext(processed_qmd_file)[0] + '.html'
+
+    if use_cache:
+        cached_html = os.path.join(cache_dir, render_cache_key(processed_qmd_file, engine) + '.html')
+        if os.path.isfile(cached_html):
+            shutil.copyfile(cached_html, html_file)
+            count_metric('render_cache_hits')
+            count_metric('files_written')
+            now = time.time()
+            os.utime(cached_html, (now, now))
+            print("QMD file knitted to HTML from the render cache")
+            return html_file
+
+    if engine not in RENDER_BACKENDS:
+        raise ValueError(f"Unknown render engine {engine!r}, available: {list(RENDER_BACKENDS)}")
+    try:
+        rendered_file = RENDER_BACKENDS[engine](processed_qmd_file)
+    except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
+        print(f"Error knitting QMD file to HTML: {e}")
+        return None
+
+    print("QMD file successfully knitted to HTML")
+    count_metric('files_written')
+
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        shutil.copyfile(rendered_file, cached_html + '.tmp')
+        os.replace(cached_html + '.tmp', cached_html)
+        evict_lru_files(cache_dir, max_bytes, '.html')
+
+    return rendered_file
+
+
+def get_github_api():
+    """
+    Url of the GitHub API, from the SSPHUB_GITHUB_API environment variable or GITHUB_API by default
+
+    Example:
+        >>> get_github_api()
+        'https://api.github.com'
+    """
+    return os.environ.get('SSPHUB_GITHUB_API', GITHUB_API).rstrip('/')
+
+
+def get_github_raw():
+    """
+    Url of the GitHub raw files, from the SSPHUB_GITHUB_RAW environment variable or GITHUB_RAW by default
+
+    Example:
+        >>> get_github_raw()
+        'https://raw.githubusercontent.com'
+    """
+    return os.environ.get('SSPHUB_GITHUB_RAW', GITHUB_RAW).rstrip('/')
+
+
+def raw_ref(branch='main', commit_sha=None):
+    """
+    Part of a raw GitHub url naming the revision of the file: the commit SHA when it is known,
+    so that all the files come from the same commit, the head of the branch otherwise
+
+    Example:
+        >>> raw_ref('main')
+        'refs/heads/main'
+    """
+    return commit_sha or f"refs/heads/{branch}"
+
+
+def raw_url_newsletter(number, branch='main', commit_sha=None):
+    """
+    Function to get url of raw Qmd files of a newsletter on SSPHub repo
+
+    Arg :
+        number: number of the newsletter
+        branch: branch of the repo to look for
+        commit_sha: commit of the branch to take the file from (see resolve_github_commit). Head of the branch if None
+
+    Returns:
+        (string) Url to raw Qmd newsletter
+    """
+    return f"{get_github_raw()}/InseeFrLab/ssphub/{raw_ref(branch, commit_sha)}/infolettre/infolettre_{number}/index.qmd"
+
+
+def published_url_newsletter(number):
+    """
+    Function to generate url of published newsletter on SSPHub website
+
+    Arg :
+        number: number of the newsletter
+
+    Returns:
+        url to ssphub website of the given newsletter
+        Output format: a string
+
+    Example:
+        >>> published_url_newsletter('19')
+        'https://ssphub.netlify.app/infolettre/infolettre_19/'
+    """
+    return f"https://ssphub.netlify.app/infolettre/infolettre_{number}/"
+
+
+# Commit SHAs of the branches {(owner, repo, branch): (time of resolution, sha)}
+# and git trees {(owner, repo, commit sha, folder): list of entries}, kept in memory
+_github_commits = {}
+_github_trees = {}
+_github_lock = threading.Lock()
+
+
+def git_blob_sha(file_path):
+    """
+    SHA of a local file as git computes it for a blob, to compare it with the 'sha' of a git tree entry
+
+    Example:
+        >>> git_blob_sha('.temp/2025_09_back_school.png')
+        'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'
+    """
+    hasher = hashlib.sha1(b'blob %d\0' % os.path.getsize(file_path))
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def resolve_github_commit(repo_owner, repo_name, branch='main', ttl=GITHUB_BRANCH_TTL):
+    """
+    Commit SHA of the head of a branch. It is kept in memory for ttl seconds, and revalidated
+    with the HTTP cache afterwards (304 answers don't count in the GitHub rate limit)
+
+    Returns:
+        (string) commit SHA
+    """
+    key = (repo_owner, repo_name, branch)
+    with _github_lock:
+        resolved = _github_commits.get(key)
+    if resolved is not None and time.monotonic() - resolved[0] < ttl:
+        return resolved[1]
+
+    response = cached_get(f"{get_github_api()}/repos/{repo_owner}/{repo_name}/commits/{branch}",
+                          headers={'Accept': 'application/vnd.github.sha'})
+    commit_sha = response.text.strip()
+    with _github_lock:
+        _github_commits[key] = (time.monotonic(), commit_sha)
+    return commit_sha
+
+
+def fetch_github_tree(repo_owner, repo_name, folder, commit_sha, cache_dir=GITHUB_TREE_CACHE_DIR):
+    """
+    Every file and folder under folder at a commit, with one recursive Git Trees API call.
+    The tree is cached in memory and on disk by commit SHA
+
+    Args:
+        repo_owner (string): owner of the repo in Github
+        repo_name (string): name of the Github repo
+        folder (string): folder of the repo, e.g. 'infolettre'
+        commit_sha (string): commit SHA, see resolve_github_commit
+        cache_dir (string): folder of the cached trees
+
+    Returns:
+        list of dicts with keys 'path' (from the root of the repo), 'type' ('blob' or 'tree'), 'sha' and 'size' (None for folders)
+    """
+    cache_dir = cache_path(cache_dir)
+    folder = folder.strip('/')
+    key = (repo_owner, repo_name, commit_sha, folder)
+    with _github_lock:
+        if key in _github_trees:
+            return _github_trees[key]
+
+    tree_path = os.path.join(cache_dir, hashlib.sha256('/'.join(key).encode('utf-8')).hexdigest()[:32] + '.json')
+    if os.path.isfile(tree_path):
+        with open(tree_path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+    else:
+        response = cached_get(f"{get_github_api()}/repos/{repo_owner}/{repo_name}/git/trees/"
+                              f"{commit_sha}:{urllib.parse.quote(folder)}?recursive=1", use_cache=False)
+        tree = response.json()
+        if tree.get('truncated'):
+            print(f"Git tree of {folder} truncated by GitHub, some files are missing")
+        entries = [{'path': f"{folder}/{item['path']}", 'type': item['type'], 'sha': item['sha'], 'size': item.get('size')}
+                   for item in tree['tree']]
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tree_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(tree_path + '.tmp', tree_path)
+
+    with _github_lock:
+        _github_trees[key] = entries
+    return entries
+
+
+def list_tree_image_files(repo_owner, repo_name, subfolder_path, branch='main', tree_folder=None, commit_sha=None):
+    """
+    List image files present in a given github folder, from the git tree of tree_folder fetched
+    once for all the folders it contains (see fetch_github_tree)
+
+    Arg :
+        repo_owner : name of the owner of the repo in Github
+        repo_name : name of the Github repo
+        subfolder_path : folder where you want to list the images. For example : infolettre/infolettre_19/
+        branch where the newsletter is (main by default)
+        tree_folder : folder whose tree is fetched. Default is the first folder of subfolder_path, e.g. 'infolettre'
+        commit_sha : commit of the branch to list, see resolve_github_commit. Head of the branch if None
+
+    Returns:
+        list of dicts with keys 'url' (raw url of the image at the listed commit), 'path', 'sha' (git blob SHA,
+        see git_blob_sha) and 'size'. None if GitHub couldn't be reached
+
+    Example:
+        >>> list_tree_image_files('InseeFrLab', 'ssphub', 'infolettre/infolettre_19')
+        [{'url': 'https://raw.githubusercontent.com/InseeFrLab/ssphub/5d0a8c1e.../infolettre/infolettre_19/2025_09_back_school.png',
+          'path': 'infolettre/infolettre_19/2025_09_back_school.png', 'sha': '3b18e512dba79e4c8300dd08aeb37f8e728b8dad', 'size': 245017}, ...]
+    """
+    subfolder_path = subfolder_path.strip('/')
+    tree_folder = (tree_folder or subfolder_path.split('/')[0]).strip('/')
+
+    try:
+        commit_sha = commit_sha or resolve_github_commit(repo_owner, repo_name, branch)
+        entries = fetch_github_tree(repo_owner, repo_name, tree_folder, commit_sha)
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching git tree from GitHub API: {e}")
+        return None
+
+    # The raw urls name the commit that was listed, not the branch that may have moved since
+    return [
+        {'url': f"{get_github_raw()}/{repo_owner}/{repo_name}/{commit_sha}/{entry['path']}", **entry}
+        for entry in entries
+        if entry['type'] == 'blob' and os.path.dirname(entry['path']) == subfolder_path
+        and os.path.splitext(entry['path'])[1].lower() in IMAGE_EXTENSIONS
+    ]
+
+
+def clear_github_trees(cache_dir=GITHUB_TREE_CACHE_DIR):
+    """
+    Forget the commit SHAs of the branches and the git trees, in memory and on disk
+    """
+    with _github_lock:
+        _github_commits.clear()
+        _github_trees.clear()
+    remove_files_dir(cache_path(cache_dir))
+
+
+def list_raw_image_files(repo_owner, repo_name, subfolder_path, branch='main', use_cache=True, listing='tree', commit_sha=None):
+    """
+    List image files present in a given github folder. Images are defined by the following formats
+    ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp')
+
+    Arg :
+        repo_owner : name of the owner of the repo in Github
+        repo_name : name of the Github repo
+        subfolder_path : in the given repo architecture, a subfolder path to the folder where you want to list all files.
+    For example : infolettre/infolettre_19/
+        branch where the newsletter is (main by default)
+        use_cache : revalidate a cached listing instead of using the API rate limit. False to bypass the cache
+        listing : 'tree' (default) to answer from the git tree of the first folder of subfolder_path, fetched
+        once for all its subfolders (see list_tree_image_files), 'contents' for one contents API call per folder
+        commit_sha : commit of the branch to list, see resolve_github_commit. Head of the branch if None
+
+    Returns:
+        url to the raw images files
+        Output format: a list of strings
+
+    Example:
+        >>> list_raw_image_files('InseeFrLab', 'ssphub', 'infolettre/infolettre_19', branch='main')
+        ['https://raw.githubusercontent.com/InseeFrLab/ssphub/5d0a8c1e.../infolettre/infolettre_19/2025_09_back_school.png',
+        'https://raw.githubusercontent.com/InseeFrLab/ssphub/5d0a8c1e.../infolettre/infolettre_19/measles-cases-historical-us-states-heatmap.png']
+
+    """
+    if listing == 'tree':
+        images = list_tree_image_files(repo_owner, repo_name, subfolder_path, branch, commit_sha=commit_sha)
+        return None if images is None else [image['url'] for image in images]
+
+    # GitHub API URL to list contents of a subfolder
+    url = f"{get_github_api()}/repos/{repo_owner}/{repo_name}/contents/{subfolder_path}?ref={commit_sha or branch}"
+
+    try:
+        # Send a GET request to the GitHub API, 304 answers are served from the cache
+        response = cached_get(url, use_cache=use_cache)
+
+        # Parse the JSON response
+        contents = response.json()
+
+        # Filter image files (assuming common image extensions)
+        image_files = [
+            f'{get_github_raw()}/{repo_owner}/{repo_name}/{raw_ref(branch, commit_sha)}/{item['path']}' for item in contents
+            if item['type'] == 'file' and os.path.splitext(item['name'])[1].lower() in IMAGE_EXTENSIONS
+        ]
+
+        return image_files
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching contents from GitHub API: {e}")
+        return None
+
+
+def list_image_files_for_newsletter(number, branch='main', listing='tree', commit_sha=None):
+    """
+    Wrapper of list_raw_image_files. List image files present in the github folder InseeFrLab, repo ssphub. Ima
+
+    Arg :
+        number of the newsletter
+        branch where the newsletter is (main by default)
+        listing : 'tree' or 'contents', see list_raw_image_files. 'tree' lists the images of every
+        newsletter with a single GitHub call
+        commit_sha : commit of the branch to list, see resolve_github_commit. Head of the branch if None
+
+    Returns:
+        list of path to the raw images files
+
+    Example:
+        >>> list_image_files_for_newsletter('19', branch='main')
+        ['https://raw.githubusercontent.com/InseeFrLab/ssphub/5d0a8c1e.../infolettre/infolettre_19/2025_09_back_school.png',
+        'https://raw.githubusercontent.com/InseeFrLab/ssphub/5d0a8c1e.../infolettre/infolettre_19/measles-cases-historical-us-states-heatmap.png']
 
     """
     repo_owner = 'InseeFrLab'
     repo_name = 'ssphub'
     subfolder_path = f'infolettre/infolettre_{number}'
 
-    return list_raw_image_files(repo_owner, repo_name, subfolder_path, branch)
+    return list_raw_image_files(repo_owner, repo_name, subfolder_path, branch, listing=listing, commit_sha=commit_sha)
+
+
+def get_http_session(pool_size=10):
+    """
+    Create a requests session whose connection pool can be shared between threads
+
+    Args:
+        pool_size (int): maximum number of connections kept open per host
+
+    Returns:
+        A requests.Session object
+
+    Example:
+        >>> session = get_http_session(pool_size=8)
+        >>> download_file('https://raw.githubusercontent.com/InseeFrLab/ssphub/refs/heads/main/infolettre/infolettre_19/2025_09_back_school.png', session=session)
+        File downloaded to .temp/2025_09_back_school.png
+        '2025_09_back_school.png'
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def file_name_from_headers(file_url, response_headers):
+    """
+    Extract the file name from the Content-Disposition header or, if not, from file_url
+
+    Args:
+        file_url (string): url of the downloaded file
+        response_headers (dict): headers of the response
+
+    Returns:
+        file_name (string)
+
+    Example:
+        >>> file_name_from_headers('https://grist.numerique.gouv.fr/api/docs/ID/attachments/archive',
+        {'Content-Disposition': 'attachment; filename="Fusion site SSPHub-Attachments.zip"'})
+        'Fusion_site_SSPHub-Attachments.zip'
+    """
+    response_headers = requests.structures.CaseInsensitiveDict(response_headers)
+    if 'Content-Disposition' in response_headers:
+        return response_headers['Content-Disposition'].split('filename=')[-1].strip('"').replace(' ', '_')
+    return os.path.basename(file_url)
+
 
+def discard_files(*file_paths):
+    """
+    Silently remove temporary files, if they exist
+
+    Args:
+        file_paths (string): paths of the files to remove
+    """
+    for file_path in file_paths:
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
+
+def stream_download(file_url,
+    output_dir='.temp',
+    headers=None,
+    session=None,
+    use_cache=True,
+    expected_checksum=None,
+    hash_algorithm='sha256',
+    chunk_size=1024 * 1024,
+    raise_errors=False):
+    """
+    Stream a file to disk chunk by chunk, so that memory use doesn't depend on the file size.
+    The file is written to a hidden .part file and renamed once complete. An interrupted download
+    is resumed with a Range request on the next call (guarded by If-Range, so a file changed on the
+    server is downloaded again from zero). A checksum is computed while streaming.
+
+    Args:
+        file_url (string): url of the file to download
+        output_dir (string): directory where to save the file to
+        headers (dict): headers of the request (None by default)
+        session (requests.Session): session to reuse connections from. If None, a single request is made
+        use_cache (boolean): revalidate a cached copy instead of downloading it again. False to bypass the cache
+        expected_checksum (string or None): hex digest the file must have. The file is discarded if it doesn't match
+        hash_algorithm (string): algorithm of the checksum, any name accepted by hashlib.new
+        chunk_size (int): size in bytes of the chunks written to disk
+        raise_errors (boolean): raise the error of a failed download (RequestException, or ValueError for
+        a checksum mismatch) instead of printing it and returning (None, None)
+
+    Returns:
+        tuple with the name of the downloaded file and its hex digest, (None, None) if the download failed
+
+    Example:
+        >>> stream_download(*get_grist_attachments_config())
+        File downloaded to .temp/Fusion_site_SSPHub-Attachments.zip
+        ('Fusion_site_SSPHub-Attachments.zip', '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08')
+    """
+    http = session if session is not None else requests
+    os.makedirs(output_dir, exist_ok=True)
+
+    # The temporary file depends on the url only, so that a new call finds it back
+    url_digest = hashlib.sha256(file_url.encode('utf-8')).hexdigest()[:16]
+    part_path = os.path.join(output_dir, f'.{url_digest}.part')
+    validator_path = part_path + '.validator'
+
+    request_headers = dict(headers or {})
+    meta = None
+    resume_from = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if resume_from and os.path.isfile(validator_path):
+        with open(validator_path, 'r', encoding='utf-8') as f:
+            request_headers['If-Range'] = f.read()
+        request_headers['Range'] = f'bytes={resume_from}-'
+    else:
+        resume_from = 0
+        if http_cache_enabled(use_cache):
+            meta = http_cache_lookup(file_url, headers)
+            request_headers = http_cache_conditional_headers(meta, request_headers)
+
+    hasher = hashlib.new(hash_algorithm)
 
-def download_file(file_url, output_dir='.temp', headers=None):
+    try:
+        with http.get(file_url, headers=request_headers, stream=True) as response:
+            count_metric('http_calls')
+            if response.status_code == 416:
+                # The partial file doesn't match the remote file anymore: start again from zero
+                discard_files(part_path, validator_path)
+                return stream_download(file_url, output_dir, headers, session, use_cache,
+                                       expected_checksum, hash_algorithm, chunk_size, raise_errors)
+            if response.status_code == 304 and meta is not None:
+                # Not modified: copy the cached body
+                count_metric('http_cache_hits')
+                http_cache_touch(meta)
+                response_headers = meta['headers']
+                cached_file = open(meta['body_path'], 'rb')
+                chunks = iter(lambda: cached_file.read(chunk_size), b'')
+                mode = 'wb'
+            else:
+                response.raise_for_status()
+                response_headers = response.headers
+                cached_file = None
+                chunks = response.iter_content(chunk_size=chunk_size)
+                if response.status_code == 206:
+                    # Resuming: the checksum starts with the bytes already on disk
+                    mode = 'ab'
+                    with open(part_path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(chunk_size), b''):
+                            hasher.update(chunk)
+                else:
+                    mode = 'wb'
+                    # Remember a strong validator to be able to resume this download safely
+                    etag = response.headers.get('ETag')
+                    validator = etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified')
+                    if validator:
+                        with open(validator_path, 'w', encoding='utf-8') as f:
+                            f.write(validator)
+                    else:
+                        discard_files(validator_path)
+
+            downloaded = 0
+            try:
+                with open(part_path, mode) as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        downloaded += len(chunk)
+            finally:
+                if cached_file is not None:
+                    cached_file.close()
+                else:
+                    count_metric('bytes_downloaded', downloaded)
+
+    except requests.exceptions.RequestException as e:
+        if raise_errors:
+            raise
+        print(f"Error downloading file: {e}")
+        return None, None
+
+    digest = hasher.hexdigest()
+    if expected_checksum is not None and digest != expected_checksum.lower():
+        discard_files(part_path, validator_path)
+        message = f"Checksum mismatch for {file_url}: expected {expected_checksum}, got {digest}"
+        if raise_errors:
+            raise ValueError(message)
+        print(message)
+        return None, None
+
+    file_name = file_name_from_headers(file_url, response_headers)
+    output_path = os.path.join(output_dir, file_name)
+    os.replace(part_path, output_path)
+    discard_files(validator_path)
+    count_metric('files_written')
+
+    if response.status_code != 304 and http_cache_enabled(use_cache):
+        http_cache_store(file_url, response, output_path, headers)
+
+    print(f"File downloaded to {output_path}")
+    return file_name, digest
+
+
+def download_file(file_url, output_dir='.temp', headers=None, session=None, use_cache=True, expected_checksum=None):
     """
-    Downloads a file from given url and store it in output_dir
+    Downloads a file from given url and store it in output_dir. The file is streamed to disk
+    and an interrupted download is resumed on the next call (see stream_download)
 
     Arg:
         file_url: url of the file to download, as a string
         output_dir: directory where to save the file to, as a string
+        headers: headers of the request, as a dict (None by default)
+        session: requests.Session to reuse connections from. If None, a single request is made
+        use_cache: revalidate a cached copy instead of downloading it again. False to bypass the cache
+        expected_checksum: sha256 hex digest the file must have, None to skip the check
 
     Returns:
-        file_name (str): name of the downloaded file
+        file_name (str): name of the downloaded file, None if the download failed
         print if download was successfull
 
     Example:
@@ -323,32 +1602,59 @@ def download_file(file_url, output_dir='.temp', headers=None):
         File downloaded to .temp/2025_09_back_school.png
         '2025_09_back_school.png'
         """
+    file_name, digest = stream_download(file_url, output_dir, headers=headers, session=session,
+                                        use_cache=use_cache, expected_checksum=expected_checksum)
+    return file_name
 
-    try:
-        # Send a GET request to the GitHub API
-        response = requests.get(file_url, headers=headers)
-        response.raise_for_status()  # Raise an exception for HTTP errors
 
-        # Create the output directory if it doesn't exist
-        os.makedirs(output_dir, exist_ok=True)
+def download_files_concurrently(file_urls, output_dir='.temp', headers=None, max_workers=8):
+    """
+    Download several files at once with a bounded pool of threads sharing one HTTP session.
+    A failing file doesn't stop the other downloads.
 
-        # Extract the file name from the response or, if not, from file_url
-        if 'Content-Disposition' in response.headers:
-            file_name = response.headers['Content-Disposition'].split('filename=')[-1].strip('"').replace(' ', '_')
-        else:
-            file_name = os.path.basename(file_url)
+    Args:
+        file_urls (list): urls of the files to download
+        output_dir (string): directory where to save the files to
+        headers (dict): headers of the requests (None by default)
+        max_workers (int): maximum number of simultaneous downloads
+
+    Returns:
+        tuple with the list of downloaded file names (same order as file_urls)
+        and a dict {file_url: error message} of the failed downloads
 
-        # Save the file to the output directory
-        output_path = os.path.join(output_dir, file_name)
-        with open(output_path, 'wb') as f:
-            f.write(response.content)
+    Example:
+        >>> download_files_concurrently(list_image_files_for_newsletter(19))
+        File downloaded to .temp/2025_09_back_school.png
+        File downloaded to .temp/measles-cases-historical-us-states-heatmap.png
+        (['2025_09_back_school.png', 'measles-cases-historical-us-states-heatmap.png'], {})
+    """
+    downloaded_files = []
+    failures = {}
 
-        print(f"File downloaded to {output_path}")
+    if not file_urls:
+        return downloaded_files, failures
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error downloading file: {e}")
+    session = get_http_session(pool_size=max_workers)
 
-    return file_name
+    def download_one(file_url):
+        # Errors are caught here so that one image cannot abort the others, and kept to be reported
+        try:
+            file_name, digest = stream_download(file_url, output_dir, headers=headers, session=session, raise_errors=True)
+            return file_name, None
+        except Exception as e:
+            return None, str(e)
+
+    with session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(download_one, file_urls))
+
+    for file_url, (file_name, error) in zip(file_urls, results):
+        if file_name:
+            downloaded_files.append(file_name)
+        else:
+            failures[file_url] = error
+            print(f"Failed to download {file_url}: {error}")
+
+    return downloaded_files, failures
 
 
 def unzip_dir(zip_file_path, extraction_dir):
@@ -382,234 +1688,1264 @@ def unzip_dir(zip_file_path, extraction_dir):
         # Extract all the contents into the specified directory
         zip_ref.extractall(extraction_dir)
 
-    print(f"Files extracted to {extraction_dir}")
+    print(f"Files extracted to {extraction_dir}")
+
+
+def download_images_for_newsletter(number, branch='main', output_dir='.temp', max_workers=8, return_failures=False):
+    """
+    Download all image files from given newsletter number and branch and store it in output_dir
+
+    Arg:
+        number: number of the newsletter whose images will be downloaded, as a string
+        branch: repo branch of the newsletter (main for published newsletter, other for non published newsletters)
+        output_dir: directory where to save the files to, as a string
+        max_workers: number of images downloaded at the same time. 1 to download them one by one
+        return_failures: True to also get the failed downloads
+
+    Returns:
+        list of the downloaded file names
+        nb : a message is printed for each successful or failed download
+        With return_failures, a tuple with this list and a dict {file_url: error message} of the failed downloads
+
+    Example:
+        >>> download_images_for_newsletter(19)
+        File downloaded to .temp/2025_09_back_school.png
+        Failed to download https://raw.githubusercontent.com/.../missing.png: 404 Client Error: Not Found for url: ...
+        ['2025_09_back_school.png']
+    """
+    # Get the list of image files in the subfolder
+    image_files = list_image_files_for_newsletter(number, branch, listing='tree')
+
+    if not image_files:
+        print("No image files found in the subfolder.")
+
+    # Download the image files, several at a time
+    downloaded_files, failures = download_files_concurrently(image_files, output_dir, max_workers=max_workers)
+
+    if return_failures:
+        return downloaded_files, failures
+    return downloaded_files
+
+
+def run_coroutine(coroutine):
+    """
+    Run a coroutine to completion from synchronous code, also when an event loop is already
+    running in this thread (e.g. in a notebook), in which case it runs in another thread
+
+    Returns:
+        the result of the coroutine
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+async def render_newsletter_async(number, branch, temp_dir='.temp', engine='quarto', max_concurrency=8):
+    """
+    Same as render_newsletter, with the network stages overlapping: the qmd file is fetched and processed
+    while the images are listed and downloaded (at most max_concurrency images at a time, see
+    download_files_concurrently). The newsletter is knitted as soon as both are done. Both are
+    taken from the commit at the head of the branch when the rendering starts.
+
+    Arg:
+        number (string): number of the newsletter
+        branch (string): repo branch of the newsletter
+        temp_dir (string): folder of the images, temp.qmd and temp.html
+        engine (string): render backend, see knit_to_html
+        max_concurrency (int): maximum number of simultaneous image downloads
+
+    Returns:
+        (string) path to the html file, None if the rendering failed (e.g. missing images)
+    """
+    temp_file_qmd = os.path.join(temp_dir, 'temp.qmd')
+    os.makedirs(temp_dir, exist_ok=True)
+
+    # The images and the qmd file are taken from the same commit, even if the branch moves meanwhile
+    try:
+        commit_sha = await asyncio.to_thread(resolve_github_commit, 'InseeFrLab', 'ssphub', branch)
+    except requests.exceptions.RequestException as e:
+        raise ValueError(f"The branch {branch} of the newsletter {number} could not be resolved: {e}")
+
+    async def download_images():
+        # requests is blocking: the listing and the pool of downloads run in threads
+        image_files = await asyncio.to_thread(list_image_files_for_newsletter, number, branch,
+                                              listing='tree', commit_sha=commit_sha)
+        if not image_files:
+            print("No image files found in the subfolder.")
+            return {}
+        downloaded_files, failures = await asyncio.to_thread(download_files_concurrently, image_files, temp_dir,
+                                                             max_workers=max_concurrency)
+        return failures
+
+    async def prepare_qmd():
+        qmd_url = raw_url_newsletter(number, branch, commit_sha)
+        qmd_content = await asyncio.to_thread(fetch_qmd_file, qmd_url)
+        if qmd_content is None:
+            raise ValueError(f"The qmd file of the newsletter {number} could not be fetched from {qmd_url}")
+        await asyncio.to_thread(process_qmd_file, qmd_content, temp_file_qmd, published_url_newsletter(number))
+
+    with pipeline_stage('download'):
+        failures, _ = await asyncio.gather(download_images(), prepare_qmd())
+
+    if failures:
+        print(f"{len(failures)} images of the newsletter could not be downloaded, the newsletter is not knitted")
+        return None
+
+    with pipeline_stage('knit'):
+        return await asyncio.to_thread(knit_to_html, temp_file_qmd, engine=engine)
+
+
+def render_newsletter(number, branch, temp_dir='.temp', engine='quarto', max_concurrency=8):
+    """
+    Download the images and the qmd file of a newsletter, and knit it to html in temp_dir.
+    Synchronous wrapper of render_newsletter_async.
+
+    Arg:
+        number (string): number of the newsletter
+        branch (string): repo branch of the newsletter
+        temp_dir (string): folder of the images, temp.qmd and temp.html
+        engine (string): render backend, see knit_to_html
+        max_concurrency (int): maximum number of simultaneous requests
+
+    Returns:
+        (string) path to the html file, None if the rendering failed
+    """
+    return run_coroutine(render_newsletter_async(number, branch, temp_dir, engine, max_concurrency))
+
+
+def generate_emails(number, branch, audiences, drop_temp=True, engine='quarto', cid_images=False, image_max_width=None, image_quality=None):
+    """
+    Generates one draft email per audience for a newsletter, in the folder '.temp/'. The newsletter
+    is downloaded and knitted once for all the audiences.
+
+    Arg:
+        number (string): number of the newsletter to turn into emails
+        branch (string): repo branch of the newsletter (main for published newsletter, other for non published newsletters)
+        audiences (list of dict): one dict per email, with keys
+            'email_object' (string): object of the email
+            'email_to' (string): list of email adresses to send the email to
+            'email_bcc' (string, optional): list of email adresses to be in bcc
+            'email_cc' (string, optional): list of email adresses to be in cc
+            'email_from' (string, optional): sender to see in Outlook. None (default) for default sender
+            'eml_file' (string, optional): where to save the email. Default is .temp/email_<position in the list>.eml
+            'shard_size' (int, optional): maximum number of bcc recipients per .eml file, see generate_sharded_eml_files
+            'batches' (list, optional): one .eml file per batch of get_recipient_batches, instead of email_bcc
+        drop_temp (boolean): if temporary knitted files should be removed after knitting. Default is true
+        engine (string): render backend, see knit_to_html
+        cid_images (boolean): True to attach the images by Content-ID instead of inside the html, see encode_email_body
+        image_max_width (int or None): with cid_images, maximum width of the images, e.g. EMAIL_IMAGE_MAX_WIDTH
+        image_quality (int or None): with cid_images, jpeg quality of the recompressed images, e.g. EMAIL_IMAGE_QUALITY
+
+    Returns:
+        list of the paths of the .eml files (several per audience with a shard_size)
+
+    Example:
+        >>> generate_emails(19, 'main', [
+                {'email_object': 'Pour validation', 'email_to': 'me@insee.fr', 'eml_file': '.temp/validation.eml'},
+                {'email_object': 'Infolettre de rentrée', 'email_to': 'me@insee.fr', 'email_bcc': get_emails()}])
+        Email saved as .temp/validation.eml
+        Email saved as .temp/email_1.eml
+        generate_email: 0.52 s (download 0.40 s, knit 0.10 s, encode_body 0.01 s, write_eml 0.01 s) | ...
+    """
+    temp_file_qmd = './.temp/temp.qmd'
+
+    # Stages and counters are reported at the end, see instrumented_pipeline
+    with instrumented_pipeline('generate_email'):
+        temp_file_html = render_newsletter(number, branch, '.temp', engine=engine)
+        if temp_file_html is None:
+            return []
+
+        with pipeline_stage('encode_body'):
+            with open(temp_file_html, 'r', encoding="utf-8") as f:
+                email_body = f.read()
+            body_bytes = encode_email_body(email_body, cid_images, image_max_width, image_quality)
+            if cid_images:
+                print(f"Email size: {len(encode_email_body(email_body)) / 1e6:.2f} MB with images inside the html, "
+                      f"{len(body_bytes) / 1e6:.2f} MB with attached images")
+
+        eml_files = []
+        with pipeline_stage('write_eml'):
+            for i, audience in enumerate(audiences):
+                eml_files.extend(write_eml_files(body_bytes,
+                                                 audience['email_object'],
+                                                 audience.get('email_bcc', ''),
+                                                 to_recipient=audience['email_to'],
+                                                 cc_recipient=audience.get('email_cc', ''),
+                                                 from_sender=audience.get('email_from'),
+                                                 eml_file_path=audience.get('eml_file', f'.temp/email_{i}.eml'),
+                                                 shard_size=audience.get('shard_size'),
+                                                 batches=audience.get('batches')))
+
+        if drop_temp:
+            remove_files_dir(temp_file_qmd, temp_file_html)
+
+    return eml_files
+
+
+def generate_email(number,
+    branch,
+    email_object,
+    email_to,
+    email_bcc,
+    email_from='SELECT THE RIGHT EMAIL',
+    email_cc='',
+    drop_temp=True,
+    engine='quarto',
+    shard_size=None,
+    cid_images=False,
+    image_max_width=None,
+    image_quality=None):
+    """
+    Generates the draft email for a newsletter in the folder '.temp/'. Built on generate_emails.
+
+    Arg:
+        number (string): number of the newsletter to turn into email
+        branch (string): repo branch of the newsletter to turn into email (main for published newsletter, other for non published newsletters)
+        email_object (string): object of the email
+        email_to (string) : list of email adresses to send the email to
+        email_bcc (string) : list of email adresses to be in bcc
+        email_from(string) : sender to see in Outlook. None for default sender
+        email_cc (string) : list of email adresses to be in cc
+        drop_temp (boolean): if temporary knitted files should be removed after knitting. Default is true
+        engine (string): render backend, see knit_to_html
+        shard_size (int or None): maximum number of bcc recipients per .eml file, see generate_sharded_eml_files
+        cid_images, image_max_width, image_quality: images attached by Content-ID and recompressed, see generate_emails
+
+    Returns:
+        None
+
+    Example:
+        >>> generate_email(19, 'main', 'Infolettre de rentrée', 'my_to_email@insee.fr', get_emails())
+        Email saved as .temp/email.eml
+    """
+    generate_emails(number, branch,
+                    [{'email_object': email_object, 'email_to': email_to, 'email_bcc': email_bcc,
+                      'email_cc': email_cc, 'email_from': email_from, 'eml_file': '.temp/email.eml',
+                      'shard_size': shard_size}],
+                    drop_temp=drop_temp, engine=engine,
+                    cid_images=cid_images, image_max_width=image_max_width, image_quality=image_quality)
+
+
+# Placeholder meaning 'every table' for PooledGristDocAPI.invalidate
+GRIST_ALL_TABLES = ('*',)
+
+
+# One shared client per (server, document)
+_grist_clients = {}
+_grist_clients_lock = threading.Lock()
+
+
+def get_grist_server():
+    """
+    Url of the GRIST server, from the GRIST_SERVER environment variable or GRIST_SERVER by default
+
+    Example:
+        >>> get_grist_server()
+        'https://grist.numerique.gouv.fr'
+    """
+    return os.environ.get('GRIST_SERVER', GRIST_SERVER).rstrip('/')
+
+
+def get_grist_client(doc_id, server=None, ttl=GRIST_SNAPSHOT_TTL):
+    """
+    Get the shared GRIST client of a document, creating it on first use
+
+    Args:
+        doc_id (string): id of the GRIST document
+        server (string): url of the GRIST server. Default from get_grist_server
+        ttl (int): lifetime in seconds of the table snapshots of a new client
+
+    Returns:
+        A PooledGristDocAPI object (see grist_client.py)
+    """
+    if 'GRIST_API_KEY' not in os.environ:
+        raise ValueError("The GRIST_API_KEY environment variable does not exist.")
+
+    # grist_api is only imported by the commands that use GRIST
+    from ssphub_directory.grist_client import PooledGristDocAPI
+
+    server = (server or get_grist_server()).rstrip('/')
+
+    with _grist_clients_lock:
+        key = (server, doc_id)
+        if key not in _grist_clients:
+            _grist_clients[key] = PooledGristDocAPI(doc_id, server=server, ttl=ttl)
+        return _grist_clients[key]
+
+
+def clear_grist_clients():
+    """
+    Forget the shared GRIST clients and their table snapshots
+    """
+    with _grist_clients_lock:
+        _grist_clients.clear()
+
+
+def get_grist_directory_login():
+    """
+    Send back GRIST API login details
+
+    Args:
+        None
+
+    Returns:
+        A PooledGristDocAPI object, shared by all the calls of the run
+    """
+    # Log in to GRIST API
+    DOC_ID = os.environ['GRIST_SSPHUB_DIRECTORY_ID']
+
+    # Returning API details connection
+    return get_grist_client(DOC_ID)
+
+
+def decode_grist_list(value):
+    """
+    Turn a GRIST list cell (['L', value, ...]) into a python list
+
+    Example:
+        >>> decode_grist_list(['L', 'datavis', 'IA'])
+        ['datavis', 'IA']
+    """
+    if isinstance(value, list) and value[:1] == ['L']:
+        return [str(item) for item in value[1:]]
+    if isinstance(value, list):
+        return [str(item) for item in value]
+    return None if value is None or value == '' else [str(value)]
+
+
+def grist_columns_to_polars(columns, schema):
+    """
+    Build a polars DataFrame directly from GRIST columns with an explicit schema,
+    without going through pandas and without scanning the rows to infer types
+
+    Args:
+        columns (dict): {column: list of values}, as sent by GRIST (see PooledGristDocAPI.fetch_table_columns)
+        schema (dict): {column: 'Int64', 'Float64', 'Boolean', 'String', 'List' or 'Object'}. Only these columns are kept.
+        The values of 'Object' columns are kept as GRIST sends them
+
+    Returns:
+        pl.DataFrame
+
+    Example:
+        >>> grist_columns_to_polars({'id': [1], 'email': ['a@x.fr'], 'tags': [['L', 'IA']]},
+        {'id': 'Int64', 'email': 'String', 'tags': 'List'})
+        shape: (1, 3) ...
+    """
+    polars_schema = {}
+    data = {}
+    for name, type_name in schema.items():
+        values = columns[name]
+        if type_name == 'List':
+            polars_schema[name] = pl.List(pl.String)
+            data[name] = [decode_grist_list(value) for value in values]
+        elif type_name == 'Boolean':
+            polars_schema[name] = pl.Boolean
+            data[name] = [None if value is None else bool(value) for value in values]
+        elif type_name == 'String':
+            polars_schema[name] = pl.String
+            data[name] = [value if value is None or isinstance(value, str) else str(value) for value in values]
+        else:
+            polars_schema[name] = getattr(pl, type_name)
+            data[name] = values
+
+    return pl.DataFrame(data, schema=polars_schema)
+
+
+def directory_snapshot_paths(snapshot_dir=DIRECTORY_SNAPSHOT_DIR, table_id='Contact'):
+    """
+    Paths of the parquet snapshot of a GRIST table and of its sync state
+
+    Returns:
+        tuple with the parquet path and the json state path
+    """
+    snapshot_dir = cache_path(snapshot_dir)
+    return os.path.join(snapshot_dir, table_id + '.parquet'), os.path.join(snapshot_dir, table_id + '.json')
+
+
+def directory_records_to_df(records, updated_at_column=DIRECTORY_UPDATED_AT_COLUMN):
+    """
+    Turn directory rows fetched with SQL into a polars DataFrame with a fixed schema.
+    SQLite gives booleans as 0/1, they are cast back to Boolean
+
+    Args:
+        records (list): list of dicts {column: value}
+        updated_at_column (string): column of the last modification time
+
+    Returns:
+        pl.DataFrame with columns id, DIRECTORY_COLUMNS and updated_at_column
+    """
+    schema = {**GRIST_TABLE_SCHEMAS['Contact'], updated_at_column: 'Float64'}
+    columns = {name: [record.get(name) for record in records] for name in schema}
+    return grist_columns_to_polars(columns, schema)
+
+
+def add_directory_updated_at_column(table_id='Contact', updated_at_column=DIRECTORY_UPDATED_AT_COLUMN):
+    """
+    Add to a GRIST table the column of the last modification time of its rows, needed by the delta
+    syncs of the directory snapshot (see sync_directory_snapshot). It is a DateTime column with the
+    trigger formula NOW(), recalculated on new rows and on any change of a row. To run once per document
+
+    Args:
+        table_id (string): name of the GRIST table
+        updated_at_column (string): name of the column to add
+
+    Example:
+        >>> add_directory_updated_at_column()
+        Column Date_modification added to the table Contact
+    """
+    api_directory = get_grist_directory_login()
+    api_directory.call(f'tables/{table_id}/columns', json_data={'columns': [{
+        'id': updated_at_column,
+        'fields': {
+            'label': updated_at_column,
+            'type': 'DateTime:Europe/Paris',
+            'isFormula': False,
+            'formula': 'NOW()',
+            'recalcWhen': 2,  # on new rows and on manual changes of any column
+            'recalcDeps': None
+            }
+        }]})
+    print(f'Column {updated_at_column} added to the table {table_id}')
+
+
+def sync_directory_snapshot(snapshot_dir=DIRECTORY_SNAPSHOT_DIR,
+    table_id='Contact',
+    updated_at_column=DIRECTORY_UPDATED_AT_COLUMN,
+    full=False):
+    """
+    Update the local parquet snapshot of the GRIST directory with the rows added, modified or removed
+    since the last sync. Only the list of row ids and the changed rows are downloaded: rows whose
+    updated_at_column is at or after the last sync (rows modified in the same second as the last sync
+    are downloaded again), or whose id is above the last known id.
+    The first sync, or full=True, downloads the whole table.
+
+    Args:
+        snapshot_dir (string): folder of the snapshot
+        table_id (string): name of the GRIST table
+        updated_at_column (string): GRIST column of the last modification time of a row
+        full (boolean): download the whole table again
+
+    Returns:
+        pl.DataFrame, the updated snapshot
+
+    Example:
+        >>> sync_directory_snapshot()
+        Directory snapshot synced: 2 added, 1 modified, 0 removed
+    """
+    snapshot_dir = cache_path(snapshot_dir)
+    api_directory = get_grist_directory_login()
+    parquet_path, state_path = directory_snapshot_paths(snapshot_dir, table_id)
+    # [] and not "": SQLite reads a "column" it doesn't find as a string, a missing column must fail the sync
+    columns = ', '.join(f'[{name}]' for name in ['id'] + DIRECTORY_COLUMNS + [updated_at_column])
+
+    snapshot = None
+    if not full and os.path.isfile(parquet_path) and os.path.isfile(state_path):
+        snapshot = pl.read_parquet(parquet_path)
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+
+    if snapshot is None:
+        snapshot = directory_records_to_df(run_grist_sql(api_directory, f'SELECT {columns} FROM "{table_id}"'), updated_at_column)
+        print(f'Directory snapshot created: {snapshot.height} rows')
+    else:
+        # Ids of the table, to find removed rows
+        current_ids = [record['id'] for record in run_grist_sql(api_directory, f'SELECT id FROM "{table_id}"')]
+        # Rows changed since the last sync, or added
+        changed = directory_records_to_df(run_grist_sql(
+            api_directory,
+            f'SELECT {columns} FROM "{table_id}" WHERE [{updated_at_column}] >= ? OR id > ?',
+            [state['last_modified'] if state['last_modified'] is not None else -1, state['max_id']]
+            ), updated_at_column).unique('id', keep='last', maintain_order=True)
+
+        known_ids = set(snapshot['id'].to_list())
+        removed = known_ids - set(current_ids)
+        added = sum(1 for row_id in changed['id'].to_list() if row_id not in known_ids)
+        # Rows of the last sync downloaded again without change are not counted as modified
+        unchanged = changed.join(snapshot, on=changed.columns, how='semi', nulls_equal=True).height
+
+        snapshot = pl.concat([
+            snapshot.filter(~pl.col('id').is_in(list(removed)) & ~pl.col('id').is_in(changed['id'].to_list())),
+            changed
+            ]).sort('id')
+        print(f'Directory snapshot synced: {added} added, {changed.height - added - unchanged} modified, {len(removed)} removed')
+
+    # Saving the snapshot and the sync state (server times, to avoid clock differences)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    snapshot.write_parquet(parquet_path + '.tmp')
+    os.replace(parquet_path + '.tmp', parquet_path)
+    state = {
+        'last_modified': snapshot[updated_at_column].max(),
+        'max_id': snapshot['id'].max() if snapshot.height else 0
+    }
+    with open(state_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(state_path + '.tmp', state_path)
+
+    return snapshot
+
+
+def normalize_email(email, fold_plus=False):
+    """
+    Normalize an email address to compare it: trimmed, without <>, lowercase
+
+    Args:
+        email (string): the email address
+        fold_plus (boolean): also remove the '+tag' of the local part
+
+    Returns:
+        (string) the normalized address, None if email is None
+
+    Example:
+        >>> normalize_email(' <First.Name+SSPHub@Insee.fr> ', fold_plus=True)
+        'first.name@insee.fr'
+    """
+    if email is None:
+        return None
+    email = email.strip().strip('<>').strip().lower()
+    if fold_plus:
+        email = re.sub(EMAIL_PLUS_TAG_PATTERN, '@', email, count=1)
+    return email
+
+
+def normalize_email_expr(column='email', fold_plus=False):
+    """
+    Polars expression doing the same as normalize_email on a column
+
+    Example:
+        >>> df.with_columns(normalize_email_expr().alias('email_normalized'))
+    """
+    expr = pl.col(column).str.strip_chars().str.strip_chars('<>').str.strip_chars().str.to_lowercase()
+    if fold_plus:
+        expr = expr.str.replace(EMAIL_PLUS_TAG_PATTERN, '@')
+    return expr
+
+
+def build_email_index(ids, emails, fold_plus=False):
+    """
+    Index row ids by normalized email address
+
+    Args:
+        ids (list): row ids
+        emails (list): email of each row
+        fold_plus (boolean): also remove the '+tag' of the local part
+
+    Returns:
+        dict {normalized email: list of row ids}
+
+    Example:
+        >>> build_email_index([1, 2, 3], ['a@x.fr', ' A@X.fr', 'b@x.fr'])
+        {'a@x.fr': [1, 2], 'b@x.fr': [3]}
+    """
+    index = {}
+    for row_id, email in zip(ids, emails):
+        normalized = normalize_email(email, fold_plus)
+        if normalized:
+            index.setdefault(normalized, []).append(row_id)
+    return index
+
+
+def get_contact_email_index(fold_plus=False):
+    """
+    Normalized email index of the Contact table (see build_email_index). It is kept by the GRIST client
+    of the directory and rebuilt only when the snapshot of the table is refreshed (see PooledGristDocAPI.email_index)
+
+    Args:
+        fold_plus (boolean): also remove the '+tag' of the local part
+
+    Returns:
+        dict {normalized email: list of row ids}
+    """
+    return get_grist_directory_login().email_index('Contact', 'email', fold_plus)
+
+
+def find_duplicate_emails(index):
+    """
+    Find the addresses present on several rows
+
+    Args:
+        index (dict): result of build_email_index
+
+    Returns:
+        dict {normalized email: list of row ids} of the duplicates
+    """
+    return {email: ids for email, ids in index.items() if len(ids) > 1}
+
+
+def get_directory_as_df(source='snapshot', sync=True, snapshot_dir=DIRECTORY_SNAPSHOT_DIR):
+    """
+    Fetch back direcory of SSPHUB as a Panda dataframe
+
+    Args:
+        source (string): 'snapshot' (default) to read the local parquet snapshot of the directory, synced with
+        GRIST. Until the DIRECTORY_UPDATED_AT_COLUMN column is added (see add_directory_updated_at_column), the
+        sync fails and the whole table is downloaded. 'grist' to download the whole Contact table
+        sync (boolean): with source='snapshot', sync the snapshot with GRIST first (see sync_directory_snapshot)
+        snapshot_dir (string): folder of the snapshot
+
+    Returns:
+        A pl.DataFrame with three columns : ['email', 'Supprimez_mon_compte', 'nom', 'Nom_domaine']
+    """
+    if source not in ('snapshot', 'grist'):
+        raise ValueError(f"source must be 'snapshot' or 'grist', not {source!r}")
+
+    if source == 'snapshot' and not sync:
+        return pl.read_parquet(directory_snapshot_paths(snapshot_dir)[0]).select(DIRECTORY_COLUMNS)
+
+    if source == 'snapshot':
+        try:
+            return sync_directory_snapshot(snapshot_dir).select(DIRECTORY_COLUMNS)
+        except requests.exceptions.HTTPError as e:
+            # e.g. no SQL access or no modification time column in the document
+            print(f"Directory snapshot can't be synced, downloading the whole table "
+                  f"(see add_directory_updated_at_column): {e}")
+
+    # fetch all the rows, typed with the schema of the table
+    api_directory = get_grist_directory_login()
+    directory_df = grist_columns_to_polars(api_directory.fetch_table_columns('Contact'), GRIST_TABLE_SCHEMAS['Contact'])
+
+    # Selecting minimum set of columns
+    cols_to_keep = DIRECTORY_COLUMNS
+    directory_df = directory_df.select(cols_to_keep)
+
+    return directory_df
+
+
+def get_emails(source='snapshot', sync=True):
+    """
+    Extract all emails that have not asked to be deteled from directory
+
+    Args:
+        source (string): 'snapshot' (local directory snapshot, synced with GRIST) or 'grist' (whole table download),
+        see get_directory_as_df
+        sync (boolean): with source='snapshot', sync the snapshot with GRIST first
+
+    Returns:
+        a single string with joined emails separated by ;
+
+    Example:
+        >>> get_emails()
+        '<myemail@example.com>; <myemail2@example.com>'
+    """
+    my_directory_df = directory_recipients(get_directory_as_df(source=source, sync=sync))
+    # Turning emails from myemail@example.com to <myemail@example.com>
+    my_directory_df = my_directory_df.with_columns(('<' + pl.col('email') + '>').alias('email'))
+    # Joining all emails into one string '<myemail@example.com>; <myemail2@example.com>'
+    return '; '.join(my_directory_df['email'])
+
+
+def directory_recipients(directory_df):
+    """
+    Members of the directory to send the newsletter to: not asking for the deletion of their account,
+    sorted by 'Nom_domaine' and 'nom', each email once
+
+    Args:
+        directory_df (pl.DataFrame): see get_directory_as_df
+
+    Returns:
+        pl.DataFrame with the same columns
+    """
+    return (directory_df.filter(pl.col('Supprimez_mon_compte') == False)
+                        .sort(['Nom_domaine', 'nom'])
+                        # A person registered twice gets the email once
+                        .filter(normalize_email_expr().is_first_distinct())
+                        )
+
+
+class RecipientBatch(namedtuple('RecipientBatch', ['number', 'emails', 'domains'])):
+    """
+    Recipients of one message: number of the batch (from 1), list of emails and
+    dict {mail domain: number of emails of the batch at this domain}
+    """
+    __slots__ = ()
+
+    @property
+    def bcc(self):
+        """
+        The emails as a bcc header, '<myemail@example.com>; <myemail2@example.com>'
+        """
+        return '; '.join(f'<{email}>' for email in self.emails)
+
+
+def plan_recipient_batches(directory_df, max_per_message=500, max_per_domain=50):
+    """
+    Split the recipients of the directory into batches, one message each, with at most max_per_message
+    emails per message and max_per_domain emails at the same mail domain (the part after @), so that
+    receiving servers don't throttle a message sent to hundreds of their users.
+    Each batch takes first from the domains with the most emails left, so that large domains
+    are spread over all the batches.
+
+    Args:
+        directory_df (pl.DataFrame): directory, see get_directory_as_df. Members asking for the deletion
+        of their account are removed and duplicates are sent once (see directory_recipients)
+        max_per_message (int): maximum number of emails per batch
+        max_per_domain (int): maximum number of emails at the same domain per batch
+
+    Returns:
+        list of RecipientBatch
+
+    Example:
+        >>> plan_recipient_batches(get_directory_as_df(), max_per_message=500, max_per_domain=50)
+        [RecipientBatch(number=1, emails=['myemail@insee.fr', ...], domains={'insee.fr': 50, 'gmail.com': 50, ...}), ...]
+    """
+    if max_per_message < 1 or max_per_domain < 1:
+        raise ValueError('max_per_message and max_per_domain must be at least 1')
+
+    recipients = directory_recipients(directory_df).with_columns(
+        normalize_email_expr().str.split('@').list.last().alias('mail_domain'))
+
+    # Emails left to send, by domain, in the order of the directory. Each email is popped once
+    queues = {}
+    for email, domain in zip(recipients['email'].to_list(), recipients['mail_domain'].to_list()):
+        queues.setdefault(domain, deque()).append(email)
+
+    batches = []
+    while queues:
+        emails = []
+        domains = {}
+        for domain in sorted(queues, key=lambda domain: len(queues[domain]), reverse=True):
+            take = min(max_per_domain, max_per_message - len(emails), len(queues[domain]))
+            if take <= 0:
+                break
+            emails.extend(queues[domain].popleft() for _ in range(take))
+            domains[domain] = take
+            if not queues[domain]:
+                del queues[domain]
+        batches.append(RecipientBatch(len(batches) + 1, emails, domains))
+
+    return batches
+
+
+def get_recipient_batches(max_per_message=500, max_per_domain=50, source='snapshot', sync=True):
+    """
+    Batches of recipients of the directory, see plan_recipient_batches and get_directory_as_df
+
+    Example:
+        >>> [batch.bcc for batch in get_recipient_batches()]
+        ['<myemail@example.com>; <myemail2@example.com>', ...]
+    """
+    return plan_recipient_batches(get_directory_as_df(source=source, sync=sync), max_per_message, max_per_domain)
+
+
+def extract_emails_from_txt(file_path='ssphub_directory/test/replies.txt'):
+    """
+    Extract all email addresses from a file that contains all the automatic replies to a newsletter / an email.
+
+    Args:
+        file_path (str): The path to the file containing email addresses.
+
+    Returns:
+        list: A list of extracted email addresses.
+    """
+    # Regular expression pattern for matching email addresses
+    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+
+    # Read the content of the file
+    with open(file_path, 'r', encoding='utf-8') as file:
+        content = file.read()
+
+    # Find all email addresses in the content
+    emails = re.findall(email_pattern, content)
+
+    # Remove duplicate - Convert the list of email addresses to a set and back to list
+    emails = set(emails)
+    emails = list(emails)
+
+    return emails
+
+
+def iter_mailbox_messages(path):
+    """
+    Read the messages of an mbox file, a Maildir, a folder of .eml files or a single .eml file,
+    one at a time
+
+    Args:
+        path (string): path to the mailbox
+
+    Returns:
+        generator of email.message.EmailMessage
+    """
+    parser = BytesParser(policy=policy.default)
+
+    def factory(file):
+        return parser.parse(file)
+
+    if os.path.isdir(path) and all(os.path.isdir(os.path.join(path, sub)) for sub in ('cur', 'new', 'tmp')):
+        box = mailbox.Maildir(path, factory=factory, create=False)
+        for key in box.iterkeys():
+            yield box[key]
+    elif os.path.isdir(path):
+        for file_name in sorted(os.listdir(path)):
+            if file_name.lower().endswith('.eml'):
+                with open(os.path.join(path, file_name), 'rb') as f:
+                    yield parser.parse(f)
+    elif path.lower().endswith('.eml'):
+        with open(path, 'rb') as f:
+            yield parser.parse(f)
+    else:
+        box = mailbox.mbox(path, factory=factory, create=False)
+        try:
+            for key in box.iterkeys():
+                yield box[key]
+        finally:
+            box.close()
+
+
+def classify_bounce(action, status):
+    """
+    Classify a failed delivery from its DSN Action and Status fields (RFC 3464)
+
+    Args:
+        action (string): 'failed', 'delayed', 'delivered', 'relayed' or 'expanded'
+        status (string): status code, e.g. '5.1.1'
+
+    Returns:
+        'hard' (permanent failure, 5.x.x), 'soft' (temporary failure, 4.x.x or delayed) or None if delivered
+
+    Example:
+        >>> classify_bounce('failed', '5.1.1')
+        'hard'
+    """
+    action = (action or '').strip().lower()
+    status = (status or '').strip()
+    if action not in ('failed', 'delayed'):
+        return None
+    if action == 'failed' and not status.startswith('4'):
+        return 'hard'
+    return 'soft'
+
+
+def parse_bounce(message):
+    """
+    Extract the failed recipients of a bounce from its delivery-status parts (RFC 3464).
+    Addresses in the text of the message (our sender, people in CC...) are ignored
+
+    Args:
+        message (email.message.EmailMessage): the bounce
+
+    Returns:
+        list of dicts with keys 'email', 'type' ('hard' or 'soft'), 'action', 'status', 'diagnostic', 'message_id'
+    """
+    bounces = []
+    for part in message.walk():
+        if part.get_content_type() != 'message/delivery-status':
+            continue
+        # First block is about the message, next ones are one per recipient
+        for block in part.get_payload()[1:]:
+            recipient = block.get('Final-Recipient') or block.get('Original-Recipient')
+            bounce_type = classify_bounce(block.get('Action'), block.get('Status'))
+            if not recipient or bounce_type is None:
+                continue
+            bounces.append({
+                'email': recipient.split(';', 1)[-1].strip().strip('<>'),
+                'type': bounce_type,
+                'action': str(block.get('Action', '')).strip().lower(),
+                'status': str(block.get('Status', '')).strip(),
+                'diagnostic': str(block.get('Diagnostic-Code', '')).strip(),
+                'message_id': message.get('Message-ID')
+            })
+    return bounces
+
+
+def iter_bounces(path, types=('hard', 'soft')):
+    """
+    Stream the failed recipients of the bounces of a mailbox (mbox file, Maildir, folder of .eml files
+    or single .eml file). Messages are read one at a time, so memory use doesn't depend on the mailbox size
+
+    Args:
+        path (string): path to the mailbox
+        types (tuple): types of bounces to yield, 'hard' and/or 'soft'
+
+    Returns:
+        generator of dicts, see parse_bounce
+
+    Example:
+        >>> next(iter_bounces('replies.mbox'))
+        {'email': 'old@example.com', 'type': 'hard', 'action': 'failed', 'status': '5.1.1', ...}
+    """
+    for message in iter_mailbox_messages(path):
+        for bounce in parse_bounce(message):
+            if bounce['type'] in types:
+                yield bounce
+
+
+def extract_emails_from_replies(path, types=('hard',)):
+    """
+    Extract the emails to remove from the replies to a newsletter. A .txt file is scanned for any
+    email address (see extract_emails_from_txt), a mailbox is parsed for delivery failures (see iter_bounces)
+
+    Args:
+        path (string): path to a .txt file or to a mailbox
+        types (tuple): types of bounces to keep for mailboxes, 'hard' by default
+
+    Returns:
+        list: A list of extracted email addresses, without duplicates
+    """
+    if os.path.isfile(path) and path.lower().endswith('.txt'):
+        return extract_emails_from_txt(path)
+
+    return list(dict.fromkeys(bounce['email'] for bounce in iter_bounces(path, types)))
 
 
-def download_images_for_newsletter(number, branch='main', output_dir='.temp'):
+def is_retryable_error(error):
     """
-    Download all image files from given newsletter number and branch and store it in output_dir
+    Tell if a failed GRIST call can be retried: connection problems, 429 (rate limit) and 5xx answers
 
-    Arg:
-        number: number of the newsletter whose images will be downloaded, as a string
-        branch: repo branch of the newsletter (main for published newsletter, other for non published newsletters)
-        output_dir: directory where to save the files to, as a string
+    Args:
+        error (Exception): the error raised by the call
 
     Returns:
-        nothing
-        nb : a message is printed if download was successfull
-
-    Example:
-        >>> download_file('https://raw.githubusercontent.com/InseeFrLab/ssphub/refs/heads/main/infolettre/infolettre_19/2025_09_back_school.png')
-        Image file downloaded to .temp/2025_09_back_school.png
+        boolean
     """
-    # Get the list of image files in the subfolder
-    image_files = list_image_files_for_newsletter(number, branch)
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and (response.status_code == 429 or response.status_code >= 500)
 
-    if not image_files:
-        print("No image files found in the subfolder.")
-
-    # Download each image file
-    downloaded_files = []
-    for image_file_url in image_files:
-        downloaded_file = download_file(image_file_url, output_dir)
-        if downloaded_file:
-            downloaded_files.append(downloaded_file)
 
-    return downloaded_files
+def retry_delay(error, attempt, backoff):
+    """
+    Seconds to wait before the next attempt: the Retry-After header of the answer if any,
+    otherwise an exponential backoff (backoff, 2 * backoff, 4 * backoff...)
+    """
+    response = getattr(error, 'response', None)
+    if response is not None and response.headers.get('Retry-After', '').isdigit():
+        return int(response.headers['Retry-After'])
+    return backoff * 2 ** attempt
 
 
-def generate_email(number,
-    branch,
-    email_object,
-    email_to,
-    email_bcc,
-    email_from='SELECT THE RIGHT EMAIL',
-    email_cc='',
-    drop_temp=True):
+def run_bulk_mutation(chunks, apply_chunk, max_retries=5, backoff=1.0):
     """
-    Generates the draft email for a newsletter in the folder '.temp/'. Built on previous functions.
+    Apply a mutation chunk by chunk, retrying a chunk with exponential backoff on 429/5xx answers.
+    apply_chunk is called again on retry, so it must be idempotent (skip what is already done).
+    A chunk failing after max_retries doesn't stop the next ones.
 
-    Arg:
-        number (string): number of the newsletter to turn into email
-        branch (string): repo branch of the newsletter to turn into email (main for published newsletter, other for non published newsletters)
-        email_object (string): object of the email
-        email_to (string) : list of email adresses to send the email to
-        email_bcc (string) : list of email adresses to be in bcc
-        email_from(string) : sender to see in Outlook. None for default sender
-        email_cc (string) : list of email adresses to be in cc
-        drop_temp (boolean): if temporary knitted files should be removed after knitting. Default is true
+    Args:
+        chunks (list): list of chunks of items
+        apply_chunk (function): takes a chunk, applies it and returns a tuple (number applied, number skipped)
+        max_retries (int): maximum number of retries of a chunk
+        backoff (float): delay in seconds before the first retry
 
     Returns:
-        None
-
-    Example:
-        >>> download_file('https://raw.githubusercontent.com/InseeFrLab/ssphub/refs/heads/main/infolettre/infolettre_19/2025_09_back_school.png')
-        Image file downloaded to .temp/2025_09_back_school.png
+        list of dicts, one per chunk, with keys 'chunk', 'size', 'applied', 'skipped', 'attempts', 'status' ('ok' or 'failed') and 'error'
     """
-    temp_file = './.temp/temp'
-    temp_file_qmd = temp_file + '.qmd'
-    temp_file_html = temp_file + '.html'
+    summary = []
+    for chunk_number, chunk in enumerate(chunks):
+        result = {'chunk': chunk_number, 'size': len(chunk), 'applied': 0, 'skipped': 0,
+                  'attempts': 0, 'status': 'ok', 'error': None}
+        for attempt in range(max_retries + 1):
+            result['attempts'] = attempt + 1
+            try:
+                result['applied'], result['skipped'] = apply_chunk(chunk)
+                result['error'] = None
+                count_metric('rows_written', result['applied'])
+                break
+            except requests.exceptions.RequestException as e:
+                result['error'] = str(e)
+                if attempt == max_retries or not is_retryable_error(e):
+                    result['status'] = 'failed'
+                    print(f"Chunk {chunk_number} failed after {attempt + 1} attempts: {e}")
+                    break
+                time.sleep(retry_delay(e, attempt, backoff))
+        summary.append(result)
+
+    return summary
+
+
+def bulk_add_records(api, table_id, records, key_column, chunk_size=200, max_retries=5, backoff=1.0):
+    """
+    Add records to a GRIST table in chunks, with retries. Records whose key_column value is already in
+    the table are skipped, so that replaying the same records doesn't create duplicates
 
-    download_images_for_newsletter(number, branch, '.temp')
+    Args:
+        api (GristDocAPI): client of the GRIST document
+        table_id (string): name of the GRIST table
+        records (list): list of dicts {column: value}
+        key_column (string): column identifying a record
+        chunk_size (int): number of records per request
+        max_retries (int): maximum number of retries of a chunk
+        backoff (float): delay in seconds before the first retry
 
-    qmd_content = fetch_qmd_file(raw_url_newsletter(number, branch))
-    process_qmd_file(qmd_content, temp_file_qmd, published_url_newsletter(number))
-    knit_to_html(temp_file_qmd)
+    Returns:
+        list of per chunk results, see run_bulk_mutation
+    """
+    # Removing duplicates of the input
+    unique_records = list({record[key_column]: record for record in records}.values())
 
-    with open(temp_file_html, 'r', encoding="utf-8") as f:
-        generate_eml_file(f.read(), email_object, email_bcc, to_recipient=email_to, cc_recipient=email_cc, from_sender=email_from)
+    def apply_chunk(chunk):
+        existing = {record['email'] for record in lookup_records(api, table_id, [r[key_column] for r in chunk], key_column)}
+        to_add = [record for record in chunk if record[key_column] not in existing]
+        if to_add:
+            api.add_records(table_id, to_add)
+        return len(to_add), len(chunk) - len(to_add)
 
-    if drop_temp:
-        remove_files_dir(temp_file_qmd, temp_file_html)
+    return run_bulk_mutation(chunk_list(unique_records, chunk_size), apply_chunk, max_retries, backoff)
 
 
-def get_grist_directory_login():
+def bulk_delete_records(api, table_id, row_ids, chunk_size=200, max_retries=5, backoff=1.0):
     """
-    Send back GRIST API login details
+    Delete rows of a GRIST table in chunks, with retries. Rows that don't exist anymore are skipped,
+    so that replaying a deletion is harmless
 
     Args:
-        None
+        api (GristDocAPI): client of the GRIST document
+        table_id (string): name of the GRIST table
+        row_ids (list): ids of the rows to delete
+        chunk_size (int): number of rows per request
+        max_retries (int): maximum number of retries of a chunk
+        backoff (float): delay in seconds before the first retry
 
     Returns:
-        A GristDocAPI object
+        list of per chunk results, see run_bulk_mutation
     """
-    # Log in to GRIST API
-    SERVER = "https://grist.numerique.gouv.fr/"
-    DOC_ID = os.environ['GRIST_SSPHUB_DIRECTORY_ID']
+    def apply_chunk(chunk):
+        existing = {record['id'] for record in lookup_records(api, table_id, chunk, 'id')}
+        to_delete = [row_id for row_id in chunk if row_id in existing]
+        if to_delete:
+            api.delete_records(table_id, to_delete)
+        return len(to_delete), len(chunk) - len(to_delete)
 
-    if 'GRIST_API_KEY' not in os.environ:
-        raise ValueError("The GRIST_API_KEY environment variable does not exist.")
+    return run_bulk_mutation(chunk_list(list(dict.fromkeys(row_ids)), chunk_size), apply_chunk, max_retries, backoff)
 
-    # Returning API details connection
-    return GristDocAPI(DOC_ID, server=SERVER)
 
+def print_bulk_summary(summary, action):
+    """
+    Print a one line summary of a bulk mutation
 
-def get_directory_as_df():
+    Example:
+        >>> print_bulk_summary([{'applied': 2, 'skipped': 1, 'status': 'ok', ...}], 'ajoutés à Delete')
+        2 emails ajoutés à Delete, 1 déjà traités, 0 lots en échec
     """
-    Fetch back direcory of SSPHUB as a Panda dataframe
+    applied = sum(result['applied'] for result in summary)
+    skipped = sum(result['skipped'] for result in summary)
+    failed = sum(result['status'] == 'failed' for result in summary)
+    print(f'{applied} emails {action}, {skipped} déjà traités, {failed} lots en échec \n')
+
+
+def add_to_grist_delete_table(data_list, chunk_size=200, max_retries=5, backoff=1.0):
+    """
+    Export a list of email adresses to Grist to delete table, in chunks, retrying on rate limits
+    and server errors. Emails already in the table are not added twice
 
     Args:
-        None
+        data_list (list): The list of email to export to Grist
+        chunk_size (int): number of emails per request
+        max_retries (int): maximum number of retries of a chunk
+        backoff (float): delay in seconds before the first retry
 
     Returns:
-        A pl.DataFrame with three columns : ['email', 'Supprimez_mon_compte', 'nom', 'Nom_domaine']
+        list of per chunk results, see run_bulk_mutation
     """
-    # fetch all the rows
-    api_directory = get_grist_directory_login()
-    directory_df = api_directory.fetch_table('Contact')
-    directory_df = pl.DataFrame(directory_df, infer_schema_length=None)
+    summary = bulk_add_records(get_grist_directory_login(), 'Delete',
+                               [{'Emails_to_delete': email} for email in data_list], 'Emails_to_delete',
+                               chunk_size=chunk_size, max_retries=max_retries, backoff=backoff)
+    print_bulk_summary(summary, 'ajoutés à la table Delete')
+    return summary
 
-    # Selecting minimum set of columns
-    cols_to_keep = [
-        'email', 'Supprimez_mon_compte', 'nom', 'Nom_domaine'
-        ]
-    directory_df = directory_df.select(cols_to_keep)
 
-    return directory_df
+def chunk_list(items, chunk_size):
+    """
+    Split a list into consecutive chunks of at most chunk_size items
 
+    Example:
+        >>> chunk_list([1, 2, 3, 4, 5], 2)
+        [[1, 2], [3, 4], [5]]
+    """
+    items = list(items)
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
 
-def get_emails():
+
+def run_grist_sql(api, sql, args=None):
     """
-    Extract all emails that have not asked to be deteled from directory
+    Run a read-only SQL query on a GRIST document
+
+    Args:
+        api (GristDocAPI): client of the GRIST document
+        sql (string): SELECT statement, with ? for parameters
+        args (list): values of the parameters
 
     Returns:
-        a single string with joined emails separated by ;
+        list of dicts {column: value}
 
     Example:
-        >>> get_emails()
-        '<myemail@example.com>; <myemail2@example.com>'
+        >>> run_grist_sql(get_grist_directory_login(), 'SELECT id, email FROM Contact WHERE id = ?', [1])
+        [{'id': 1, 'email': 'myemail@example.com'}]
     """
-    my_directory_df = get_directory_as_df()
-    my_directory_df = (my_directory_df.filter(pl.col('Supprimez_mon_compte') == False)
-                                      .sort(['Nom_domaine', 'nom'])
-                                      )
-    # Turning emails from myemail@example.com to <myemail@example.com>
-    my_directory_df.with_columns('<' + pl.col('email') + '>')
-    # Joining all emails into one string '<myemail@example.com>; <myemail2@example.com>'
-    return '; '.join(my_directory_df['email'])
+    response = api.call('sql', json_data={'sql': sql, 'args': list(args or [])})
+    records = [record['fields'] for record in response.json()['records']]
+    count_metric('rows_fetched', len(records))
+    return records
 
 
-def extract_emails_from_txt(file_path='ssphub_directory/test/replies.txt'):
+def query_ids_of_email_sql(api, table_id, emails_list, email_column='email', chunk_size=500):
     """
-    Extract all email addresses from a file that contains all the automatic replies to a newsletter / an email.
+    Look for emails with the GRIST SQL endpoint, in batches of 'IN (...)' queries.
+    Only the id and email columns are sent back by GRIST
 
     Args:
-        file_path (str): The path to the file containing email addresses.
+        api (GristDocAPI): client of the GRIST document
+        table_id (string): name of the GRIST table
+        emails_list (list): emails to look for
+        email_column (string): name of the column holding the emails
+        chunk_size (int): number of emails per query (SQLite accepts at most 999 parameters)
 
     Returns:
-        list: A list of extracted email addresses.
+        list of dicts {'id': row id, 'email': email}
     """
-    # Regular expression pattern for matching email addresses
-    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+    for name in (table_id, email_column):
+        if not re.fullmatch(r'\w+', name):
+            raise ValueError(f"Invalid GRIST table or column name: {name!r}")
 
-    # Read the content of the file
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
+    records = []
+    for emails_chunk in chunk_list(emails_list, chunk_size):
+        placeholders = ', '.join('?' * len(emails_chunk))
+        # Names are quoted: 'Delete' is a SQL keyword
+        sql = (f'SELECT id, "{email_column}" AS email FROM "{table_id}" '
+               f'WHERE "{email_column}" IN ({placeholders}) ORDER BY id')
+        records.extend(run_grist_sql(api, sql, emails_chunk))
 
-    # Find all email addresses in the content
-    emails = re.findall(email_pattern, content)
+    return records
 
-    # Remove duplicate - Convert the list of email addresses to a set and back to list
-    emails = set(emails)
-    emails = list(emails)
 
-    return emails
+def query_ids_of_email_filter(api, table_id, emails_list, email_column='email', chunk_size=500):
+    """
+    Look for emails with the filter parameter of the GRIST records endpoint, in batches
 
+    Args:
+        api (GristDocAPI): client of the GRIST document
+        table_id (string): name of the GRIST table
+        emails_list (list): emails to look for
+        email_column (string): name of the column holding the emails
+        chunk_size (int): number of emails per request
+
+    Returns:
+        list of dicts {'id': row id, 'email': email}
+    """
+    records = []
+    for emails_chunk in chunk_list(emails_list, chunk_size):
+        query = urllib.parse.quote_plus(json.dumps({email_column: emails_chunk}))
+        response = api.call(f'tables/{table_id}/records?filter={query}')
+        records.extend({'id': record['id'],
+                        'email': record['id'] if email_column == 'id' else record['fields'][email_column]}
+                       for record in response.json()['records'])
 
-def add_to_grist_delete_table(data_list):
+    return records
+
+
+def lookup_records(api, table_id, values, column='email', chunk_size=500, lookup='sql'):
     """
-    Export a list of email adresses to Grist to delete table
+    Find the rows of a GRIST table whose column is in values, filtering on the GRIST server
 
     Args:
-        data_list (list): The list of email to export to Grist
+        api (GristDocAPI): client of the GRIST document
+        table_id (string): name of the GRIST table
+        values (list): values to look for
+        column (string): name of the column to filter on ('id' for row ids)
+        chunk_size (int): number of values sent per request
+        lookup (string): 'sql' to use the SQL endpoint (falls back to 'filter' if it is not available,
+        see GRIST_SQL_UNAVAILABLE_STATUSES) or 'filter' to use the filter parameter of the records endpoint
 
     Returns:
-        None
+        list of dicts {'id': row id, 'email': value of the column}
     """
+    if lookup == 'sql':
+        try:
+            return query_ids_of_email_sql(api, table_id, values, column, chunk_size)
+        except requests.exceptions.HTTPError as e:
+            # Rate limits and server errors are raised, to be retried by run_bulk_mutation
+            if e.response is None or e.response.status_code not in GRIST_SQL_UNAVAILABLE_STATUSES:
+                raise
+            print(f"GRIST SQL endpoint not available, using record filters: {e}")
 
-    get_grist_directory_login().add_records('Delete', [{'Emails_to_delete': email} for email in data_list])
+    return query_ids_of_email_filter(api, table_id, values, column, chunk_size)
 
 
-def get_ids_of_email(table_id, emails_list):
+def get_ids_of_email(table_id, emails_list, lookup=None, email_column='email', chunk_size=500):
     """
     Return the ids of the rows of the email in the GRIST directory
 
     Args:
+        table_id (string) : name of the GRIST table to look into
         emails_list (list) : a list of strings, containing the emails to look for in df
+        lookup (string) : where the emails are filtered. By default 'index' for the email column of the
+        Contact table, 'sql' for the other tables
+            'index': in the normalized email index of the Contact table (case, spaces and duplicates are handled)
+            'sql': on GRIST, with its SQL endpoint (falls back to 'filter' if it is not available)
+            'filter': on GRIST, with the filter parameter of the records endpoint
+            'full': locally, after downloading the whole table
+        email_column (string) : name of the column holding the emails
+        chunk_size (int) : number of emails sent to GRIST per request
 
     Returns:
         list: A list of ids of the rows in df
 
     """
+    if lookup is None:
+        lookup = 'index' if (table_id, email_column) == ('Contact', 'email') else 'sql'
+    if lookup not in ('index', 'sql', 'filter', 'full'):
+        raise ValueError(f"lookup must be 'index', 'sql', 'filter' or 'full', not {lookup!r}")
+    if lookup == 'index' and (table_id, email_column) != ('Contact', 'email'):
+        raise ValueError("lookup='index' is only available for the email column of the Contact table")
+
     # Get the latest GRIST directory
     api_directory = get_grist_directory_login()
-    directory_df = api_directory.fetch_table(table_id)
-    directory_df = pl.DataFrame(pd.DataFrame(directory_df)[["id", "email"]])  # Using pandas bcs pl has an issue with list input from Grist
+
+    if not emails_list:
+        return []
+
+    if lookup == 'index':
+        index = get_contact_email_index()
+        ids = [row_id for email in dict.fromkeys(normalize_email(email) for email in emails_list)
+               for row_id in index.get(email, [])]
+        return sorted(ids)
+
+    if lookup != 'full':
+        records = lookup_records(api_directory, table_id, emails_list, email_column, chunk_size, lookup)
+        return [record['id'] for record in records]
+
+    directory_df = grist_columns_to_polars(api_directory.fetch_table_columns(table_id), {'id': 'Int64', email_column: 'String'})
 
     # Filter the emails
-    res = directory_df.filter(pl.col('email').is_in(emails_list))
+    res = directory_df.filter(pl.col(email_column).is_in(emails_list))
     res = pl.Series(res.select(pl.col('id'))).to_list()
 
     return res
 
 
-def delete_email_from_contact_table(file_path):
+def delete_email_from_contact_table(file_path, chunk_size=200, max_retries=5, backoff=1.0, lookup='index', types=('hard',)):
     """
-    Takes a txt file as input and delete the detected email from the Contacts table of Grist
+    Takes a txt file or a mailbox of replies as input and delete the detected email from the Contacts
+    table of Grist, in chunks, retrying on rate limits and server errors
 
     Args:
-        file_path (string): path to the txt file to extract emails from
+        file_path (string): path to the txt file or mailbox to extract emails from (see extract_emails_from_replies)
+        chunk_size (int): number of rows deleted per request
+        max_retries (int): maximum number of retries of a chunk
+        backoff (float): delay in seconds before the first retry
+        lookup (string): how emails are matched to rows, see get_ids_of_email. By default with the normalized
+        email index of the Contact table: the rows whose email only differs by case or spaces are deleted too.
+        'sql' only deletes the rows with exactly the extracted emails, filtered on GRIST
+        types (tuple of string): types of delivery failures whose emails are deleted, see extract_emails_from_replies
 
     Return:
-        None
+        list of per chunk results, see run_bulk_mutation
     """
-    emails_list = extract_emails_from_txt(file_path)
-    print(str(len(emails_list)) + ' emails extraits du fichier: ', emails_list)
-    print()
-    emails_id = get_ids_of_email('Contact', emails_list)
-    print(str(len(emails_id)) + ' emails trouvés dans la table Contact \n')
-    get_grist_directory_login().delete_records('Contact', emails_id)
-    print('Emails supprimés de la table Contact \n')
+    # Stages and counters are reported at the end, see instrumented_pipeline
+    with instrumented_pipeline('delete_email_from_contact_table'):
+        with pipeline_stage('extract_emails'):
+            emails_list = extract_emails_from_replies(file_path, types)
+            print(str(len(emails_list)) + ' emails extraits du fichier: ', emails_list)
+            print()
+        with pipeline_stage('lookup'):
+            emails_id = get_ids_of_email('Contact', emails_list, lookup=lookup)
+            print(str(len(emails_id)) + ' emails trouvés dans la table Contact \n')
+        with pipeline_stage('delete'):
+            summary = bulk_delete_records(get_grist_directory_login(), 'Contact', emails_id,
+                                          chunk_size=chunk_size, max_retries=max_retries, backoff=backoff)
+        print_bulk_summary(summary, 'supprimés de la table Contact')
+    return summary
 
 
 
@@ -642,55 +2978,284 @@ def clean_br_values_df(df):
     return df
 
 
-def fill_template(path_to_template, df, directory_output='ssphub_directory'):
+def hash_values(*values):
     """
-    Update the variables in a template QMD file with the ones from a data table.
+    Stable sha256 hash of json-serializable values (other values are turned into strings)
+
+    Example:
+        >>> hash_values({'my_yaml_title': 'Title'}, 'template')
+        '5b0c6d...'
+    """
+    serialized = json.dumps(values, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def load_build_manifest(manifest_path):
+    """
+    Load the build manifest recording, per page folder, the hashes of the inputs used to write it
 
     Args:
-        df (pandas object): data frame where to have the values. A column must be named 'nom_dossier'
-        qmd_file (str): The path to the template QMD file. Format 'my_folder/subfolder/template.qmd'
-        directory_output (str): A string to paste before nom_dossier. Default is ssphub_directory/nom_dossier/index.qmd'
+        manifest_path (string): path to the json manifest
+
+    Returns:
+        dict {'pages': {nom_dossier: {'page': hash of row and template, 'image': hash of the image}}}
+        Empty manifest if the file doesn't exist or can't be read
+    """
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {'pages': {}}
+    manifest.setdefault('pages', {})
+    return manifest
+
+
+def save_build_manifest(manifest, manifest_path):
+    """
+    Write the build manifest atomically
+
+    Args:
+        manifest (dict): see load_build_manifest
+        manifest_path (string): path to the json manifest
+    """
+    os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def find_orphan_pages(manifest, page_dirs):
+    """
+    List the page folders recorded in the manifest that don't match any page anymore
+
+    Args:
+        manifest (dict): see load_build_manifest
+        page_dirs (list): folders of the current pages, prefixed with the output directory
+
+    Returns:
+        sorted list of orphan folders
+    """
+    page_dirs = set(page_dirs)
+    return sorted(page_dir for page_dir in manifest['pages'] if page_dir not in page_dirs)
+
+
+def compile_template(path_to_template):
+    """
+    Read a template QMD file once and split it into literal text and {{placeholder}} segments
+
+    Args:
+        path_to_template (str): The path to the template QMD file. Format 'my_folder/subfolder/template.qmd'
+
+    Returns:
+        dict with keys
+            'parts': list alternating literal text (even indexes) and placeholder names (odd indexes)
+            'placeholders': list of the distinct placeholder names, in order of appearance
+            'hash': sha256 of the template content
+
+    Example:
+        >>> compile_template('ssphub_directory/template.qmd')['placeholders']
+        ['my_yaml_title', 'my_yaml_description', 'my_yaml_authors', ...]
+    """
+    with open(path_to_template, 'r') as file:
+        template_content = file.read()
+
+    parts = re.split(r'\{\{(\w+)\}\}', template_content)
+
+    return {
+        'parts': parts,
+        'placeholders': list(dict.fromkeys(parts[1::2])),
+        'hash': hashlib.sha256(template_content.encode('utf-8')).hexdigest()
+    }
+
+
+def check_template_columns(template, columns, strict=True):
+    """
+    Check that every placeholder of a compiled template has a column to take its value from
+
+    Args:
+        template (dict): result of compile_template
+        columns (list): column names of the data table
+        strict (boolean): raise an error if placeholders are missing. Otherwise a message is printed
+        and the placeholders are left as is in the output
+
+    Returns:
+        list of the placeholders without a column
+    """
+    columns = set(columns)
+    missing = [name for name in template['placeholders'] if name not in columns]
+    if missing and strict:
+        raise ValueError(f"Template placeholders without a matching column: {missing}")
+    if missing:
+        print(f"Template placeholders without a matching column, left as is: {missing}")
+    return missing
+
 
+def render_template(template, values):
     """
+    Render a compiled template in a single pass
 
-    # Add directory before the output folder in df
-    df['nom_dossier'] = directory_output.strip('/') + '/' + df['nom_dossier'].str.strip('/')
+    Args:
+        template (dict): result of compile_template
+        values (dict): {placeholder name: value}. Values are turned into strings
+
+    Returns:
+        (string) the rendered template
+
+    Example:
+        >>> render_template(compile_template('ssphub_directory/template.qmd'), {'my_yaml_title': 'My project', ...})
+    """
+    parts = template['parts']
+    rendered = parts[:]
+    for i in range(1, len(parts), 2):
+        name = parts[i]
+        rendered[i] = str(values[name]) if name in values else '{{' + name + '}}'
+    return ''.join(rendered)
+
+
+def render_template_batch(template, df):
+    """
+    Render a compiled template for every row of a data table
+
+    Args:
+        template (dict): result of compile_template
+        df (pd.DataFrame): data frame whose columns are named after the placeholders
+
+    Returns:
+        list of rendered strings, one per row in the order of df
+    """
+    return [render_template(template, row) for row in df.to_dict(orient='records')]
+
+
+def write_page(template, row, previous_page_hash=None):
+    """
+    Render one row of a compiled template to nom_dossier/index.qmd. Nothing is written
+    if the inputs of the page or its content didn't change
+
+    Args:
+        template (dict): result of compile_template
+        row (dict): values of the row, with the 'nom_dossier' key
+        previous_page_hash (string or None): hash of the inputs of the page at the last build
+
+    Returns:
+        tuple with the status ('written', 'unchanged' or 'skipped' when the inputs didn't change),
+        the hash of the inputs of the page and the rendered content (None if skipped)
+    """
+    output_dir = row['nom_dossier']
+    output_file_path = output_dir + '/index.qmd'
+
+    # Skipping pages whose inputs didn't change since last build
+    page_hash = hash_values(row, template['hash'])
+    if previous_page_hash == page_hash and os.path.isfile(output_file_path):
+        return 'skipped', page_hash, None
+
+    template_content = render_template(template, row)
 
-    for index, row in df.iterrows():
+    # Create the output directory if it doesn't exist
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Write the file only if its content changed
+    if os.path.isfile(output_file_path):
+        with open(output_file_path, 'r') as old_file:
+            if old_file.read() == template_content:
+                return 'unchanged', page_hash, template_content
+
+    with open(output_file_path, 'w') as res_file:
+        res_file.write(template_content)
+    count_metric('files_written')
+
+    return 'written', page_hash, template_content
 
-        with open(path_to_template, 'r') as file:
-            template_content = file.read()
 
-        for column in df.columns:
-            variable_name = column
-            variable_value = row[column]
-            template_content = template_content.replace('{{' + variable_name + '}}', str(variable_value))
+def with_page_dirs(df, directory_output):
+    """
+    Copy of a data table whose folders nom_dossier are put inside directory_output
+
+    Example:
+        >>> with_page_dirs(pd.DataFrame({'nom_dossier': ['/a/']}), 'project/')['nom_dossier'].tolist()
+        ['project/a']
+    """
+    return df.assign(nom_dossier=directory_output.rstrip('/') + '/' + df['nom_dossier'].str.strip('/'))
+
 
-        # Create the output directory if it doesn't exist
-        os.makedirs(df.at[index, 'nom_dossier'], exist_ok=True)
+def fill_template(path_to_template, df, directory_output='ssphub_directory', strict=False, manifest=None, max_workers=1,
+                  return_failures=False):
+    """
+    Update the variables in a template QMD file with the ones from a data table.
+    The template is read and parsed once, then every row is rendered in a single pass.
+    A page whose content didn't change is left untouched, so its modification time is kept.
 
-        output_file_path = df.at[index, 'nom_dossier'] + '/index.qmd'
+    Args:
+        df (pandas object): data frame where to have the values. A column must be named 'nom_dossier'
+        qmd_file (str): The path to the template QMD file. Format 'my_folder/subfolder/template.qmd'
+        directory_output (str): A string to paste before nom_dossier. Default is ssphub_directory/nom_dossier/index.qmd'
+        strict (boolean): raise an error if a placeholder of the template has no column in df
+        manifest (dict or None): build manifest (see load_build_manifest). Pages whose row and template
+        hashes are recorded are skipped without rendering. The manifest is updated in place
+        max_workers (int): number of pages rendered and written at the same time. Messages and the
+        manifest are still handled in the order of df
+        return_failures (boolean): also return the pages that could not be written
 
-        # Remove the file and write it
-        remove_files_dir(output_file_path)
-        with open(output_file_path, 'w') as res_file:
-            res_file.write(template_content)
+    Returns:
+        The content of the last page rendered. An error on one page is printed and doesn't stop the others.
+        With return_failures, a tuple (content of the last page, dict {path of the page: error})
+    """
+    template = compile_template(path_to_template)
+    check_template_columns(template, df.columns, strict=strict)
+
+    # Add directory before the output folder, on a copy: df is left as is
+    df = with_page_dirs(df, directory_output)
+
+    rows = df.to_dict(orient='records')
+    previous_hashes = [None] * len(rows)
+    if manifest is not None:
+        previous_hashes = [manifest['pages'].get(row['nom_dossier'], {}).get('page') for row in rows]
+
+    def write_one(row_and_hash):
+        # Errors are caught here so that one page cannot stop the others
+        try:
+            return write_page(template, *row_and_hash), None
+        except Exception as e:
+            return None, e
+
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(write_one, zip(rows, previous_hashes)))
+    else:
+        results = [write_one(row_and_hash) for row_and_hash in zip(rows, previous_hashes)]
+
+    template_content = None
+    errors = {}
+    for row, (result, error) in zip(rows, results):
+        output_file_path = row['nom_dossier'] + '/index.qmd'
+        if error is not None:
+            errors[output_file_path] = error
+            print(f'Error writing {output_file_path}: {error}')
+            continue
+
+        status, page_hash, content = result
+        if status == 'written':
+            print(f'File written at {output_file_path}')
+        else:
+            print(f'File unchanged at {output_file_path}')
+        if content is not None:
+            template_content = content
+        if manifest is not None:
+            manifest['pages'].setdefault(row['nom_dossier'], {})['page'] = page_hash
 
-        print(f'File written at {output_file_path}')
+    if errors:
+        print(f'{len(errors)} pages could not be written')
 
+    if return_failures:
+        return template_content, errors
     return template_content
 
 
 def get_grist_merge_website_login():
     # Log in to GRIST API
-    SERVER = "https://grist.numerique.gouv.fr/"
     DOC_ID = os.environ['GRIST_SSPHUB_WEBSITE_MERGE_ID']
 
-    if 'GRIST_API_KEY' not in os.environ:
-        raise ValueError("The GRIST_API_KEY environment variable does not exist.")
-
     # Returning API details connection
-    return GristDocAPI(DOC_ID, server=SERVER)
+    return get_grist_client(DOC_ID)
 
 
 def get_grist_merge_as_df():
@@ -711,16 +3276,15 @@ def get_grist_merge_as_df():
     """
     # fetch all the rows
     api_merge = get_grist_merge_website_login()
-    new_website_df = api_merge.fetch_table('Intranet_details')
-    # Pb with attachment column with polars, so pass by pandas
-    new_website_df = pd.DataFrame(new_website_df)
+    columns = api_merge.fetch_table_columns('Intranet_details')
 
-    # Selecting useful columns
-    cols_to_keep = ['id', 'Acteurs', 'Resultats', 'Details_du_projet',
-       'sous_titre', 'Code_du_projet', 'tags', 'nom_dossier', 'date',
-       'image', 'Titre', 'auteurs', 'to_update']
+    # Selecting useful columns, typed with the schema of the table. 'tags', 'date' and 'image' are
+    # written in the pages as GRIST sends them
+    pages_df = grist_columns_to_polars(columns, GRIST_TABLE_SCHEMAS['Intranet_details'])
 
-    new_website_df = new_website_df[cols_to_keep]
+    # The pages are written with pandas (see fill_template). The columns kept as sent get the types
+    # pandas infers, as when the table was read with pandas
+    new_website_df = pages_df.to_pandas().infer_objects()
 
     # Dictionnary for renaming variables / Right part must correspond to template keywords
     variable_mapping = {
@@ -758,7 +3322,7 @@ def get_grist_attachments_config():
         >>> get_grist_attachments_config()
         ('https://grist.numerique.gouv.fr/api/docs/SSPHUB_WEBSITE_MERGE_ID/attachments/archive', {'Authorization': 'Bearer GRIST_API_KEY'})
     """
-    url = f'https://grist.numerique.gouv.fr/api/docs/{os.environ['GRIST_SSPHUB_WEBSITE_MERGE_ID']}/attachments/archive'
+    url = f'{get_grist_server()}/api/docs/{os.environ['GRIST_SSPHUB_WEBSITE_MERGE_ID']}/attachments/archive'
     headers = {
         'Authorization': f'Bearer {os.environ['GRIST_API_KEY']}'
     }
@@ -766,67 +3330,292 @@ def get_grist_attachments_config():
     return url, headers
 
 
-def fill_all_templates_from_grist(path_to_template='ssphub_directory/template.qmd', directory='ssphub_directory'):
+def needed_attachments(pages_df):
+    """
+    List the images needed by the pages to update, and where they must be written
+
+    Args:
+        pages_df (pd.DataFrame): pages to update, with 'nom_dossier' (already prefixed with the output directory)
+        and 'my_yaml_image_path' columns
+
+    Returns:
+        dict {image file name: list of destination paths}
+
+    Example:
+        >>> needed_attachments(pd.DataFrame({'nom_dossier': ['project/a'], 'my_yaml_image_path': ['logo.png']}))
+        {'logo.png': ['project/a/logo.png']}
+    """
+    needed = {}
+    for nom_dossier, image in zip(pages_df['nom_dossier'], pages_df['my_yaml_image_path']):
+        if isinstance(image, str) and image.strip() != '':
+            needed.setdefault(image, []).append(nom_dossier + '/' + image)
+    return needed
+
+
+def archive_member_short_name(member_name):
+    """
+    Name of the original file of a member of the GRIST attachments archive,
+    whose members are prefixed with a 40 characters identifier and '_'
+
+    Example:
+        >>> archive_member_short_name('0123456789012345678901234567890123456789_logo.png')
+        'logo.png'
+    """
+    return os.path.basename(member_name)[41:]
+
+
+def extract_needed_attachments(zip_file_path, pages_df, chunk_size=1024 * 1024, manifest=None):
+    """
+    Stream only the archive members needed by the pages to update straight to their page folder,
+    without extracting the whole archive
+
+    Args:
+        zip_file_path (string): path to the GRIST attachments archive
+        pages_df (pd.DataFrame): pages to update, see needed_attachments
+        chunk_size (int): size in bytes of the chunks copied to disk
+        manifest (dict or None): build manifest (see load_build_manifest). Images whose CRC is recorded
+        for the page are not written again. The manifest is updated in place
+
+    Returns:
+        list of the written image paths
+    """
+    needed = needed_attachments(pages_df)
+    written = []
+
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            short_name = archive_member_short_name(member.filename)
+            if member.is_dir() or short_name not in needed:
+                continue
+            image_hash = hash_values(short_name, member.CRC, member.file_size)
+            for dest_image_path in needed.pop(short_name):
+                page_dir = os.path.dirname(dest_image_path)
+                if image_unchanged(manifest, page_dir, image_hash, dest_image_path):
+                    print(f'File unchanged at {dest_image_path}')
+                    continue
+                os.makedirs(page_dir or '.', exist_ok=True)
+                with zip_ref.open(member) as source, open(dest_image_path, 'wb') as dest:
+                    shutil.copyfileobj(source, dest, chunk_size)
+                count_metric('files_written')
+                if manifest is not None:
+                    manifest['pages'].setdefault(page_dir, {})['image'] = image_hash
+                written.append(dest_image_path)
+                print(f'File {member.filename} == extracted to ==> {dest_image_path}')
+
+    for image in needed:
+        print(f'Image {image} not found in the GRIST attachments')
+
+    return written
+
+
+def list_grist_attachments(attachments_url=None, headers=None):
+    """
+    List the metadata of the attachments of the GRIST website merge document
+
+    Args:
+        attachments_url (string): url of the attachments endpoint. Default is built from get_grist_attachments_config
+        headers (dict): headers of the API call. Default from get_grist_attachments_config
+
+    Returns:
+        list of dicts with at least 'id' and 'fileName' keys
+
+    Example:
+        >>> list_grist_attachments()
+        [{'id': 1, 'fileName': 'logo.png', 'fileSize': 12045, ...}, ...]
+    """
+    if attachments_url is None or headers is None:
+        archive_url, config_headers = get_grist_attachments_config()
+        attachments_url = attachments_url or archive_url.removesuffix('/archive')
+        headers = headers or config_headers
+
+    response = requests.get(attachments_url, headers=headers)
+    count_metric('http_calls')
+    response.raise_for_status()
+    count_metric('bytes_downloaded', len(response.content))
+
+    return [{'id': record['id'], **record['fields']} for record in response.json()['records']]
+
+
+def image_unchanged(manifest, page_dir, image_hash, dest_image_path):
+    """
+    Tell if the image recorded in the build manifest for a page is the same and still on disk
+
+    Args:
+        manifest (dict or None): see load_build_manifest
+        page_dir (string): folder of the page
+        image_hash (string): hash identifying the image to write
+        dest_image_path (string): path of the image in the page folder
+
+    Returns:
+        boolean
+    """
+    if manifest is None:
+        return False
+    return (manifest['pages'].get(page_dir, {}).get('image') == image_hash
+            and os.path.isfile(dest_image_path))
+
+
+def fetch_needed_attachments(pages_df, max_workers=8, attachments_url=None, headers=None, manifest=None):
+    """
+    Download only the attachments needed by the pages to update, concurrently, through the per-attachment
+    GRIST endpoint, and write them to their page folder
+
+    Args:
+        pages_df (pd.DataFrame): pages to update, see needed_attachments
+        max_workers (int): number of attachments downloaded at the same time
+        attachments_url (string): url of the attachments endpoint. Default is built from get_grist_attachments_config
+        headers (dict): headers of the API call. Default from get_grist_attachments_config
+        manifest (dict or None): build manifest (see load_build_manifest). Images whose GRIST metadata is
+        recorded for the page are not downloaded again. The manifest is updated in place
+
+    Returns:
+        list of the written image paths
+    """
+    if attachments_url is None or headers is None:
+        archive_url, config_headers = get_grist_attachments_config()
+        attachments_url = attachments_url or archive_url.removesuffix('/archive')
+        headers = headers or config_headers
+
+    needed = needed_attachments(pages_df)
+    if not needed:
+        return []
+
+    # Latest upload wins when several attachments have the same name
+    attachments = {}
+    for attachment in sorted(list_grist_attachments(attachments_url, headers), key=lambda a: a['id']):
+        attachments[attachment['fileName']] = attachment
+
+    tasks = []
+    for image, dest_image_paths in needed.items():
+        if image not in attachments:
+            print(f'Image {image} not found in the GRIST attachments')
+            continue
+        image_hash = hash_values(attachments[image])
+        dest_image_paths = [dest_image_path for dest_image_path in dest_image_paths
+                            if not image_unchanged(manifest, os.path.dirname(dest_image_path), image_hash, dest_image_path)]
+        if not dest_image_paths:
+            print(f'Image {image} unchanged')
+            continue
+        tasks.append((f"{attachments_url}/{attachments[image]['id']}/download", dest_image_paths, image_hash))
+
+    if not tasks:
+        return []
+
+    session = get_http_session(pool_size=max_workers)
+
+    def fetch_one(task):
+        url, dest_image_paths, image_hash = task
+        first_dest = dest_image_paths[0]
+        file_name = download_file(url, os.path.dirname(first_dest) or '.', headers=headers, session=session, use_cache=False)
+        if file_name is None:
+            return []
+        # The endpoint names the file from its Content-Disposition header: put it at the expected path
+        os.replace(os.path.join(os.path.dirname(first_dest) or '.', file_name), first_dest)
+        for dest_image_path in dest_image_paths[1:]:
+            os.makedirs(os.path.dirname(dest_image_path) or '.', exist_ok=True)
+            shutil.copyfile(first_dest, dest_image_path)
+            count_metric('files_written')
+        return dest_image_paths
+
+    with session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(fetch_one, tasks))
+
+    if manifest is not None:
+        for (url, dest_image_paths, image_hash), written in zip(tasks, results):
+            for dest_image_path in written:
+                manifest['pages'].setdefault(os.path.dirname(dest_image_path), {})['image'] = image_hash
+
+    return [path for paths in results for path in paths]
+
+
+def fill_all_templates_from_grist(path_to_template='ssphub_directory/template.qmd',
+    directory='ssphub_directory',
+    attachments_mode='selective',
+    max_workers=8,
+    incremental=True):
     """
     Fetch information from GRIST to create index.qmd and download the image data, move it to the right folder
 
     Arg:
         path_to_template (string): the path of the template to use
         directory (string): the root directory where to save the files
+        attachments_mode (string): 'selective' to download only the images of the pages to update,
+        'archive' to download the whole GRIST attachments archive and extract only the needed images
+        max_workers (int): number of pages written and images downloaded at the same time
+        incremental (boolean): keep a build manifest in directory/.build_manifest.json and only write
+        the pages and images whose inputs changed. Pages of the manifest no longer in GRIST are reported
 
     Returns:
-        None
+        list of orphan page folders (recorded in the manifest but no longer in GRIST).
+        A ValueError is raised at the end if some pages could not be written, once the others are done
 
     Example:
         >>> fill_all_templates_from_grist()
     """
-    # Storing info from GRIST
-    pages_df = get_grist_merge_as_df()
-
-    # Cleaning breaks
-    pages_df = clean_br_values_df(pages_df)
-
-    # Droping rows with empty nom_dossier and keeping only the one to_update
-    pages_df = pages_df.query('nom_dossier != "" and to_update == True ')
-
-    # Create the index.qmd by calling the function
-    fill_template(path_to_template, pages_df, directory_output=directory)
-
-    # Download all attachments in GRIST
-    # URL set up
-    url = get_grist_attachments_config()[0]
-    headers = get_grist_attachments_config()[1]
-    # Destination directory
-    temp_dir = '.temp/'
-    # Download attachment and store zip file name
-    grist_attach_filename = download_file(url, output_dir=temp_dir, headers=headers)
-
-    # Unzip attachment file archive
-    unzip_dir_path = temp_dir + 'extracted_data'
-    unzip_dir(temp_dir + grist_attach_filename, unzip_dir_path)
-
-    # List all images downloaded
-    attachments_list = os.listdir(unzip_dir_path)
-
-    # Merging with GRIST data to have destination folder defined in GRIST
-    # Creating an intermediate dict
-    attachments_dict = {}
-    attachments_dict['short_image_name'] = [image[41:] for image in attachments_list]
-    attachments_dict['local_image_path'] = [unzip_dir_path + '/' + image for image in attachments_list]
-    # Selecting the two useful columns
-    pages_df = pages_df[['nom_dossier', 'my_yaml_image_path']]
-    # Merging the two
-    pages_df = pages_df.merge(pd.DataFrame.from_dict(attachments_dict), how='left', left_on='my_yaml_image_path', right_on='short_image_name')
-    # Creating destination file
-    pages_df['dest_image_path'] = pages_df['nom_dossier'] + '/' + pages_df['my_yaml_image_path']
-    pages_df.dropna(subset='local_image_path', inplace=True)  # Droping files where didn't download image
-    # Moving all images to their folder
-    for index, row in pages_df.iterrows():
-        os.rename(row['local_image_path'], row['dest_image_path'])
-        print(f'File {row['local_image_path']} == moved to ==> {row['dest_image_path']}')
-
-    # Cleaning intermediate data
-    remove_files_dir(unzip_dir_path, temp_dir+grist_attach_filename)
+    if attachments_mode not in ('selective', 'archive'):
+        raise ValueError(f"attachments_mode must be 'selective' or 'archive', not {attachments_mode!r}")
+
+    # Stages and counters are reported at the end, see instrumented_pipeline
+    with instrumented_pipeline('fill_all_templates_from_grist'):
+        with pipeline_stage('grist_fetch'):
+            # Storing info from GRIST
+            pages_df = get_grist_merge_as_df()
+
+            # Cleaning breaks
+            pages_df = clean_br_values_df(pages_df)
+
+            # Droping rows with empty nom_dossier
+            pages_df = pages_df.query('nom_dossier != ""')
+            all_page_dirs = with_page_dirs(pages_df, directory)['nom_dossier'].tolist()
+
+            # Keeping only the one to_update
+            pages_df = pages_df.query('to_update == True')
+
+        with pipeline_stage('write_pages'):
+            # Loading the previous build
+            manifest_path = os.path.join(directory, BUILD_MANIFEST_FILE)
+            manifest = load_build_manifest(manifest_path) if incremental else None
+
+            # Create the index.qmd by calling the function
+            _, failures = fill_template(path_to_template, pages_df, directory_output=directory, manifest=manifest,
+                                        max_workers=max_workers, return_failures=True)
+            pages_df = with_page_dirs(pages_df, directory)
+
+        # Putting the images of the updated pages in their folder
+        with pipeline_stage('attachments'):
+            if attachments_mode == 'selective':
+                fetch_needed_attachments(pages_df, max_workers=max_workers, manifest=manifest)
+            else:
+                # Download all attachments in GRIST
+                url, headers = get_grist_attachments_config()
+                # Destination directory
+                temp_dir = '.temp/'
+                # Download attachment and store zip file name. The archive is used once: no copy in the HTTP cache
+                grist_attach_filename = download_file(url, output_dir=temp_dir, headers=headers, use_cache=False)
+
+                if grist_attach_filename is None:
+                    print('GRIST attachments archive not downloaded: the images of the pages were not updated')
+                else:
+                    # Extracting only the images needed to their folder
+                    extract_needed_attachments(temp_dir + grist_attach_filename, pages_df, manifest=manifest)
+
+                    # Cleaning intermediate data
+                    remove_files_dir(temp_dir + grist_attach_filename)
+
+        orphans = []
+        if manifest is not None:
+            with pipeline_stage('manifest'):
+                # Reporting pages that don't exist in GRIST anymore
+                orphans = find_orphan_pages(manifest, all_page_dirs)
+                for orphan in orphans:
+                    print(f'Page {orphan} is no longer in GRIST')
+
+                save_build_manifest(manifest, manifest_path)
+
+    if failures:
+        raise ValueError(f"{len(failures)} pages could not be written: {', '.join(failures)}")
+
+    return orphans
 
 
 def remove_files_dir(*file_paths):
@@ -5,7 +5,7 @@ import os
 
 # To generate email
 newsletter_nb = 20
-## Validation
+## Validation, from the branch of the newsletter (not published yet)
 my_f.generate_email(
     newsletter_nb,
     'newsletter_'+str(newsletter_nb),
@@ -14,8 +14,8 @@ my_f.generate_email(
     email_bcc='',
     email_from=None,
     email_cc=os.environ['EMAIL_VALIDATION_CC']+";"+os.environ['EMAIL_SSPHUB'])
-## Send to all
-my_f.generate_email(newsletter_nb, 'main', 'Infolettre de rentrée', get_emails())
+## Send to all, once the newsletter is published on main
+my_f.generate_email(newsletter_nb, 'main', 'Infolettre de rentrée', os.environ['EMAIL_SSPHUB'], my_f.get_emails())
 
 ## Treat replies
 my_f.add_to_grist_delete_table(my_f.extract_emails_from_txt(file_path='ssphub_directory/test/replies.txt'))
@@ -1,5 +1,25 @@
 from ssphub_directory.my_functions import *
 import time  # for pausing code execution
+import threading  # to run local stand-ins of the web services
+import http.server  # local stand-ins of GitHub / Grist
+import functools
+import pytest
+import urllib.parse
+from ssphub_directory.tests.stand_ins import QuietHandler, GristStandIn
+from ssphub_directory.grist_client import PooledGristDocAPI
+
+
+def serve_directory(directory):
+    """
+    Serve a local directory over HTTP in a background thread, as a stand-in for GitHub raw files
+
+    Returns:
+        tuple with the server (to shut down) and its base url
+    """
+    handler = functools.partial(QuietHandler, directory=str(directory))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
 
 def test_generate_email():
     generate_email(19, 'main', 'Infolettre de rentrée', 'my_to_email@insee.fr', get_emails())
@@ -106,3 +126,824 @@ def test_global():
 
     fill_all_templates_from_grist(directory='ssphub_directory/test')
     generate_email(19, 'main', 'Infolettre de rentrée', 'my_to_email@insee.fr', get_emails())
+
+
+def test_download_files_concurrently(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    for i in range(5):
+        (source / f'image_{i}.png').write_bytes(bytes([i]) * 100)
+    server, base_url = serve_directory(source)
+
+    urls = [base_url + f'image_{i}.png' for i in range(5)] + [base_url + 'missing.png']
+    files, failures = download_files_concurrently(urls, output_dir=str(tmp_path / 'out'), max_workers=3)
+    server.shutdown()
+
+    assert files == [f'image_{i}.png' for i in range(5)]
+    assert list(failures) == [base_url + 'missing.png'] and '404' in failures[base_url + 'missing.png']
+    assert (tmp_path / 'out' / 'image_3.png').read_bytes() == bytes([3]) * 100
+    # The HTTP cache is kept in the cache folder of the test (see conftest.py), not in the working directory
+    assert len(os.listdir(tmp_path / '.cache' / HTTP_CACHE_DIR)) == 10 and not os.path.exists('.cache')
+
+
+def test_http_cache_revalidation(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'index.qmd').write_text('---\ntitle: test\n---\nbody')
+    (source / 'big.png').write_bytes(b'x' * 1000)
+    server, base_url = serve_directory(source)
+    cache_dir = str(tmp_path / 'cache')
+
+    statuses = []
+    session = requests.Session()
+    session.hooks['response'].append(lambda response, *args, **kwargs: statuses.append(response.status_code))
+
+    first = cached_get(base_url + 'index.qmd', session=session, cache_dir=cache_dir)
+    second = cached_get(base_url + 'index.qmd', session=session, cache_dir=cache_dir)
+    bypass = cached_get(base_url + 'index.qmd', session=session, cache_dir=cache_dir, use_cache=False)
+    assert first.text == second.text == bypass.text
+    assert statuses == [200, 304, 200]
+
+    # The least recently used entry is evicted when the cache is full
+    cached_get(base_url + 'big.png', session=session, cache_dir=cache_dir, max_bytes=1000)
+    server.shutdown()
+    assert http_cache_lookup(base_url + 'index.qmd', cache_dir=cache_dir) is None
+    assert http_cache_lookup(base_url + 'big.png', cache_dir=cache_dir) is not None
+
+
+class RangeHandler(QuietHandler):
+    """Serve one payload with a strong ETag and Range / If-Range support"""
+    payload = bytes(range(256)) * 400
+    etag = '"v1"'
+    ranges_seen = []
+
+    def do_GET(self):
+        start = 0
+        if 'Range' in self.headers and self.headers.get('If-Range') == self.etag:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.ranges_seen.append(start)
+        body = self.payload[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Disposition', 'attachment; filename="my archive.zip"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_stream_download_resume_and_checksum(tmp_path):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/archive'
+    expected = hashlib.sha256(RangeHandler.payload).hexdigest()
+
+    # Simulate an interrupted download: half of the file is already on disk
+    url_digest = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+    part_path = tmp_path / f'.{url_digest}.part'
+    part_path.write_bytes(RangeHandler.payload[:50000])
+    (tmp_path / f'.{url_digest}.part.validator').write_text(RangeHandler.etag)
+
+    file_name, digest = stream_download(url, str(tmp_path), use_cache=False, expected_checksum=expected, chunk_size=4096)
+    assert file_name == 'my_archive.zip'
+    assert digest == expected
+    assert RangeHandler.ranges_seen == [50000]
+    assert (tmp_path / 'my_archive.zip').read_bytes() == RangeHandler.payload
+    assert not part_path.exists()
+
+    # A wrong checksum discards the file
+    assert download_file(url, str(tmp_path / 'bad'), use_cache=False, expected_checksum='0' * 64) is None
+    server.shutdown()
+    assert os.listdir(tmp_path / 'bad') == []
+
+
+def test_extract_needed_attachments(tmp_path):
+    archive_path = tmp_path / 'attachments.zip'
+    with zipfile.ZipFile(archive_path, 'w') as zip_ref:
+        zip_ref.writestr('a' * 40 + '_logo.png', b'logo')
+        zip_ref.writestr('b' * 40 + '_other.png', b'other')
+    pages_df = pd.DataFrame({
+        'nom_dossier': [str(tmp_path / 'project/a'), str(tmp_path / 'project/b')],
+        'my_yaml_image_path': ['logo.png', '']
+    })
+
+    written = extract_needed_attachments(str(archive_path), pages_df)
+
+    assert written == [str(tmp_path / 'project/a/logo.png')]
+    assert (tmp_path / 'project/a/logo.png').read_bytes() == b'logo'
+    assert not (tmp_path / 'project/b').exists()
+
+
+class GristAttachmentsHandler(QuietHandler):
+    """Stand-in for the GRIST attachments endpoints"""
+    files = {1: ('logo.png', b'old logo'), 2: ('logo.png', b'new logo'), 3: ('other.png', b'other')}
+    downloaded = []
+
+    def do_GET(self):
+        if self.path == '/attachments':
+            records = [{'id': i, 'fields': {'fileName': name}} for i, (name, _) in self.files.items()]
+            body = json.dumps({'records': records}).encode('utf-8')
+        else:
+            attachment_id = int(self.path.split('/')[2])
+            self.downloaded.append(attachment_id)
+            body = self.files[attachment_id][1]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_fetch_needed_attachments(tmp_path):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), GristAttachmentsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/attachments'
+    pages_df = pd.DataFrame({
+        'nom_dossier': [str(tmp_path / 'a'), str(tmp_path / 'b')],
+        'my_yaml_image_path': ['logo.png', 'logo.png']
+    })
+
+    written = fetch_needed_attachments(pages_df, attachments_url=url, headers={})
+    server.shutdown()
+
+    assert sorted(written) == [str(tmp_path / 'a/logo.png'), str(tmp_path / 'b/logo.png')]
+    assert GristAttachmentsHandler.downloaded == [2]
+    assert (tmp_path / 'b/logo.png').read_bytes() == b'new logo'
+
+
+def test_compiled_template(tmp_path):
+    template_path = tmp_path / 'template.qmd'
+    template_path.write_text('title: "{{my_yaml_title}}"\n{{my_table_details}} / {{my_yaml_title}} {{unknown}}')
+    template = compile_template(str(template_path))
+    df = pd.DataFrame({'my_yaml_title': ['A {{my_table_details}}', 'B'], 'my_table_details': ['x', 2]})
+
+    assert template['placeholders'] == ['my_yaml_title', 'my_table_details', 'unknown']
+    assert check_template_columns(template, df.columns, strict=False) == ['unknown']
+    with pytest.raises(ValueError):
+        check_template_columns(template, df.columns)
+    # Values are inserted in one pass: a placeholder inside a value isn't replaced
+    assert render_template_batch(template, df) == [
+        'title: "A {{my_table_details}}"\nx / A {{my_table_details}} {{unknown}}',
+        'title: "B"\n2 / B {{unknown}}'
+    ]
+
+
+def test_fill_template_incremental(tmp_path):
+    template_path = tmp_path / 'template.qmd'
+    template_path.write_text('title: "{{my_yaml_title}}"')
+    manifest = load_build_manifest(str(tmp_path / BUILD_MANIFEST_FILE))
+
+    def pages(titles):
+        return pd.DataFrame({'my_yaml_title': titles, 'nom_dossier': ['a', 'b']})
+
+    fill_template(str(template_path), pages(['A', 'B']), str(tmp_path), manifest=manifest)
+    page_a, page_b = tmp_path / 'a/index.qmd', tmp_path / 'b/index.qmd'
+    os.utime(page_a, (0, 0))
+    os.utime(page_b, (0, 0))
+
+    # Only the page whose row changed is written again
+    fill_template(str(template_path), pages(['A', 'B2']), str(tmp_path), manifest=manifest)
+    assert page_a.stat().st_mtime == 0
+    assert page_b.stat().st_mtime != 0
+    assert page_b.read_text() == 'title: "B2"'
+
+    save_build_manifest(manifest, str(tmp_path / BUILD_MANIFEST_FILE))
+    manifest = load_build_manifest(str(tmp_path / BUILD_MANIFEST_FILE))
+    assert find_orphan_pages(manifest, [str(tmp_path / 'a')]) == [str(tmp_path / 'b')]
+
+
+def test_fill_template_parallel(tmp_path):
+    template_path = tmp_path / 'template.qmd'
+    template_path.write_text('{{my_yaml_title}}')
+    (tmp_path / 'blocked').write_text('a file where a folder is expected')
+    df = pd.DataFrame({
+        'my_yaml_title': [f'page {i}' for i in range(20)] + ['error'],
+        'nom_dossier': [f'page_{i}' for i in range(20)] + ['blocked']
+    })
+
+    last_content, failures = fill_template(str(template_path), df, str(tmp_path), max_workers=4, return_failures=True)
+
+    assert last_content == 'page 19'
+    assert all((tmp_path / f'page_{i}/index.qmd').read_text() == f'page {i}' for i in range(20))
+    # The page that could not be written is reported with its error, the data frame of the caller is left as is
+    assert list(failures) == [f'{tmp_path}/blocked/index.qmd'] and isinstance(failures[f'{tmp_path}/blocked/index.qmd'], OSError)
+    assert df['nom_dossier'].iloc[-1] == 'blocked'
+    assert fill_template(str(template_path), df, str(tmp_path)) == 'page 19'
+
+
+def test_pooled_grist_client_snapshots(grist_stand_in, monkeypatch):
+    url = grist_stand_in({
+        'Contact': {'id': [1, 2, 3], 'email': ['a@x.fr', 'b@x.fr', 'c@x.fr']},
+        'Delete': {'id': [], 'Emails_to_delete': []}
+    })
+
+    api = get_grist_directory_login()
+    assert api is get_grist_directory_login()
+    assert len(api.fetch_table('Contact')) == 3
+    assert len(api.fetch_table('Contact')) == 3
+    assert GristStandIn.requests_log.count(('GET', '/api/docs/doc/tables/Contact/data')) == 1
+
+    # Our own write invalidates the snapshot of the table
+    api.delete_records('Contact', [2])
+    assert [record.email for record in api.fetch_table('Contact')] == ['a@x.fr', 'c@x.fr']
+    assert GristStandIn.requests_log.count(('GET', '/api/docs/doc/tables/Contact/data')) == 2
+
+    # SQLITE_BUSY is retried a bounded number of times
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    GristStandIn.fail_next = [(500, 'SQLITE_BUSY: database is locked')] * 2
+    api.delete_records('Contact', [3])
+    assert GristStandIn.fail_next == [] and GristStandIn.tables['Contact']['id'] == [1]
+    GristStandIn.fail_next = [(500, 'SQLITE_BUSY: database is locked')] * (GRIST_BUSY_RETRIES + 1)
+    with pytest.raises(requests.HTTPError, match='SQLITE_BUSY'):
+        api.delete_records('Contact', [1])
+    GristStandIn.fail_next = []
+
+    # A dry run sends no write, but still reads with the SQL endpoint
+    dry_api = PooledGristDocAPI('doc', api_key='key', server=url, dryrun=True)
+    assert dry_api.call('apply', [['BulkRemoveRecord', 'Contact', [1]]]) is None
+    assert run_grist_sql(dry_api, 'SELECT id FROM Contact') == [{'id': 1}]
+    assert GristStandIn.tables['Contact']['id'] == [1]
+
+
+def test_get_ids_of_email_on_grist(grist_stand_in):
+    grist_stand_in({
+        'Contact': {'id': [1, 2, 3, 4], 'email': ['a@x.fr', 'b@x.fr', 'c@x.fr', 'd@x.fr'],
+                    'tags': [['L', 'a'], ['L'], ['L'], ['L', 'b']]}
+    })
+    emails = ['d@x.fr', 'b@x.fr', 'unknown@x.fr']
+
+    assert get_ids_of_email('Contact', emails, lookup='sql', chunk_size=2) == [2, 4]
+    assert get_ids_of_email('Contact', emails, lookup='filter', chunk_size=2) == [2, 4]
+    assert get_ids_of_email('Contact', emails, lookup='full') == [2, 4]
+    # Two SQL batches, no download of the whole table for the server-side lookups
+    assert GristStandIn.requests_log.count(('POST', '/api/docs/doc/sql')) == 2
+    assert GristStandIn.requests_log.count(('GET', '/api/docs/doc/tables/Contact/data')) == 1
+
+    # A GRIST without the SQL endpoint: record filters are used instead
+    GristStandIn.fail_sql = [404]
+    assert get_ids_of_email('Contact', emails, lookup='sql') == [2, 4]
+    # A rate limit is not hidden by the fallback
+    GristStandIn.fail_sql = [429]
+    with pytest.raises(requests.exceptions.HTTPError):
+        get_ids_of_email('Contact', emails, lookup='sql')
+
+
+def test_bulk_mutations_retry_and_replay(grist_stand_in, tmp_path):
+    grist_stand_in({
+        'Contact': {'id': [1, 2, 3, 4, 5], 'email': ['a@x.fr', 'b@x.fr', 'c@x.fr', 'd@x.fr', 'e@x.fr']},
+        'Delete': {'id': [1], 'Emails_to_delete': ['a@x.fr']}
+    })
+
+    # A rate limit then a server error on the first chunk: it is retried
+    GristStandIn.fail_next = [429, 503]
+    summary = add_to_grist_delete_table(['a@x.fr', 'b@x.fr', 'c@x.fr', 'b@x.fr'], chunk_size=2, backoff=0)
+    assert [(r['applied'], r['skipped'], r['attempts'], r['status']) for r in summary] == [(1, 1, 3, 'ok'), (1, 0, 1, 'ok')]
+    # Replaying adds nothing
+    summary = add_to_grist_delete_table(['a@x.fr', 'b@x.fr', 'c@x.fr'], chunk_size=2, backoff=0)
+    assert sum(r['applied'] for r in summary) == 0
+    assert sorted(GristStandIn.tables['Delete']['Emails_to_delete']) == ['a@x.fr', 'b@x.fr', 'c@x.fr']
+    # A server error of the lookup of what is already there is retried with the chunk
+    GristStandIn.fail_sql = [503]
+    summary = add_to_grist_delete_table(['e@x.fr'], backoff=0)
+    assert [(r['applied'], r['attempts'], r['status']) for r in summary] == [(1, 2, 'ok')]
+
+    # A client error is not retried
+    GristStandIn.fail_next = [400]
+    summary = bulk_delete_records(get_grist_directory_login(), 'Contact', [1, 2, 3], chunk_size=2, backoff=0)
+    assert [r['status'] for r in summary] == ['failed', 'ok']
+    assert GristStandIn.tables['Contact']['id'] == [1, 2, 4, 5]
+
+    replies = tmp_path / 'replies.txt'
+    replies.write_text('Undeliverable: b@x.fr\nUndeliverable: d@x.fr\n')
+    summary = delete_email_from_contact_table(str(replies), backoff=0)
+    assert sum(r['applied'] for r in summary) == 2
+    assert GristStandIn.tables['Contact']['id'] == [1, 5]
+
+
+def test_directory_snapshot_delta_sync(grist_stand_in, tmp_path):
+    contact = {
+        'id': [1, 2, 3],
+        'email': ['a@x.fr', 'b@y.fr', 'c@x.fr'],
+        'Supprimez_mon_compte': [False, False, True],
+        'nom': ['A', 'B', 'C'],
+        'Nom_domaine': ['x.fr', 'y.fr', 'x.fr'],
+        'Date_modification': [100.0, 100.0, 100.0],
+        'tags': [['L'], ['L'], ['L']]
+    }
+    grist_stand_in({'Contact': contact})
+    snapshot_dir = str(tmp_path / 'snapshot')
+
+    assert sync_directory_snapshot(snapshot_dir).height == 3
+
+    # One row modified, one removed, one added on GRIST
+    contact['email'][1] = 'b2@y.fr'
+    contact['Date_modification'][1] = 200.0
+    for column in contact:
+        del contact[column][2]
+    for column, value in zip(contact, [4, 'd@x.fr', False, 'D', 'x.fr', 200.0, ['L']]):
+        contact[column].append(value)
+
+    snapshot = sync_directory_snapshot(snapshot_dir)
+    assert snapshot['id'].to_list() == [1, 2, 4]
+    assert snapshot['email'].to_list() == ['a@x.fr', 'b2@y.fr', 'd@x.fr']
+    assert snapshot.schema['Supprimez_mon_compte'] == pl.Boolean
+    assert get_directory_as_df('snapshot', sync=False, snapshot_dir=snapshot_dir).columns == DIRECTORY_COLUMNS
+
+    # A row modified in the same second as the last sync is not missed
+    contact['nom'][0] = 'A2'
+    contact['Date_modification'][0] = 200.0
+    assert sync_directory_snapshot(snapshot_dir)['nom'].to_list() == ['A2', 'B', 'D']
+
+    # The recipients are read from the snapshot: only the ids and the changed rows are downloaded
+    assert get_emails() == '<a@x.fr>; <d@x.fr>; <b2@y.fr>'
+    requests_before = len(GristStandIn.requests_log)
+    assert get_emails() == '<a@x.fr>; <d@x.fr>; <b2@y.fr>'
+    assert GristStandIn.requests_log[requests_before:] == [('POST', '/api/docs/doc/sql')] * 2
+
+
+def test_directory_snapshot_migration(grist_stand_in):
+    grist_stand_in({'Contact': {'id': [1, 2], 'email': ['a@x.fr', 'b@x.fr'], 'Supprimez_mon_compte': [False, True],
+                                           'nom': ['A', 'B'], 'Nom_domaine': ['x.fr', 'x.fr']}})
+
+    # Without the modification time column, the whole table is downloaded
+    assert get_emails() == '<a@x.fr>'
+    assert ('GET', '/api/docs/doc/tables/Contact/data') in GristStandIn.requests_log
+
+    add_directory_updated_at_column()
+    assert GristStandIn.tables['Contact'][DIRECTORY_UPDATED_AT_COLUMN] == [None, None]
+    GristStandIn.requests_log = []
+    assert get_emails() == '<a@x.fr>'
+    assert GristStandIn.requests_log == [('POST', '/api/docs/doc/sql')]
+
+
+def test_grist_columns_to_polars():
+    columns = {
+        'id': [1, 2, 3],
+        'email': ['a@x.fr', None, 'c@x.fr'],
+        'Supprimez_mon_compte': [False, True, None],
+        'tags': [['L', 'IA', 'datavis'], None, ['L']],
+        'image': [['L', 12], None, None]
+    }
+    df = grist_columns_to_polars(columns, {'id': 'Int64', 'email': 'String', 'Supprimez_mon_compte': 'Boolean', 'tags': 'List'})
+
+    assert df.schema == {'id': pl.Int64, 'email': pl.String, 'Supprimez_mon_compte': pl.Boolean, 'tags': pl.List(pl.String)}
+    assert df['tags'].to_list() == [['IA', 'datavis'], None, []]
+
+
+def test_grist_merge_pages_as_pandas(grist_stand_in, tmp_path):
+    table = {
+        'id': [1, 2, 3],
+        'Acteurs': ['Équipe 1\nInsee', None, ''],
+        'Resultats': ['- [ici](https://www.insee.fr)', 'Aucun', None],
+        'Details_du_projet': ['Détails\nsur deux lignes', None, 'Détails'],
+        'sous_titre': ['Sous-titre\nlong', 'Sous-titre', None],
+        'Code_du_projet': ['https://github.com/InseeFrLab/projet_1', None, ''],
+        'tags': [['L', 'IA', 'datavis'], '  - tag0\n  - tag1', None],
+        'nom_dossier': ['projet_1', 'projet_2', 'projet_3'],
+        'date': [1727740800, None, 1696118400],
+        'image': [['L', 12], 'image.png', None],
+        'Titre': ['Projet 1', 'Projet\n2', None],
+        'auteurs': ['  - Auteur 1', None, '  - Auteur 3'],
+        'to_update': [True, False, True]
+    }
+    grist_stand_in({'Intranet_details': table})
+
+    pages_df = get_grist_merge_as_df()
+    # The table as it was read before polars: a pandas DataFrame of the GRIST records
+    records_df = pd.DataFrame(get_grist_merge_website_login().fetch_table('Intranet_details'))
+
+    records_df = records_df[list(GRIST_TABLE_SCHEMAS['Intranet_details'])].rename(columns={
+        'Titre': 'my_yaml_title', 'sous_titre': 'my_yaml_description', 'auteurs': 'my_yaml_authors',
+        'date': 'my_yaml_date', 'image': 'my_yaml_image_path', 'tags': 'my_yaml_categories',
+        'Details_du_projet': 'my_table_details', 'Acteurs': 'my_table_actors', 'Resultats': 'my_table_results',
+        'Code_du_projet': 'my_table_repo_path'})
+    records_df['my_table_title'] = records_df['my_yaml_title']
+    assert pages_df.dtypes.to_dict() == records_df.dtypes.to_dict()
+
+    # Same pages, byte for byte
+    for name, df in [('polars', pages_df), ('pandas', records_df)]:
+        fill_template('ssphub_directory/template.qmd', clean_br_values_df(df), str(tmp_path / name))
+    for page in ['projet_1', 'projet_2', 'projet_3']:
+        expected = (tmp_path / 'pandas' / page / 'index.qmd').read_bytes()
+        assert (tmp_path / 'polars' / page / 'index.qmd').read_bytes() == expected
+    page = (tmp_path / 'polars' / 'projet_1' / 'index.qmd').read_text()
+    assert "date: 1727740800.0\n" in page and "categories : \n['L', 'IA', 'datavis']" in page
+
+
+def make_bounce(recipient, action, status):
+    return (
+        'From: MAILER-DAEMON@mx.example.com\n'
+        'To: newsletter@ssphub.fr\n'
+        'Cc: team@ssphub.fr\n'
+        'Subject: Undelivered Mail\n'
+        'MIME-Version: 1.0\n'
+        'Content-Type: multipart/report; report-type=delivery-status; boundary="B"\n\n'
+        '--B\nContent-Type: text/plain\n\n'
+        f'Could not deliver to {recipient}, sent by newsletter@ssphub.fr\n\n'
+        '--B\nContent-Type: message/delivery-status\n\n'
+        'Reporting-MTA: dns; mx.example.com\n\n'
+        f'Final-Recipient: rfc822; {recipient}\nAction: {action}\nStatus: {status}\n\n'
+        '--B--\n'
+    )
+
+
+def test_iter_bounces(tmp_path):
+    box = mailbox.mbox(str(tmp_path / 'replies.mbox'))
+    box.add(make_bounce('dead@example.com', 'failed', '5.1.1'))
+    box.add(make_bounce('full@example.com', 'delayed', '4.2.2'))
+    box.add('From: someone@example.com\nSubject: Out of office\n\nBack on monday, write to other@example.com\n')
+    box.add(make_bounce('dead@example.com', 'failed', '5.1.1'))
+    box.close()
+
+    bounces = list(iter_bounces(str(tmp_path / 'replies.mbox')))
+    assert [(b['email'], b['type']) for b in bounces] == [
+        ('dead@example.com', 'hard'), ('full@example.com', 'soft'), ('dead@example.com', 'hard')]
+    assert extract_emails_from_replies(str(tmp_path / 'replies.mbox')) == ['dead@example.com']
+
+    (tmp_path / 'eml').mkdir()
+    (tmp_path / 'eml' / '1.eml').write_text(make_bounce('gone@example.com', 'failed', '5.0.0'))
+    assert extract_emails_from_replies(str(tmp_path / 'eml')) == ['gone@example.com']
+
+    maildir = mailbox.Maildir(str(tmp_path / 'maildir'))
+    maildir.add(make_bounce('moved@example.com', 'failed', '5.1.6'))
+    assert extract_emails_from_replies(str(tmp_path / 'maildir')) == ['moved@example.com']
+
+
+def test_normalized_email_index(grist_stand_in, monkeypatch, tmp_path):
+    assert normalize_email(' <First.Name+SSPHub@Insee.fr> ') == 'first.name+ssphub@insee.fr'
+    assert normalize_email(' <First.Name+SSPHub@Insee.fr> ', fold_plus=True) == 'first.name@insee.fr'
+    df = pl.DataFrame({'email': [' <First.Name+SSPHub@Insee.fr> ']})
+    assert df.select(normalize_email_expr(fold_plus=True))['email'].to_list() == ['first.name@insee.fr']
+
+    grist_stand_in({'Contact': {
+        'id': [1, 2, 3, 4],
+        'email': ['a@x.fr', ' A@X.fr', 'b+news@x.fr', 'c@x.fr'],
+        'Supprimez_mon_compte': [False, False, False, True],
+        'nom': ['A', 'A bis', 'B', 'C'],
+        'Nom_domaine': ['x.fr'] * 4
+    }})
+
+    assert find_duplicate_emails(get_contact_email_index()) == {'a@x.fr': [1, 2]}
+    assert get_contact_email_index(fold_plus=True)['b@x.fr'] == [3]
+    assert get_ids_of_email('Contact', ['A@x.FR', 'b+NEWS@x.fr', 'z@x.fr'], lookup='index') == [1, 2, 3]
+    assert get_emails(source='grist') == '<a@x.fr>; <b+news@x.fr>'
+
+    # The index is built once per snapshot of the table
+    import ssphub_directory.my_functions as my_f
+    with monkeypatch.context() as patch:
+        patch.setattr(my_f, 'build_email_index', lambda *args: pytest.fail('index built again'))
+        assert get_ids_of_email('Contact', ['a@x.fr']) == [1, 2]
+
+    # Deleting the bounces deletes every row of the normalized email, unless exact matches are asked for
+    replies = tmp_path / 'replies.txt'
+    replies.write_text('Undeliverable: A@X.fr\nUndeliverable: c@x.fr\n')
+    delete_email_from_contact_table(str(replies), backoff=0, lookup='sql')
+    assert GristStandIn.tables['Contact']['id'] == [1, 2, 3]
+    # The deletion dropped the index with the snapshot of the table
+    delete_email_from_contact_table(str(replies), backoff=0)
+    assert GristStandIn.tables['Contact']['id'] == [3]
+
+
+def test_render_backends(tmp_path, monkeypatch):
+    from ssphub_directory.tests.stand_ins import render_stand_in
+    qmd = tmp_path / 'temp.qmd'
+    process_qmd_file('---\ntitle: "La rentrée"\ndescription: "Infolettre"\n---\n# Actualités\n', str(qmd),
+                     'https://ssphub.netlify.app/infolettre/infolettre_19/')
+    monkeypatch.setitem(RENDER_BACKENDS, 'stand_in', render_stand_in)
+
+    html_file = knit_to_html(str(qmd), engine='stand_in', use_cache=False)
+    assert html_file == str(tmp_path / 'temp.html') and '# Actualités' in open(html_file, encoding='utf-8').read()
+    with pytest.raises(ValueError, match='Unknown render engine'):
+        knit_to_html(str(qmd), engine='pandoc', use_cache=False)
+
+    from ssphub_directory.benchmark import benchmark_render_backends
+    assert benchmark_render_backends(str(qmd), engines=('stand_in',), repeat=1)[0]['text_similarity'] == 1.0
+
+
+def test_render_cache(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    (work_dir / 'chart.png').write_bytes(b'\x89PNG fake')
+    qmd = work_dir / 'temp.qmd'
+    qmd.write_text('---\ntitle: "Infolettre"\n---\n# Titre\n\n![Un graphique](chart.png)\n', encoding='utf-8')
+
+    from ssphub_directory.tests.stand_ins import render_stand_in
+    calls = []
+    monkeypatch.setitem(RENDER_BACKENDS, 'counting', lambda path: calls.append(path) or render_stand_in(path))
+
+    first = knit_to_html(str(qmd), engine='counting', cache_dir=cache_dir)
+    os.remove(first)
+    second = knit_to_html(str(qmd), engine='counting', cache_dir=cache_dir)
+    assert len(calls) == 1 and os.path.isfile(second)
+
+    # Images the qmd doesn't reference don't matter
+    (work_dir / 'other.png').write_bytes(b'\x89PNG unrelated')
+    knit_to_html(str(qmd), engine='counting', cache_dir=cache_dir)
+    assert len(calls) == 1
+    assert referenced_image_files(qmd.read_text(encoding='utf-8'), str(work_dir)) == [str(work_dir / 'chart.png')]
+
+    # Any change of a referenced image gives a new key
+    (work_dir / 'chart.png').write_bytes(b'\x89PNG other')
+    knit_to_html(str(qmd), engine='counting', cache_dir=cache_dir)
+    assert len(calls) == 2
+
+    invalidate_render_cache(str(qmd), engine='counting', cache_dir=cache_dir)
+    knit_to_html(str(qmd), engine='counting', cache_dir=cache_dir)
+    assert len(calls) == 3
+
+    # The store is bounded
+    assert len(os.listdir(cache_dir)) == 2
+    evict_lru_files(cache_dir, 0, '.html')
+    assert os.listdir(cache_dir) == []
+
+
+def test_batch_emails_render_once(tmp_path, monkeypatch):
+    import ssphub_directory.my_functions as my_f
+    monkeypatch.chdir(tmp_path)
+    calls = []
+
+    def fake_render(number, branch, temp_dir='.temp', engine='quarto'):
+        calls.append((number, branch))
+        os.makedirs(temp_dir, exist_ok=True)
+        with open(os.path.join(temp_dir, 'temp.html'), 'w', encoding='utf-8') as f:
+            f.write('<p>Infolettre</p>')
+        return os.path.join(temp_dir, 'temp.html')
+
+    monkeypatch.setattr(my_f, 'render_newsletter', fake_render)
+    eml_files = generate_emails(19, 'main', [
+        {'email_object': 'Pour validation', 'email_to': 'me@insee.fr', 'email_cc': 'boss@insee.fr', 'eml_file': '.temp/validation.eml'},
+        {'email_object': 'Infolettre', 'email_to': 'me@insee.fr', 'email_bcc': 'a@b.fr;c@d.fr', 'email_from': 'ssphub@insee.fr'}])
+
+    assert calls == [(19, 'main')]
+    assert eml_files == ['.temp/validation.eml', '.temp/email_1.eml']
+    with open('.temp/email_1.eml', 'rb') as f:
+        msg = BytesParser().parse(f)
+    assert msg['BCC'] == 'a@b.fr;c@d.fr' and msg['From'] == 'ssphub@insee.fr'
+    assert '<p>Infolettre</p>' in msg.get_payload()[0].get_payload(decode=True).decode('utf-8')
+    assert not os.path.exists('.temp/temp.html')
+
+
+def test_sharded_eml_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    recipients = '; '.join(f'<user{i}@insee.fr>' for i in range(7))
+
+    shards = write_eml_files(encode_email_body('<p>Infolettre de rentrée</p>'), 'Infolettre de rentrée', recipients,
+                             to_recipient='me@insee.fr', shard_size=3)
+    # The first shard is on disk before the next ones are built
+    assert next(shards) == '.temp/email_001.eml' and os.listdir('.temp') == ['email_001.eml']
+    assert list(shards) == ['.temp/email_002.eml', '.temp/email_003.eml']
+
+    bodies = set()
+    for i, expected in enumerate([3, 3, 1], start=1):
+        with open(f'.temp/email_{i:03d}.eml', 'rb') as f:
+            msg = BytesParser().parse(f)
+        assert len(msg['BCC'].split(';')) == expected and msg['To'] == 'me@insee.fr'
+        bodies.add(msg.get_payload()[0].get_payload(decode=True))
+    assert bodies == {'<p>Infolettre de rentrée</p>'.encode('utf-8')}
+
+    assert generate_eml_file('<p>x</p>', 'objet', '<a@b.fr>') == '.temp/email.eml'
+    assert split_recipients('', 3) == ['']
+
+    # Long headers are folded, and read back whole in front of the body
+    many = '; '.join(f'<user{i}@exemple-de-domaine.fr>' for i in range(60))
+    headers = encode_email_headers('Lettre n°12 : rentrée', many, to_recipient='me@insee.fr')
+    assert b'\n ' in headers and headers.endswith(b'X-Unsent: 1\n')
+    msg = BytesParser().parsebytes(headers + encode_email_body('<p>x</p>'))
+    assert msg['BCC'].split() == many.split() and msg['X-Unsent'] == '1'
+    assert msg.get_payload()[0].get_payload(decode=True) == b'<p>x</p>'
+
+
+def test_recipient_batches(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    emails = [f'user{i}@insee.fr' for i in range(7)] + ['a@gmail.com', 'b@GMAIL.com', 'c@ens.fr', 'USER0@insee.fr']
+    directory_df = pl.DataFrame({'email': emails + ['gone@insee.fr'],
+                                 'nom': [f'nom{i}' for i in range(len(emails) + 1)],
+                                 'Nom_domaine': ['Insee'] * (len(emails) + 1),
+                                 'Supprimez_mon_compte': [False] * len(emails) + [True]})
+
+    batches = plan_recipient_batches(directory_df, max_per_message=4, max_per_domain=2)
+    # Everyone once, without the deleted account and the duplicate
+    sent = [email for batch in batches for email in batch.emails]
+    assert sorted(sent) == sorted(emails[:-1])
+    for batch in batches:
+        assert len(batch.emails) <= 4 and max(batch.domains.values()) <= 2
+        assert sum(batch.domains.values()) == len(batch.emails)
+    # insee.fr, with the most emails, is spread over all the batches
+    assert [batch.domains.get('insee.fr') for batch in batches] == [2, 2, 2, 1]
+    assert batches[0].number == 1 and batches[0].bcc.startswith('<user') and batches[0].bcc.count('; ') == 3
+
+    files = list(write_eml_files(encode_email_body('<p>x</p>'), 'objet', '', batches=batches))
+    assert files == [f'.temp/email_{i:03d}.eml' for i in range(1, 5)]
+    with open(files[-1], 'rb') as f:
+        assert BytesParser().parse(f)['BCC'] == batches[-1].bcc
+
+    with pytest.raises(ValueError):
+        plan_recipient_batches(directory_df, max_per_domain=0)
+
+
+def test_cid_images():
+    png = base64.b64encode(b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 40).decode('ascii')
+    gif = base64.b64encode(b'GIF89a' + bytes(100)).decode('ascii')
+    email_body = (f'<p>Infolettre</p><img src="data:image/png;base64,{png}" alt="a">'
+                  f'<img alt="b" src="data:image/png;base64,{png}"><img src=\'data:image/gif;base64,{gif}\'>')
+
+    html_content, images = extract_inline_images(email_body)
+    assert len(images) == 2 and 'data:' not in html_content
+    assert html_content.count('src="cid:') == 2 and "src='cid:" in html_content
+
+    inline = encode_email_body(email_body)
+    related = encode_email_body(email_body, cid_images=True)
+    assert len(related) < 0.6 * len(inline)
+
+    msg = BytesParser().parsebytes(related)
+    assert msg.get_content_type() == 'multipart/related'
+    html_part, *image_parts = msg.get_payload()
+    cids = {part['Content-ID'].strip('<>') for part in image_parts}
+    assert cids == set(images)
+    assert all(f'cid:{cid}' in html_part.get_payload(decode=True).decode('utf-8') for cid in cids)
+
+
+def test_recompress_image():
+    Image = pytest.importorskip('PIL.Image')
+    output = io.BytesIO()
+    Image.new('RGB', (2400, 1200), (200, 30, 30)).save(output, 'PNG')
+    image_bytes, mime_type = recompress_image(output.getvalue(), 'image/png', max_width=600, quality=70)
+    assert mime_type == 'image/jpeg' and Image.open(io.BytesIO(image_bytes)).size == (600, 300)
+
+
+def test_render_newsletter_overlaps_network_stages(tmp_path, monkeypatch):
+    import ssphub_directory.my_functions as my_f
+    from ssphub_directory.tests.stand_ins import render_stand_in
+    monkeypatch.setitem(RENDER_BACKENDS, 'stand_in', render_stand_in)
+    monkeypatch.chdir(tmp_path)
+    running = []
+    peak = []
+
+    def slow(seconds, result):
+        running.append(1)
+        peak.append(len(running))
+        time.sleep(seconds)
+        running.pop()
+        return result
+
+    def fake_download(file_url, output_dir, headers=None, session=None, raise_errors=False):
+        with open(os.path.join(output_dir, file_url.rsplit('/', 1)[1]), 'wb') as f:
+            f.write(b'\x89PNG fake')
+        return slow(0.2, (file_url.rsplit('/', 1)[1], None))
+
+    qmd_urls = []
+    monkeypatch.setattr(my_f, 'resolve_github_commit', lambda owner, repo, branch: 'c0ffee')
+    monkeypatch.setattr(my_f, 'list_image_files_for_newsletter',
+                        lambda number, branch, listing, commit_sha: slow(0.2, [f'https://example.org/{commit_sha}/img_{i}.png' for i in range(6)]))
+    monkeypatch.setattr(my_f, 'stream_download', fake_download)
+    monkeypatch.setattr(my_f, 'fetch_qmd_file',
+                        lambda url: qmd_urls.append(url) or slow(0.4, '---\ntitle: "Infolettre"\ndescription: "Octobre"\n---\n# Titre\n\n![](img_0.png)\n'))
+
+    html_file = render_newsletter(20, 'main', '.temp', engine='stand_in', max_concurrency=3)
+
+    # 3 images downloaded at a time while the qmd file is still being fetched
+    assert max(peak) == 4
+    # The qmd file comes from the commit of the images
+    assert '/c0ffee/infolettre/infolettre_20/' in qmd_urls[0]
+    assert '![](img_0.png)' in open(html_file, encoding='utf-8').read()
+
+    # A qmd file that can't be fetched is reported as such
+    monkeypatch.setattr(my_f, 'fetch_qmd_file', lambda url: None)
+    with pytest.raises(ValueError, match='could not be fetched'):
+        render_newsletter(20, 'main', '.temp', engine='stand_in')
+
+
+@pytest.mark.slow
+def test_offline_benchmarks():
+    from ssphub_directory.benchmark import run_offline_benchmarks, compare_results
+    results = run_offline_benchmarks(scales=(300,), repeat=2, n_images=2, pages_per_rows=50, cold_start=False)
+    by_name = {result['benchmark']: result for result in results['results']}
+
+    assert set(by_name) == {'get_emails', 'generate_email', 'fill_all_templates_from_grist', 'delete_email_from_contact_table'}
+    assert by_name['get_emails']['emails'] == 300 - 300 // 97 - 300 // 53
+    assert by_name['fill_all_templates_from_grist']['pages'] == 6
+    assert by_name['delete_email_from_contact_table']['deleted'] == 3
+    assert all(result['runs'] == 2 and result['best_seconds'] <= result['cold_seconds'] for result in results['results'])
+
+    slower = {'results': [{**result, 'best_seconds': result['best_seconds'] * 2 + 1} for result in results['results']]}
+    assert len(compare_results(results, slower)) == 4 and compare_results(slower, results) == []
+
+
+def test_cli_bounces(tmp_path, capsys):
+    from ssphub_directory.cli import main
+    (tmp_path / 'replies.txt').write_text('Delivery failed for a@x.fr\nand for b@x.fr\n')
+    assert main(['bounces', str(tmp_path / 'replies.txt')]) == 0
+    assert sorted(capsys.readouterr().out.split()) == ['a@x.fr', 'b@x.fr']
+
+
+def test_cli_bounces_delete_types(tmp_path, monkeypatch):
+    from ssphub_directory import cli
+    calls = []
+    monkeypatch.setattr(cli.my_f, 'delete_email_from_contact_table',
+                        lambda path, types: calls.append((path, types)) or [])
+    assert cli.main(['bounces', 'replies.mbox', '--delete', '--types', 'hard', 'soft']) == 0
+    assert cli.main(['bounces', 'replies.mbox', '--delete']) == 0
+    assert calls == [('replies.mbox', ('hard', 'soft')), ('replies.mbox', ('hard',))]
+
+
+def test_cli_max_per_domain_needs_directory(capsys):
+    from ssphub_directory.cli import main
+    with pytest.raises(SystemExit) as error:
+        main(['newsletter', '20', '--object', 'Infolettre', '--to', 'a@x.fr', '--max-per-domain', '50'])
+    assert error.value.code == 2
+    assert '--directory-bcc' in capsys.readouterr().err
+
+
+@pytest.mark.slow
+def test_cold_start_benchmark():
+    from ssphub_directory.benchmark import benchmark_cold_start
+    results = {result['benchmark']: result for result in benchmark_cold_start(repeat=1)}
+    assert results['cold_start_import']['heavy_modules_loaded'] == []
+    assert set(results) == {'cold_start_import', 'cold_start_bounces', 'cold_start_heavy_modules'}
+
+
+def test_pipeline_stages_across_threads(capsys):
+    with instrumented_pipeline('threads'):
+        with pipeline_stage('main'):
+            count_metric('calls')
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(count_metric, ['calls'] * 4))
+            run_coroutine(asyncio.to_thread(count_metric, 'calls'))
+        with pipeline_stage('empty'):
+            pass
+
+    # The counters of the threads go to the stage open meanwhile
+    stages = {stage['stage']: stage['counters'] for stage in last_pipeline_metrics('threads')['stages']}
+    assert stages == {'main': {'calls': 6}, 'empty': {}}
+    # The summary is only logged
+    assert 'threads:' not in capsys.readouterr().out
+    # The profilers are only imported to profile
+    import subprocess
+    import sys
+    code = 'import ssphub_directory.my_functions, sys; print("cProfile" in sys.modules or "tracemalloc" in sys.modules)'
+    assert subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() == 'False'
+
+
+def test_pipeline_metrics(grist_stand_in, tmp_path, monkeypatch):
+    grist_stand_in({'Contact': {'id': [1, 2, 3], 'email': ['a@x.fr', 'b@x.fr', 'c@x.fr']}})
+    monkeypatch.setenv('SSPHUB_METRICS_FILE', str(tmp_path / 'metrics.jsonl'))
+    (tmp_path / 'replies.txt').write_text('Undeliverable: b@x.fr\n')
+
+    delete_email_from_contact_table(str(tmp_path / 'replies.txt'))
+    report = last_pipeline_metrics('delete_email_from_contact_table')
+    assert [stage['stage'] for stage in report['stages']] == ['extract_emails', 'lookup', 'delete']
+    lookup, delete = report['stages'][1:]
+    assert lookup['counters'] == {'http_calls': 1, 'bytes_downloaded': lookup['counters']['bytes_downloaded'], 'rows_fetched': 3}
+    assert delete['counters']['rows_written'] == 1
+    assert report['counters']['http_calls'] == sum(stage['counters'].get('http_calls', 0) for stage in report['stages'])
+    assert json.loads((tmp_path / 'metrics.jsonl').read_text())['pipeline'] == 'delete_email_from_contact_table'
+
+    # Opt-in profiling, nested pipelines add to the outer run
+    for profile, key in [('cprofile', 'profile'), ('tracemalloc', 'memory')]:
+        with instrumented_pipeline('outer', profile=profile):
+            with pipeline_stage('setup'):
+                [bytes(1000) for _ in range(100)]
+            delete_email_from_contact_table(str(tmp_path / 'replies.txt'))
+        stages = last_pipeline_metrics('outer')['stages']
+        assert [stage['stage'] for stage in stages] == ['setup', 'extract_emails', 'lookup', 'delete']
+        assert all(key in stage for stage in stages)
+    assert 'cumulative' in stages[0].get('profile', '') or stages[0]['memory']['peak_bytes'] > 0
+
+
+def test_github_tree_listing(tmp_path, monkeypatch):
+    from ssphub_directory.tests.stand_ins import serve_github, write_synthetic_newsletter, GitHubStandIn
+    for number in (19, 20):
+        write_synthetic_newsletter(str(tmp_path / 'github'), number=number, n_images=2, image_size=1000)
+    server, url = serve_github(str(tmp_path / 'github'))
+    monkeypatch.setenv('SSPHUB_GITHUB_API', url)
+    monkeypatch.setenv('SSPHUB_GITHUB_RAW', url)
+    monkeypatch.chdir(tmp_path)
+    clear_github_trees()
+
+    images_19 = list_tree_image_files('InseeFrLab', 'ssphub', 'infolettre/infolettre_19')
+    images_20 = list_image_files_for_newsletter(20)
+    assert [image['path'] for image in images_19] == ['infolettre/infolettre_19/image_0.png', 'infolettre/infolettre_19/image_1.png']
+    # The raw urls name the commit that was listed
+    commit_sha, = GitHubStandIn.commits
+    assert images_20 == [f'{url}/InseeFrLab/ssphub/{commit_sha}/infolettre/infolettre_20/image_{i}.png' for i in range(2)]
+    assert [url.replace(f'/{commit_sha}/', '/refs/heads/main/') for url in images_20] == \
+        list_image_files_for_newsletter(20, listing='contents')
+    # One call for the commit and one for the tree, whatever the number of newsletters
+    assert [path.split('/')[4] for path in GitHubStandIn.requests_log if '/commits/' in path or '/git/' in path] == ['commits', 'git']
+
+    # Blob SHAs tell which images are already there
+    download_file(images_19[0]['url'], 'images')
+    assert git_blob_sha('images/image_0.png') == images_19[0]['sha']
+    # The images of a newsletter, as a list of file names
+    assert download_images_for_newsletter(20, output_dir='newsletter_20') == ['image_0.png', 'image_1.png']
+    assert download_images_for_newsletter(20, output_dir='newsletter_20', return_failures=True)[1] == {}
+
+    # The tree is kept on disk by commit SHA
+    with_disk_cache = len(GitHubStandIn.requests_log)
+    import ssphub_directory.my_functions as my_f
+    monkeypatch.setattr(my_f, "_github_trees", {})
+    list_tree_image_files('InseeFrLab', 'ssphub', 'infolettre/infolettre_20')
+    assert not any('/git/' in path for path in GitHubStandIn.requests_log[with_disk_cache:])
+
+    server.shutdown()
+    clear_github_trees()
@@ -0,0 +1,311 @@
+"""
+Local stand-ins of GitHub and GRIST, serving synthetic data over HTTP, and of Quarto (render_stand_in).
+Used by the tests and the offline benchmarks.
+
+Example:
+    >>> server, url = serve_grist({'Contact': {'id': [1], 'email': ['a@b.fr'], ...}})
+    >>> with stand_in_environment(github_url, url):
+    ...     my_f.get_emails()
+    '<a@b.fr>'
+    >>> server.shutdown()
+"""
+import contextlib  # To point my_functions to the stand-ins
+import functools  # To serve a folder over HTTP
+import hashlib  # Commit and blob SHAs of the GitHub stand-in
+import html  # Page of the Quarto stand-in
+import http.server  # Local stand-ins of GitHub / GRIST
+import io  # To build the attachments archive in memory
+import json
+import os
+import random  # Synthetic newsletter
+import sqlite3  # SQL endpoint of the GRIST stand-in
+import threading  # To run the stand-ins in the background
+import urllib.parse
+import zipfile  # GRIST attachments archive
+
+import ssphub_directory.my_functions as my_f
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """Request handler not logging every request"""
+    def log_message(self, *args):
+        pass
+
+
+def start_server(handler):
+    """
+    Start an HTTP server in a background thread
+
+    Returns:
+        tuple with the server (to shut down) and its base url
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+class GitHubStandIn(QuietHandler):
+    """
+    Local stand-in for GitHub, serving a folder laid out as raw.githubusercontent.com
+    (<owner>/<repo>/refs/heads/<branch>/<path>): raw files, with Last-Modified revalidation, also
+    at <owner>/<repo>/<commit sha>/<path> for the commit SHAs it gave,
+    the contents API (/repos/<owner>/<repo>/contents/<path>?ref=<branch>), the commit SHA of a branch
+    (/repos/<owner>/<repo>/commits/<branch>) and the recursive Git Trees API
+    (/repos/<owner>/<repo>/git/trees/<commit sha>:<path>?recursive=1)
+    """
+    requests_log = []
+    commits = {}  # {commit sha: branch}
+
+    def send_body(self, body, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        self.requests_log.append(url.path)
+        parts = url.path.strip('/').split('/')
+        if parts[0] != 'repos':
+            if len(parts) > 2 and parts[2] in self.commits:
+                # Raw file at a commit: served from the branch it was given for
+                self.path = '/' + '/'.join(parts[:2] + ['refs', 'heads', self.commits[parts[2]]] + parts[3:])
+            return super().do_GET()
+
+        owner, repo = parts[1], parts[2]
+        if parts[3] == 'commits':
+            # The commit SHA changes with the content of the branch
+            branch_dir = os.path.join(self.directory, owner, repo, 'refs', 'heads', parts[4])
+            hasher = hashlib.sha1(parts[4].encode('utf-8'))
+            for root, dirs, files in sorted(os.walk(branch_dir)):
+                for name in sorted(files):
+                    with open(os.path.join(root, name), 'rb') as f:
+                        hasher.update(os.path.relpath(os.path.join(root, name), branch_dir).encode('utf-8') + f.read())
+            GitHubStandIn.commits[hasher.hexdigest()] = parts[4]
+            return self.send_body(hasher.hexdigest().encode('ascii'), 'application/vnd.github.sha')
+
+        if parts[3] == 'git':
+            commit_sha, _, path = urllib.parse.unquote('/'.join(parts[5:])).partition(':')
+            folder = os.path.join(self.directory, owner, repo, 'refs', 'heads', self.commits[commit_sha], path)
+            tree = []
+            for root, dirs, files in sorted(os.walk(folder)):
+                relative_root = os.path.relpath(root, folder)
+                for name in sorted(dirs):
+                    tree.append({'path': os.path.normpath(os.path.join(relative_root, name)), 'type': 'tree', 'sha': '0' * 40})
+                for name in sorted(files):
+                    with open(os.path.join(root, name), 'rb') as f:
+                        content = f.read()
+                    tree.append({'path': os.path.normpath(os.path.join(relative_root, name)), 'type': 'blob', 'size': len(content),
+                                 'sha': hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()})
+            return self.send_body(json.dumps({'sha': commit_sha, 'tree': tree, 'truncated': False}).encode('utf-8'))
+
+        path = '/'.join(parts[4:])
+        branch = urllib.parse.parse_qs(url.query).get('ref', ['main'])[0]
+        folder = os.path.join(self.directory, owner, repo, 'refs', 'heads', branch, path)
+        if not os.path.isdir(folder):
+            self.send_error(404)
+            return
+        self.send_body(json.dumps([{'name': name, 'path': f'{path}/{name}',
+                                    'type': 'file' if os.path.isfile(os.path.join(folder, name)) else 'dir'}
+                                   for name in sorted(os.listdir(folder))]).encode('utf-8'))
+
+
+def serve_github(directory):
+    """Start a GitHub stand-in serving the given folder, returns the server and its url"""
+    GitHubStandIn.requests_log = []
+    GitHubStandIn.commits = {}
+    return start_server(functools.partial(GitHubStandIn, directory=str(directory)))
+
+
+class GristStandIn(QuietHandler):
+    """
+    Local stand-in for the GRIST REST API. Every document has the same tables, dicts of columns,
+    e.g. {'Contact': {'id': [1, 2], 'email': ['a@b.fr', 'c@d.fr']}}, and attachments {id: (file name, content)}
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    tables = {}
+    attachments = {}
+    requests_log = []
+    fail_next = []  # status codes, or (status code, error message), to answer to the next writes, to test retries
+    fail_sql = []  # status codes to answer to the next SQL queries
+
+    def send_body(self, body, content_type='application/json', status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, obj, status=200):
+        self.send_body(json.dumps(obj).encode('utf-8'), status=status)
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def send_attachments(self, parts):
+        # parts: ['', 'api', 'docs', doc, 'attachments', ('archive' | id, 'download')]
+        if len(parts) == 5:
+            self.send_json({'records': [{'id': attachment_id, 'fields': {'fileName': name, 'fileSize': len(content)}}
+                                        for attachment_id, (name, content) in sorted(self.attachments.items())]})
+        elif parts[5] == 'archive':
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w') as zip_file:
+                for attachment_id, (name, content) in sorted(self.attachments.items()):
+                    zip_file.writestr(f'{attachment_id:040d}_{name}', content)
+            self.send_body(archive.getvalue(), 'application/zip',
+                           headers={'Content-Disposition': 'attachment; filename="attachments.zip"'})
+        else:
+            name, content = self.attachments[int(parts[5])]
+            self.send_body(content, 'application/octet-stream',
+                           headers={'Content-Disposition': f'attachment; filename="{name}"'})
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        self.requests_log.append(('GET', url.path))
+        parts = url.path.split('/')  # ['', 'api', 'docs', doc, 'tables', table, 'data']
+        if parts[4] == 'attachments':
+            return self.send_attachments(parts)
+        table = self.tables[parts[5]]
+        rows = range(len(table['id']))
+        query = urllib.parse.parse_qs(url.query)
+        if 'filter' in query:
+            filters = json.loads(query['filter'][0])
+            rows = [i for i in rows if all(table[col][i] in values for col, values in filters.items())]
+        if parts[6] == 'records':
+            self.send_json({'records': [
+                {'id': table['id'][i], 'fields': {col: values[i] for col, values in table.items() if col != 'id'}}
+                for i in rows]})
+        else:
+            self.send_json({col: [values[i] for i in rows] for col, values in table.items()})
+
+    def run_sql(self, sql, args):
+        # The tables are loaded into an in-memory SQLite database, as GRIST does
+        connection = sqlite3.connect(':memory:')
+        for table_name, table in self.tables.items():
+            columns = list(table)
+            connection.execute(f'CREATE TABLE "{table_name}" ({", ".join(columns)})')
+            connection.executemany(f'INSERT INTO "{table_name}" VALUES ({", ".join("?" * len(columns))})',
+                                   [[json.dumps(v) if isinstance(v, list) else v for v in row]
+                                    for row in zip(*table.values())])
+        cursor = connection.execute(sql, args)
+        names = [description[0] for description in cursor.description]
+        return [{'fields': dict(zip(names, row))} for row in cursor.fetchall()]
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        self.requests_log.append(('POST', url.path))
+        data = self.read_json()
+        parts = url.path.split('/')
+        if parts[4] == 'sql' and self.fail_sql:
+            self.send_json({'error': 'SQL endpoint not available'}, self.fail_sql.pop(0))
+        elif parts[4] != 'sql' and self.fail_next:
+            status = self.fail_next.pop(0)
+            status, error = status if isinstance(status, tuple) else (status, 'Try again later')
+            self.send_json({'error': error}, status)
+        elif parts[4] == 'sql':
+            try:
+                self.send_json({'records': self.run_sql(data['sql'], data.get('args', []))})
+            except sqlite3.Error as e:
+                self.send_json({'error': str(e)}, 400)
+        elif parts[4] == 'apply':
+            for action, table_name, row_ids in data:
+                table = self.tables[table_name]
+                row_ids = set(row_ids)
+                keep = [i for i, row_id in enumerate(table['id']) if row_id not in row_ids]
+                self.tables[table_name] = {col: [values[i] for i in keep] for col, values in table.items()}
+            self.send_json({})
+        elif parts[6] == 'columns':
+            table = self.tables[parts[5]]
+            for column in data['columns']:
+                table[column['id']] = [None] * len(table['id'])
+            self.send_json({'columns': [{'id': column['id']} for column in data['columns']]})
+        else:
+            table = self.tables[parts[5]]
+            count = len(next(iter(data.values())))
+            first_id = max(table['id'], default=0) + 1
+            new_ids = list(range(first_id, first_id + count))
+            for col in table:
+                table[col].extend(new_ids if col == 'id' else data.get(col, [None] * count))
+            self.send_json(new_ids)
+
+
+def serve_grist(tables, attachments=None):
+    """Start a GRIST stand-in serving the given tables and attachments, returns the server and its url"""
+    GristStandIn.tables = tables
+    GristStandIn.attachments = attachments or {}
+    GristStandIn.requests_log = []
+    GristStandIn.fail_next = []
+    GristStandIn.fail_sql = []
+    return start_server(GristStandIn)
+
+
+@contextlib.contextmanager
+def stand_in_environment(github_url, grist_url, cache_dir=None):
+    """
+    Point the functions of my_functions to the stand-ins (environment variables of the servers,
+    documents and API key), and restore the environment afterwards. With a cache_dir, the caches
+    of my_functions are kept there (SSPHUB_CACHE_DIR)
+    """
+    variables = {
+        'SSPHUB_GITHUB_API': github_url,
+        'SSPHUB_GITHUB_RAW': github_url,
+        'GRIST_SERVER': grist_url,
+        'GRIST_API_KEY': 'benchmark',
+        'GRIST_SSPHUB_DIRECTORY_ID': 'directory',
+        'GRIST_SSPHUB_WEBSITE_MERGE_ID': 'website'
+    }
+    if cache_dir is not None:
+        variables['SSPHUB_CACHE_DIR'] = cache_dir
+    previous = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    my_f.clear_grist_clients()
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        my_f.clear_grist_clients()
+
+
+def write_synthetic_newsletter(github_dir, number=1, n_images=8, image_size=200_000, branch='main'):
+    """
+    Write a newsletter with n_images images of image_size bytes in a folder served by GitHubStandIn
+
+    Returns:
+        (string) folder of the newsletter
+    """
+    rng = random.Random(number)
+    folder = os.path.join(github_dir, 'InseeFrLab', 'ssphub', 'refs', 'heads', branch, 'infolettre', f'infolettre_{number}')
+    os.makedirs(folder, exist_ok=True)
+
+    sections = []
+    for i in range(n_images):
+        with open(os.path.join(folder, f'image_{i}.png'), 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + rng.randbytes(image_size))
+        paragraph = ' '.join(rng.choice(['données', 'statistique', '**Python**', 'réseau', '[site](https://ssphub.netlify.app/)',
+                                         'enquête', 'modèle', '*datavis*']) for _ in range(120))
+        sections.append(f'## Actualité {i}\n\n{paragraph}\n\n- point 1\n- point 2\n\n![Image {i}](image_{i}.png){{width=80%}}\n')
+
+    with open(os.path.join(folder, 'index.qmd'), 'w', encoding='utf-8') as f:
+        f.write(f'---\ntitle: "Infolettre {number}"\ndescription: "Infolettre de __synthèse__"\ndate: \'2025-10-01\'\n'
+                f'number: {number}\nimage: image_0.png\n---\n\n' + '\n'.join(sections))
+    return folder
+
+
+def render_stand_in(processed_qmd_file):
+    """
+    Render backend standing in for Quarto (see my_f.register_render_backend): writes the qmd file as is
+    in an html page next to it, to run the newsletter pipeline where Quarto isn't installed
+    """
+    with open(processed_qmd_file, 'r', encoding='utf-8') as f:
+        qmd_content = f.read()
+    html_file = os.path.splitext(processed_qmd_file)[0] + '.html'
+    with open(html_file, 'w', encoding='utf-8') as f:
+        f.write(f'<!DOCTYPE html>\n<html>\n<body>\n<pre>{html.escape(qmd_content)}</pre>\n</body>\n</html>\n')
+    return html_file